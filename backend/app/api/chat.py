@@ -1,10 +1,15 @@
-from fastapi import APIRouter, HTTPException
-from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Dict, List, Optional
 from pydantic import BaseModel
+import asyncio
+import json
 from app.services.llm_service import llm_service
 from app.services.conversation_service import conversation_service
 
 router = APIRouter()
+# WebSocket路由挂载在/ws下（nginx已代理/ws/）
+ws_router = APIRouter()
 
 class ChatRequest(BaseModel):
     message: str
@@ -15,6 +20,50 @@ class ChatResponse(BaseModel):
     conversation_id: str
     sources: List[str] = []
 
+def _begin_turn(message: str, conversation_id: Optional[str]):
+    """获取或创建对话并写入用户消息，返回(对话id, 之前的对话历史, 已收集的症状)"""
+    if conversation_id:
+        conversation = conversation_service.get_conversation(conversation_id)
+        if not conversation:
+            raise LookupError('对话不存在')
+    else:
+        conversation = conversation_service.create_conversation()
+    
+    # 添加用户消息
+    conversation_service.add_message(conversation['id'], 'user', message)
+    
+    # 获取对话历史（直接引用已有消息，不逐条重建）；症状由对话状态增量维护，已包含本条消息
+    conv = conversation_service.get_conversation(conversation['id'])
+    symptoms = list(conversation_service.get_symptoms(conversation['id']))
+    return conversation['id'], conv['messages'][:-1], symptoms
+
+async def _stream_turn(message: str, conversation_id: str, conversation_history: List[Dict], symptoms: List[str]) -> AsyncIterator[Dict]:
+    """逐段转发模型输出，流结束（或客户端断开）后保存助手回复"""
+    yield {'type': 'start', 'conversation_id': conversation_id}
+    parts = []
+    sources = []
+    saved = False
+    try:
+        async for event in llm_service.astream_chat_with_rag(
+            message=message,
+            conversation_history=conversation_history,
+            session_id=conversation_id,
+            collected_symptoms=symptoms
+        ):
+            if event['type'] == 'delta':
+                parts.append(event['content'])
+                yield event
+            else:
+                sources = event['result'].get('sources', [])
+                # 先保存再通知结束，客户端收到done后即可读到这条回复
+                saved = True
+                await asyncio.to_thread(conversation_service.add_message, conversation_id, 'assistant', ''.join(parts), sources)
+                yield {'type': 'done', 'conversation_id': conversation_id, 'sources': sources, 'prompt_tokens': event['result'].get('prompt_tokens')}
+    finally:
+        if parts and not saved:
+            # 客户端中途断开时生成器已被关闭、不能再await：提交到线程池保存，不等待完成
+            asyncio.get_running_loop().run_in_executor(None, conversation_service.add_message, conversation_id, 'assistant', ''.join(parts), sources)
+
 @router.post('/consultation', response_model=ChatResponse)
 async def consultation(request: ChatRequest):
     """中医诊疗对话接口"""
@@ -23,34 +72,21 @@ async def consultation(request: ChatRequest):
         raise HTTPException(status_code=400, detail='消息不能为空')
     
     try:
-        # 获取或创建对话
-        if request.conversation_id:
-            conversation = conversation_service.get_conversation(request.conversation_id)
-            if not conversation:
-                raise HTTPException(status_code=404, detail='对话不存在')
-        else:
-            conversation = conversation_service.create_conversation()
-        
-        # 添加用户消息
-        conversation_service.add_message(conversation['id'], 'user', request.message)
-        
-        # 获取对话历史
-        conv = conversation_service.get_conversation(conversation['id'])
-        conversation_history = [
-            {'role': msg['role'], 'content': msg['content']}
-            for msg in conv['messages'][:-1]
-        ]
+        # 对话读写在事务中进行，可能等待其他进程的写锁，放到线程池中执行
+        conversation_id, conversation_history, symptoms = await asyncio.to_thread(_begin_turn, request.message, request.conversation_id)
         
         # 调用RAG服务
-        result = llm_service.chat_with_rag(
+        result = await llm_service.achat_with_rag(
             message=request.message,
             conversation_history=conversation_history,
-            session_id=conversation['id']
+            session_id=conversation_id,
+            collected_symptoms=symptoms
         )
         
         # 添加助手回复
-        conversation_service.add_message(
-            conversation['id'],
+        await asyncio.to_thread(
+            conversation_service.add_message,
+            conversation_id,
             'assistant',
             result['response'],
             result.get('sources', [])
@@ -58,22 +94,74 @@ async def consultation(request: ChatRequest):
         
         return ChatResponse(
             response=result['response'],
-            conversation_id=conversation['id'],
+            conversation_id=conversation_id,
             sources=result.get('sources', [])
         )
         
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f'处理失败: {str(e)}')
 
+@router.post('/consultation/stream')
+async def consultation_stream(request: ChatRequest):
+    """流式诊疗对话接口（SSE），逐段返回模型输出"""
+    
+    if not request.message or not request.message.strip():
+        raise HTTPException(status_code=400, detail='消息不能为空')
+    
+    try:
+        conversation_id, conversation_history, symptoms = await asyncio.to_thread(_begin_turn, request.message, request.conversation_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    
+    async def event_stream():
+        async for event in _stream_turn(request.message, conversation_id, conversation_history, symptoms):
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@ws_router.websocket('/consultation')
+async def consultation_ws(websocket: WebSocket):
+    """流式诊疗对话接口（WebSocket），客户端发送 {"message", "conversation_id"}"""
+    await websocket.accept()
+    try:
+        while True:
+            data = await websocket.receive_json()
+            message = data.get('message') or ''
+            if not message.strip():
+                await websocket.send_json({'type': 'error', 'detail': '消息不能为空'})
+                continue
+            try:
+                conversation_id, conversation_history, symptoms = await asyncio.to_thread(_begin_turn, message, data.get('conversation_id'))
+            except LookupError as e:
+                await websocket.send_json({'type': 'error', 'detail': str(e)})
+                continue
+            async for event in _stream_turn(message, conversation_id, conversation_history, symptoms):
+                await websocket.send_json(event)
+    except WebSocketDisconnect:
+        pass
+
 @router.get('/conversations')
-async def list_conversations():
-    """获取所有对话列表"""
+async def list_conversations(
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    summary: bool = True
+):
+    """分页获取对话列表（默认只返回摘要）"""
     try:
-        conversations = conversation_service.list_conversations()
+        page = await asyncio.to_thread(conversation_service.list_conversation_page, limit=limit, cursor=cursor, summary=summary)
         return {
             'status': 'success',
-            'data': conversations
+            'data': page['items'],
+            'next_cursor': page['next_cursor']
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -81,7 +169,7 @@ async def list_conversations():
 async def get_conversation(conversation_id: str):
     """获取对话详情"""
     try:
-        conversation = conversation_service.get_conversation(conversation_id)
+        conversation = await asyncio.to_thread(conversation_service.get_conversation, conversation_id)
         if not conversation:
             raise HTTPException(status_code=404, detail='对话不存在')
         return {
@@ -95,7 +183,7 @@ async def get_conversation(conversation_id: str):
 async def create_conversation(title: str = '新对话'):
     """创建新对话"""
     try:
-        conversation = conversation_service.create_conversation(title)
+        conversation = await asyncio.to_thread(conversation_service.create_conversation, title)
         return {
             'status': 'success',
             'data': conversation
@@ -107,7 +195,7 @@ async def create_conversation(title: str = '新对话'):
 async def delete_conversation(conversation_id: str):
     """删除对话"""
     try:
-        success = conversation_service.delete_conversation(conversation_id)
+        success = await asyncio.to_thread(conversation_service.delete_conversation, conversation_id)
         if not success:
             raise HTTPException(status_code=404, detail='对话不存在')
         return {
@@ -121,7 +209,7 @@ async def delete_conversation(conversation_id: str):
 async def update_title(conversation_id: str, title: str):
     """更新对话标题"""
     try:
-        success = conversation_service.update_title(conversation_id, title)
+        success = await asyncio.to_thread(conversation_service.update_title, conversation_id, title)
         if not success:
             raise HTTPException(status_code=404, detail='对话不存在')
         return {
@@ -140,11 +228,26 @@ async def health_check():
         'version': '2.1.0'
     }
 
+@router.get('/cache/stats')
+async def cache_stats():
+    """问诊回复缓存命中统计"""
+    if not llm_service.cache:
+        return {'status': 'success', 'data': {'enabled': False}}
+    return {
+        'status': 'success',
+        'data': {'enabled': True, **llm_service.cache.stats()}
+    }
+
+@router.get('/coalescing/stats')
+async def coalescing_stats():
+    """上游调用合并和检索微批统计"""
+    return {'status': 'success', 'data': llm_service.coalescing_stats()}
+
 @router.post('/test-rag')
 async def test_rag(query: str = '头痛发热怎么办？'):
     """测试RAG功能"""
     try:
-        result = llm_service.chat_with_rag(
+        result = await llm_service.achat_with_rag(
             message=query,
             conversation_history=[],
             session_id='test'
@@ -153,7 +256,9 @@ async def test_rag(query: str = '头痛发热怎么办？'):
             'status': 'success',
             'query': query,
             'response': result['response'],
-            'sources': result['sources']
+            'sources': result['sources'],
+            'retrieval': result['retrieval'],
+            'prompt_tokens': result['prompt_tokens']
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
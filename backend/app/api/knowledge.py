@@ -1,20 +1,21 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from typing import Optional
+from typing import Optional, Tuple
 import os
 import shutil
+import asyncio
 import uuid
 from datetime import datetime
+from app.core.config import settings
 from app.services.rag_service import rag_service
-from app.services.document_parser import DocumentParser
+from app.services.ingest_service import ingest_service, extract_archive
 
 router = APIRouter(tags=["knowledge"])
-parser = DocumentParser()
 
 @router.post("/categories")
 async def create_category(name: str = Form(...), creator: str = Form(default="admin")):
     """创建知识库类别"""
     try:
-        category = rag_service.create_category(name, creator)
+        category = await asyncio.to_thread(rag_service.create_category, name, creator)
         return {
             "status": "success",
             "message": f"✅ 类别「{name}」创建成功！",
@@ -27,7 +28,7 @@ async def create_category(name: str = Form(...), creator: str = Form(default="ad
 async def list_categories():
     """获取所有知识库类别"""
     try:
-        categories = rag_service.list_categories()
+        categories = await asyncio.to_thread(rag_service.list_categories)
         return {
             "status": "success",
             "data": categories
@@ -38,7 +39,7 @@ async def list_categories():
 @router.delete("/categories/{category_id}")
 async def delete_category(category_id: str):
     try:
-        rag_service.delete_category(category_id)
+        await asyncio.to_thread(rag_service.delete_category, category_id)
         return {
             "status": "success",
             "message": "✅ 类别已删除"
@@ -49,79 +50,155 @@ async def delete_category(category_id: str):
 @router.put("/categories/{category_id}")
 async def rename_category(category_id: str, name: str = Form(...)):
     try:
-        for cat in rag_service.categories:
-            if cat['id'] == category_id:
-                cat['name'] = name
-                rag_service._save_data()
-                return {
-                    "status": "success",
-                    "message": "✅ 类别重命名成功"
-                }
+        if await asyncio.to_thread(rag_service.rename_category, category_id, name):
+            return {
+                "status": "success",
+                "message": "✅ 类别重命名成功"
+            }
         raise HTTPException(status_code=404, detail="类别不存在")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+async def _spool_upload(file: UploadFile, max_size: int = settings.MAX_FILE_SIZE) -> Tuple[str, str, int]:
+    """分块写入上传目录并检查大小上限，返回(保存的文件名, 路径, 字节数)
+
+    保存的文件名带随机后缀，同一秒内上传同名文件不会互相覆盖；显示用的文件名仍为原文件名。
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    safe_filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{os.path.basename(file.filename or 'unnamed')}"
+    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    file_path = os.path.join(settings.UPLOAD_DIR, safe_filename)
+    size = 0
+    # 独占创建，即使重名也不会覆盖其他上传（或排队任务）的文件
+    f = open(file_path, "xb")
+    try:
+        with f:
+            while True:
+                block = await file.read(settings.UPLOAD_CHUNK_SIZE)
+                if not block:
+                    break
+                size += len(block)
+                if size > max_size:
+                    raise HTTPException(status_code=413, detail=f"文件超过大小限制（{max_size} 字节）")
+                await asyncio.to_thread(f.write, block)
+    except BaseException:
+        os.remove(file_path)
+        raise
+    return safe_filename, file_path, size
+
 @router.post("/upload")
 async def upload_document(
     file: UploadFile = File(...),
     category_id: str = Form(...),
     creator: str = Form(default="admin")
 ):
+    """上传文档：保存后立即返回任务id，解析和入库在后台进行"""
     try:
-        # 读取文件内容
-        content = await file.read()
-
-        # 保存文件
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_filename = f"{timestamp}_{file.filename}"
-        upload_dir = "./data/uploads"
-        os.makedirs(upload_dir, exist_ok=True)
-        file_path = os.path.join(upload_dir, safe_filename)
-
-        with open(file_path, "wb") as f:
-            f.write(content)
-
-        # 解析文档
-        parse_result = parser.parse(file_path)
-        text_content = parse_result['content']
-
-        # 添加到知识库
-        doc = rag_service.add_document(
-            content=text_content,
+        safe_filename, file_path, size = await _spool_upload(file)
+        job = ingest_service.submit(
+            file_path=file_path,
             filename=safe_filename,
+            original_filename=file.filename,
             file_type=file.filename.split('.')[-1] if '.' in file.filename else 'unknown',
-            file_size=len(content),
+            file_size=size,
             category_id=category_id,
             creator=creator
         )
-
         return {
             "status": "success",
-            "message": f"✅ 上传成功！\n\n文件：{file.filename}\n类型：{doc['type']}\n大小：{len(content)} 字节\n知识块：{doc['chunk_count']} 个",
-            "data": doc
+            "message": f"✅ 上传成功，正在后台解析\n\n文件：{file.filename}\n大小：{size} 字节",
+            "data": job
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"上传失败：{str(e)}")
 
+@router.post("/import")
+async def import_archive(
+    file: UploadFile = File(...),
+    category_id: str = Form(...),
+    creator: str = Form(default="admin")
+):
+    """批量导入zip/tar归档：并行解析，分批提交，返回逐文件结果"""
+    safe_filename, archive_path, size = await _spool_upload(file, settings.MAX_ARCHIVE_SIZE)
+    extract_dir = os.path.splitext(archive_path)[0] + "_files"
+    try:
+        files = await asyncio.to_thread(extract_archive, archive_path, extract_dir)
+        report = await ingest_service.import_files(files, category_id, creator)
+        return {
+            "status": "success",
+            "message": f"✅ 批量导入完成\n\n成功：{report['succeeded']} 个\n失败：{report['failed']} 个",
+            "data": report
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"批量导入失败：{str(e)}")
+    finally:
+        # 内容已写入知识库，归档及解压文件不再保留
+        os.remove(archive_path)
+        shutil.rmtree(extract_dir, ignore_errors=True)
+
+@router.get("/jobs")
+async def list_ingest_jobs(status: Optional[str] = None, limit: int = 50):
+    """列出文档入库任务（按创建时间倒序）"""
+    return {
+        "status": "success",
+        "data": ingest_service.list_jobs(status, limit)
+    }
+
+@router.get("/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    """查询文档入库任务状态"""
+    job = ingest_service.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return {
+        "status": "success",
+        "data": job
+    }
+
+@router.post("/jobs/{job_id}/retry")
+async def retry_ingest_job(job_id: str):
+    """重新执行失败的入库任务"""
+    job = ingest_service.retry(job_id)
+    if not job:
+        raise HTTPException(status_code=400, detail="任务不存在或未失败")
+    return {
+        "status": "success",
+        "message": "✅ 已重新加入入库队列",
+        "data": job
+    }
+
 @router.get("/documents")
 async def list_documents(
     category_id: Optional[str] = None,
     page: int = 1,
     page_size: int = 10,
-    status: Optional[str] = None
+    status: Optional[str] = None,
+    sort: str = "created_at",
+    order: str = "asc"
 ):
-    """分页获取文档列表"""
+    """分页获取文档列表，可按created_at/size/name排序"""
     try:
-        result = rag_service.list_documents(
+        result = await asyncio.to_thread(
+            rag_service.list_documents,
             category_id=category_id,
             page=page,
             page_size=page_size,
-            status=status
+            status=status,
+            sort=sort,
+            order=order
         )
         return {
             "status": "success",
             "data": result
         }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -129,7 +206,7 @@ async def list_documents(
 async def delete_document(doc_id: str):
     """删除文档"""
     try:
-        rag_service.delete_document(doc_id)
+        await asyncio.to_thread(rag_service.delete_document, doc_id)
         return {
             "status": "success",
             "message": "✅ 文档已删除"
@@ -141,7 +218,7 @@ async def delete_document(doc_id: str):
 async def disable_document(doc_id: str):
     """禁用文档"""
     try:
-        if rag_service.disable_document(doc_id):
+        if await asyncio.to_thread(rag_service.disable_document, doc_id):
             return {
                 "status": "success",
                 "message": "✅ 文档已禁用"
@@ -154,7 +231,7 @@ async def disable_document(doc_id: str):
 async def enable_document(doc_id: str):
     """启用文档"""
     try:
-        if rag_service.enable_document(doc_id):
+        if await asyncio.to_thread(rag_service.enable_document, doc_id):
             return {
                 "status": "success",
                 "message": "✅ 文档已启用"
@@ -167,7 +244,7 @@ async def enable_document(doc_id: str):
 async def rename_document(doc_id: str, new_name: str = Form(...)):
     """重命名文档"""
     try:
-        if rag_service.rename_document(doc_id, new_name):
+        if await asyncio.to_thread(rag_service.rename_document, doc_id, new_name):
             return {
                 "status": "success",
                 "message": "✅ 文档已重命名"
@@ -179,7 +256,7 @@ async def rename_document(doc_id: str, new_name: str = Form(...)):
 @router.put("/documents/{doc_id}/migrate")
 async def migrate_document(doc_id: str, new_category_id: str = Form(...)):
     try:
-        if rag_service.migrate_document(doc_id, new_category_id):
+        if await asyncio.to_thread(rag_service.migrate_document, doc_id, new_category_id):
             return {
                 "status": "success",
                 "message": "✅ 文档已迁移"
@@ -191,45 +268,43 @@ async def migrate_document(doc_id: str, new_category_id: str = Form(...)):
 @router.post("/documents/{doc_id}/copy")
 async def copy_document(doc_id: str, target_category_id: str = Form(...)):
     try:
-        import copy
-        for doc in rag_service.documents:
-            if doc['id'] == doc_id:
-                new_doc = copy.deepcopy(doc)
-                new_doc['id'] = str(uuid.uuid4())
-                new_doc['category_id'] = target_category_id
-                new_doc['created_at'] = datetime.now().isoformat()
-                new_doc['updated_at'] = datetime.now().isoformat()
-                rag_service.documents.append(new_doc)
-                rag_service._save_data()
-                return {
-                    "status": "success",
-                    "message": "✅ 文档已复制"
-                }
+        if await asyncio.to_thread(rag_service.copy_document, doc_id, target_category_id):
+            return {
+                "status": "success",
+                "message": "✅ 文档已复制"
+            }
         raise HTTPException(status_code=404, detail="文档不存在")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/documents/{doc_id}/reupload")
 async def reupload_document(doc_id: str, file: UploadFile = File(...)):
-    """重新上传文档内容"""
+    """重新上传文档内容：与上传相同，在后台进程中解析和切分"""
+    if not await asyncio.to_thread(rag_service.get_document, doc_id):
+        raise HTTPException(status_code=404, detail="文档不存在")
+    safe_filename, file_path, size = await _spool_upload(file)
     try:
-        content = await file.read()
-        text_content = parser.parse(content, file.filename)
-
-        if rag_service.update_document_content(doc_id, text_content):
+        parsed = await ingest_service.parse_and_chunk(file_path)
+        if await asyncio.to_thread(rag_service.update_document_content, doc_id, parsed['content'], parsed['chunks'], size):
             return {
                 "status": "success",
                 "message": "✅ 文档内容已更新"
             }
         raise HTTPException(status_code=404, detail="文档不存在")
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        os.remove(file_path)
 
 @router.get("/stats")
 async def get_stats():
     """获取知识库统计信息"""
     try:
-        stats = rag_service.get_stats()
+        stats = await asyncio.to_thread(rag_service.get_stats)
         return {
             "status": "success",
             "data": stats
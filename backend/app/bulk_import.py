@@ -0,0 +1,73 @@
+"""批量导入命令行工具，在backend目录下运行：
+
+    python -m app.bulk_import <目录|zip|tar|文件>... --category <类别id或名称> [--create] [--creator admin]
+
+直接写入知识库数据库；运行中的服务无需重启，各worker在下一次读取时按变更记录加载新文档。
+"""
+from typing import List, Tuple
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from app.services.rag_service import rag_service
+from app.services.ingest_service import ingest_service, extract_archive
+
+def _collect(paths: List[str], temp_dir: str) -> List[Tuple[str, str]]:
+    """展开目录和归档为[(文件路径, 显示文件名)]"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for name in sorted(names):
+                    if not name.startswith('.'):
+                        full = os.path.join(root, name)
+                        files.append((full, os.path.relpath(full, path)))
+        elif path.lower().endswith(('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')):
+            files.extend(extract_archive(path, os.path.join(temp_dir, str(len(files)))))
+        elif os.path.isfile(path):
+            files.append((path, os.path.basename(path)))
+        else:
+            print(f"跳过不存在的路径: {path}", file=sys.stderr)
+    return files
+
+def _resolve_category(value: str, create: bool, creator: str) -> str:
+    for category in rag_service.categories:
+        if value in (category['id'], category['name']):
+            return category['id']
+    if not create:
+        raise SystemExit(f"类别不存在: {value}（使用--create按名称新建）")
+    return rag_service.create_category(value, creator)['id']
+
+async def _import(files: List[Tuple[str, str]], category_id: str, creator: str):
+    try:
+        return await ingest_service.import_files(files, category_id, creator)
+    finally:
+        await ingest_service.shutdown()
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='批量导入文档到知识库')
+    parser.add_argument('paths', nargs='+', help='目录、zip/tar归档或单个文件')
+    parser.add_argument('--category', required=True, help='目标类别id或名称')
+    parser.add_argument('--create', action='store_true', help='类别不存在时按名称新建')
+    parser.add_argument('--creator', default='admin')
+    args = parser.parse_args(argv)
+
+    category_id = _resolve_category(args.category, args.create, args.creator)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        files = _collect(args.paths, temp_dir)
+        if not files:
+            print('没有可导入的文件')
+            return 1
+        report = asyncio.run(_import(files, category_id, args.creator))
+    for result in report['files']:
+        if result['status'] == 'done':
+            print(f"✅ {result['filename']}  知识块: {result['chunk_count']}")
+        else:
+            print(f"❌ {result['filename']}  {result['error']}")
+    print(f"共 {report['total']} 个文件，成功 {report['succeeded']} 个，失败 {report['failed']} 个")
+    return 0 if report['failed'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
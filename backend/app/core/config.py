@@ -14,6 +14,18 @@ class Settings(BaseSettings):
     # 智谱AI配置
     ZHIPUAI_API_KEY: Optional[str] = None
     ZHIPUAI_MODEL: str = 'glm-4-flash'
+    LLM_MAX_CONCURRENCY: int = 8
+    LLM_TIMEOUT: float = 60.0
+    # 并发的相同提示词合并为一次上游调用（含流式），各请求共享同一回复
+    LLM_SINGLE_FLIGHT: bool = True
+    
+    # 问诊回复缓存
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_TTL: int = 3600
+    RESPONSE_CACHE_MAX_ENTRIES: int = 1000
+    RESPONSE_CACHE_MAX_BYTES: int = 16 * 1024 * 1024
+    # 大于0时启用消息向量相似度匹配（需要vector/hybrid检索模式）
+    RESPONSE_CACHE_SIMILARITY: float = 0.0
     
     # 向量数据库配置
     CHROMA_PERSIST_DIR: str = './data/chroma'
@@ -22,11 +34,59 @@ class Settings(BaseSettings):
     # 文档配置
     UPLOAD_DIR: str = './data/uploads'
     MAX_FILE_SIZE: int = 10 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+    # 批量导入的zip/tar归档大小上限
+    MAX_ARCHIVE_SIZE: int = 500 * 1024 * 1024
+    # 归档解压后的总大小和文件数上限（防止压缩炸弹）
+    MAX_ARCHIVE_UNCOMPRESSED_SIZE: int = 2 * 1024 * 1024 * 1024
+    MAX_ARCHIVE_FILES: int = 2000
+    # 批量导入每个事务提交的文档数：分批在线程中提交，批与批之间其他写入可以进行
+    IMPORT_COMMIT_BATCH: int = 32
+    # 文档解析进程数，默认保留一个核心给接口进程
+    INGEST_WORKERS: int = max(1, (os.cpu_count() or 2) - 1)
+    # 入库任务失败后的最大尝试次数及重试间隔（秒，按次数指数退避）
+    INGEST_MAX_ATTEMPTS: int = 3
+    INGEST_RETRY_DELAY: float = 2.0
+    # PDF按页段并行提取时每个任务的页数
+    PDF_PAGES_PER_TASK: int = 20
     
     # RAG配置
     CHUNK_SIZE: int = 500
     CHUNK_OVERLAP: int = 50
-    TOP_K_RESULTS: int = 3
+    # 知识块切分方式：structured（按标题/段落/条文/句子）或 fixed（固定长度）
+    CHUNKER: str = 'structured'
+    TOP_K_RESULTS: int = 5
+    BM25_K1: float = 1.5
+    BM25_B: float = 0.75
+    # 检索模式：keyword(BM25) / vector(向量检索) / hybrid(两路并行 + RRF融合)
+    RETRIEVAL_MODE: str = 'keyword'
+    RETRIEVAL_CANDIDATES: int = 20
+    RETRIEVAL_CONTEXT_CHARS: int = 3000
+    RRF_K: int = 60
+    # 提示词token预算（本地估算，含系统提示词），扣除固定部分后按比例分给知识库内容，其余给对话历史
+    PROMPT_TOKEN_BUDGET: int = 4000
+    PROMPT_KB_SHARE: float = 0.6
+    # 对话历史保留原文的最近轮数，更早的压缩为摘要
+    PROMPT_RECENT_TURNS: int = 8
+    # 检索结果LRU缓存条目数，0为关闭
+    RETRIEVAL_CACHE_SIZE: int = 1024
+    # 检索微批：窗口（毫秒）内到达的检索合并执行，相同查询只检索一次、查询向量批量嵌入；0为关闭
+    RETRIEVAL_BATCH_WINDOW_MS: float = 5.0
+    RETRIEVAL_BATCH_MAX: int = 16
+    # 嵌入配置：local(本地特征哈希) / zhipuai
+    EMBEDDING_PROVIDER: str = 'local'
+    EMBEDDING_MODEL: str = 'embedding-2'
+    EMBEDDING_DIM: int = 512
+    
+    # 症状词表：词表文件（不存在时使用内置关键词），另从该名称的知识库类别中加载词条（为空则不加载）
+    SYMPTOM_LEXICON_FILE: str = './data/symptom_lexicon.txt'
+    SYMPTOM_KEYWORDS: list = ['头痛', '身痛', '发热', '怕冷', '恶寒', '无汗', '有汗', '酸痛']
+    SYMPTOM_LEXICON_CATEGORY: str = '症状词表'
+    # 否定词（词表中“否定词:”行可追加），否定词与症状之间最多相隔的字数
+    SYMPTOM_NEGATIONS: list = ['不', '没', '没有', '无', '未', '并不', '从不']
+    SYMPTOM_NEGATION_WINDOW: int = 2
+    # 检查词表文件和知识库词表类别是否变化的间隔（秒）
+    SYMPTOM_LEXICON_RELOAD_INTERVAL: float = 2.0
     
     class Config:
         env_file = '.env'
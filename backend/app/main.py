@@ -1,13 +1,27 @@
+from contextlib import asynccontextmanager
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import chat, knowledge
 from app.core.config import settings
+from app.services.ingest_service import ingest_service
+from app.services.symptom_lexicon import symptom_lexicon
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 启动入库调度并恢复未完成的任务
+    await ingest_service.start()
+    # 首次加载症状词表需要读取知识库，放到线程池中完成，之后的更新检查在后台线程进行
+    await asyncio.to_thread(symptom_lexicon.current)
+    yield
+    await ingest_service.shutdown()
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
     version=settings.VERSION,
     openapi_url=f'{settings.API_V1_STR}/openapi.json',
-    description='基于RAG的中医诊疗助手系统'
+    description='基于RAG的中医诊疗助手系统',
+    lifespan=lifespan
 )
 
 # CORS配置
@@ -26,6 +40,12 @@ app.include_router(
     tags=['chat']
 )
 
+app.include_router(
+    chat.ws_router,
+    prefix='/ws',
+    tags=['chat']
+)
+
 app.include_router(
     knowledge.router,
     prefix=f'{settings.API_V1_STR}/knowledge',
@@ -0,0 +1,62 @@
+from typing import Iterable, List, Optional, Tuple
+import mmap
+import os
+import threading
+
+class ChunkBlob:
+    """知识块正文文件：UTF-8正文首尾相接追加写入，按(offset, length)寻址，内存映射只读
+
+    只追加不修改，已删除正文留下的空洞由KnowledgeStore整理时重写到新文件。
+    写入在知识库的SQLite写事务内进行，多进程追加由数据库写锁串行化。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return os.fstat(self._fd).st_size
+
+    def append(self, texts: Iterable[str]) -> List[Tuple[int, int]]:
+        """追加正文并落盘，返回各自的(offset, length)"""
+        with self._lock:
+            offset = self.size
+            addresses, parts = [], []
+            for text in texts:
+                data = text.encode('utf-8')
+                addresses.append((offset, len(data)))
+                parts.append(data)
+                offset += len(data)
+            if parts:
+                data = memoryview(b''.join(parts))
+                while data:
+                    data = data[os.write(self._fd, data):]
+                os.fsync(self._fd)
+            return addresses
+
+    def read(self, offset: int, length: int) -> str:
+        if not length:
+            return ''
+        view = self._map
+        if view is None or offset + length > len(view):
+            view = self._remap()
+        return view[offset:offset + length].decode('utf-8')
+
+    def _remap(self) -> mmap.mmap:
+        # 旧映射可能仍被其他线程读取，不主动关闭，无引用后自动释放
+        with self._lock:
+            if self.size:
+                self._map = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+            return self._map
+
+    def close(self):
+        if self._fd is not None:
+            self._map = None
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
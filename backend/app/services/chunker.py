@@ -0,0 +1,145 @@
+from typing import Dict, List, Optional, Tuple
+from bisect import bisect_right
+import hashlib
+import re
+import unicodedata
+from app.core.config import settings
+
+# 标题：Markdown标题、“第X章/篇/卷/节/回”
+_HEADING_RE = re.compile(r'^[ \t]*(?:#{1,6}[ \t]|第[一二三四五六七八九十百千零〇\d]+[章节篇卷回部])', re.M)
+# 条文编号：“第X条”、“一、”、“（一）”、“12.”
+_CLAUSE_RE = re.compile(r'^[ \t]*(?:第[一二三四五六七八九十百千零〇\d]+条|[一二三四五六七八九十百]+[、．.]|[（(][一二三四五六七八九十百\d]+[)）]|\d+[、．.)）])', re.M)
+_PARAGRAPH_RE = re.compile(r'\n[ \t]*\n\s*')
+# 句子：以中文/英文句末标点（含其后的引号、括号）或换行结尾
+_SENTENCE_RE = re.compile(r'[^。！？；!?;\n]*[。！？；!?;]+[」』”’）)]*|[^。！？；!?;\n]+|\n')
+
+Span = Tuple[int, int]
+
+def chunk_hash(text: str) -> str:
+    """知识块id：归一化（NFKC、合并空白）后正文的哈希，内容相同的知识块共享同一id和正文"""
+    normalized = ' '.join(unicodedata.normalize('NFKC', text).split())
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest()
+
+def _assign_pages(chunks: List[Dict], pages: Optional[List[List[int]]]):
+    """按知识块起始位置记录所在页码，pages=[[offset, 页码], ...]"""
+    if not pages:
+        return
+    offsets = [offset for offset, _ in pages]
+    for chunk in chunks:
+        chunk['page'] = pages[max(bisect_right(offsets, chunk['start']) - 1, 0)][1]
+
+def _make_chunks(text: str, spans: List[Span], pages: Optional[List[List[int]]]) -> List[Dict]:
+    chunks = [
+        {'id': chunk_hash(text[start:end]), 'content': text[start:end], 'index': index, 'start': start, 'end': end}
+        for index, (start, end) in enumerate(spans)
+    ]
+    _assign_pages(chunks, pages)
+    return chunks
+
+def _strip(text: str, start: int, end: int) -> Span:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+class FixedChunker:
+    """固定长度滑动窗口切分"""
+
+    name = 'fixed'
+
+    def __init__(self, chunk_size: int = 500, overlap: int = 0):
+        self.chunk_size = chunk_size
+        self.overlap = min(overlap, chunk_size - 1)
+
+    def chunk(self, text: str, pages: Optional[List[List[int]]] = None) -> List[Dict]:
+        spans = []
+        start = 0
+        while start < len(text):
+            end = min(start + self.chunk_size, len(text))
+            span = _strip(text, start, end)
+            if span[0] < span[1]:
+                spans.append(span)
+            if end == len(text):
+                break
+            start = end - self.overlap
+        return _make_chunks(text, spans, pages)
+
+class StructuredChunker:
+    """按文档结构切分：标题、段落、条文编号处断开，过长的段落再按句末标点切分，
+    相邻的短条文合并到chunk_size以内。
+
+    重叠按整句计算：新知识块以上一块末尾不超过overlap字的完整句子开头，
+    不会从句子中间开始；标题处不重叠。每个知识块记录其在正文中的[start, end)。
+    """
+
+    name = 'structured'
+
+    def __init__(self, chunk_size: int = 500, overlap: int = 0):
+        self.chunk_size = chunk_size
+        self.overlap = min(overlap, chunk_size - 1)
+
+    def chunk(self, text: str, pages: Optional[List[List[int]]] = None) -> List[Dict]:
+        return _make_chunks(text, self._pack(self._units(text)), pages)
+
+    def _blocks(self, text: str) -> List[Tuple[int, int, bool]]:
+        """切成结构块 (start, end, 是否以标题开头)"""
+        boundaries = {0: False}
+        for match in _PARAGRAPH_RE.finditer(text):
+            boundaries.setdefault(match.end(), False)
+        for match in _CLAUSE_RE.finditer(text):
+            boundaries.setdefault(match.start(), False)
+        for match in _HEADING_RE.finditer(text):
+            boundaries[match.start()] = True
+        starts = sorted(boundaries)
+        return [(start, end, boundaries[start]) for start, end in zip(starts, starts[1:] + [len(text)])]
+
+    def _units(self, text: str) -> List[Tuple[int, int, bool]]:
+        """不可再分的切分单元：短结构块整体，长结构块拆成句子，超长句子按长度硬切"""
+        units = []
+        for block_start, block_end, heading in self._blocks(text):
+            start, end = _strip(text, block_start, block_end)
+            if start >= end:
+                continue
+            if end - start <= self.chunk_size:
+                units.append((start, end, heading))
+                continue
+            first = True
+            for match in _SENTENCE_RE.finditer(text, start, end):
+                s_start, s_end = _strip(text, match.start(), match.end())
+                for piece in range(s_start, s_end, self.chunk_size):
+                    units.append((piece, min(piece + self.chunk_size, s_end), heading and first))
+                    first = False
+        return units
+
+    def _pack(self, units: List[Tuple[int, int, bool]]) -> List[Span]:
+        spans: List[Span] = []
+        current: List[Span] = []
+        for start, end, heading in units:
+            if current and (heading or end - current[0][0] > self.chunk_size):
+                spans.append((current[0][0], current[-1][1]))
+                current = [] if heading else self._overlap(current, end)
+            current.append((start, end))
+        if current:
+            spans.append((current[0][0], current[-1][1]))
+        return spans
+
+    def _overlap(self, previous: List[Span], next_end: int) -> List[Span]:
+        """上一块末尾不超过overlap字、且与下一单元合计不超过chunk_size的完整单元"""
+        if self.overlap <= 0:
+            return []
+        last_end = previous[-1][1]
+        tail = []
+        for span in reversed(previous[1:]):
+            if last_end - span[0] > self.overlap or next_end - span[0] > self.chunk_size:
+                break
+            tail.insert(0, span)
+        return tail
+
+def create_chunker(name: Optional[str] = None, chunk_size: Optional[int] = None, overlap: Optional[int] = None):
+    """按配置创建切分器：CHUNKER=structured/fixed"""
+    chunk_size = chunk_size or settings.CHUNK_SIZE
+    overlap = settings.CHUNK_OVERLAP if overlap is None else overlap
+    if (name or settings.CHUNKER) == 'fixed':
+        return FixedChunker(chunk_size, overlap)
+    return StructuredChunker(chunk_size, overlap)
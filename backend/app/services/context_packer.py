@@ -0,0 +1,142 @@
+from typing import Dict, List, Tuple
+import math
+import re
+
+# 中日韩字符（含全角标点）每字计1个token，连续的字母数字约每4个字符1个token，其余符号各计1个
+_TOKEN_RE = re.compile(r'[　-〿㐀-鿿豈-﫿＀-￯]|[A-Za-z0-9_]+|\S')
+_SENTENCE_END_RE = re.compile(r'[。！？；!?;\n]')
+
+def count_tokens(text: str) -> int:
+    """本地估算token数（不调用接口），对中文偏保守"""
+    total = 0
+    for match in _TOKEN_RE.finditer(text):
+        piece = match.group()
+        total += math.ceil(len(piece) / 4) if piece[0].isascii() and piece[0].isalnum() else 1
+    return total
+
+def truncate_tokens(text: str, budget: int, keep_end: bool = False) -> str:
+    """截断到预算以内，尽量停在句末；keep_end=True时保留末尾"""
+    if budget <= 0:
+        return ''
+    if count_tokens(text) <= budget:
+        return text
+    # token数不小于字符数的1/4，先按字符粗截再逐步收缩
+    length = min(len(text), budget * 4)
+    while length and count_tokens(text[-length:] if keep_end else text[:length]) > budget:
+        length = max(length - max(length // 8, 1), 0)
+    if keep_end:
+        return text[-length:] if length else ''
+    cut = text[:length]
+    ends = [match.end() for match in _SENTENCE_END_RE.finditer(cut)]
+    if ends and ends[-1] >= length // 2:
+        cut = cut[:ends[-1]]
+    return cut
+
+class ContextPacker:
+    """按token预算组装问诊提示词中的知识库内容和对话历史
+
+    系统提示词、指令模板和当前问题为固定部分，先从预算中扣除；
+    剩余预算按kb_share分给知识库内容，其余给对话历史，一方用不完的让给另一方。
+    知识块按检索排名放入，去掉与已放入内容重复或首尾重叠的部分；
+    对话历史保留最近的若干轮原文，更早的轮次压缩为患者原话摘要。
+    """
+
+    def __init__(self, budget: int, kb_share: float = 0.6, recent_turns: int = 8, max_overlap: int = 200, summary_chars: int = 40):
+        self.budget = budget
+        self.kb_share = kb_share
+        self.recent_turns = recent_turns
+        self.max_overlap = max_overlap
+        self.summary_chars = summary_chars
+
+    def pack(self, fixed_parts: Dict[str, str], chunks: List[str], history: List[Dict]) -> Dict:
+        """返回 {'knowledge': 知识库文本, 'history': 对话历史文本, 'used_chunks': 放入的知识块序号, 'tokens': 各部分token数}"""
+        tokens = {name: count_tokens(text) for name, text in fixed_parts.items()}
+        available = max(self.budget - sum(tokens.values()), 0)
+        pieces = self._dedupe(chunks)
+        history_lines, summarized = self._history_lines(history)
+        # 每段另计1个换行
+        history_needed = sum(count_tokens(line) + 1 for line in history_lines)
+        # 对话历史用不完的预算让给知识库，知识库实际未用完的再让给对话历史
+        kb_budget = max(int(available * self.kb_share), available - history_needed)
+        knowledge, used = self._pack_chunks(pieces, kb_budget)
+        tokens['knowledge'] = count_tokens(knowledge)
+        history_text = self._pack_history(history_lines, available - tokens['knowledge'] - len(used))
+        tokens['history'] = count_tokens(history_text)
+        tokens['total'] = sum(tokens.values())
+        return {
+            'knowledge': knowledge,
+            'history': history_text,
+            'used_chunks': used,
+            'tokens': dict(tokens, budget=self.budget, dropped_chunks=len(chunks) - len(used), summarized_turns=summarized)
+        }
+
+    def _dedupe(self, chunks: List[str]) -> List[Tuple[int, str]]:
+        """去掉被已放入内容包含的知识块，裁掉与已放入内容首尾重叠的部分（切分重叠造成）"""
+        kept: List[Tuple[int, str]] = []
+        for position, text in enumerate(chunks):
+            text = text.strip()
+            if not text or any(text in other for _, other in kept):
+                continue
+            for _, other in kept:
+                text = text[self._overlap(other, text):]
+                tail = self._overlap(text, other)
+                if tail:
+                    text = text[:-tail]
+            text = text.strip()
+            if text:
+                kept.append((position, text))
+        return kept
+
+    def _overlap(self, left: str, right: str) -> int:
+        """left的后缀与right的前缀重合的最大长度"""
+        for size in range(min(len(left), len(right), self.max_overlap), 0, -1):
+            if left.endswith(right[:size]):
+                return size
+        return 0
+
+    @staticmethod
+    def _pack_chunks(pieces: List[Tuple[int, str]], budget: int) -> Tuple[str, List[int]]:
+        parts, used = [], []
+        for position, text in pieces:
+            cost = count_tokens(text) + 1
+            if cost > budget:
+                # 排名第一的知识块超出预算时截断放入，其余直接跳过
+                if not parts:
+                    text = truncate_tokens(text, budget - 1)
+                    if text:
+                        parts.append(text)
+                        used.append(position)
+                break
+            parts.append(text)
+            used.append(position)
+            budget -= cost
+        return '\n'.join(parts), used
+
+    def _history_lines(self, history: List[Dict]) -> Tuple[List[str], int]:
+        """最近recent_turns轮保留原文，更早的轮次只保留患者原话的开头并合并为一行摘要"""
+        lines = []
+        split = max(len(history) - self.recent_turns, 0)
+        older, recent = history[:split], history[split:]
+        said = [item.get('content', '').strip()[:self.summary_chars] for item in older if item.get('role') == 'user']
+        said = [text for text in said if text]
+        if said:
+            lines.append(f"（更早的对话摘要）您提到：{'；'.join(said)}")
+        for item in recent:
+            role = "您" if item.get('role') == 'user' else "小艾"
+            lines.append(f"{role}：{item.get('content', '')}")
+        return lines, len(older)
+
+    @staticmethod
+    def _pack_history(lines: List[str], budget: int) -> str:
+        """从最近一轮往前放，放不下的那一轮截去开头"""
+        kept = []
+        for line in reversed(lines):
+            cost = count_tokens(line) + 1
+            if cost > budget:
+                line = truncate_tokens(line, budget - 1, keep_end=True)
+                if line:
+                    kept.append(line)
+                break
+            kept.append(line)
+            budget -= cost
+        return '\n'.join(reversed(kept))
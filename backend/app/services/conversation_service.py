@@ -1,29 +1,67 @@
 from typing import List, Dict, Optional
+from collections import OrderedDict
 import os
-import json
 from datetime import datetime
 import uuid
+import json
+import base64
+from app.services.conversation_store import ConversationStore
+from app.services.symptom_lexicon import symptom_lexicon
 
 class ConversationService:
-    """对话历史管理服务"""
+    """对话历史管理服务
+
+    conversations: id -> 对话 的OrderedDict，按updated_at从旧到新排列，
+    写入时move_to_end即可维持最近优先顺序。
+    每个对话的symptom_state记录已收集的症状、已扫描的消息数和所用词表版本，
+    新消息到来时只扫描新增部分，词表更新后重新扫描一次。
+    多个worker共用同一数据库：读写前_sync()按变更记录重新加载其他worker修改过的对话，
+    修改在写事务内先同步再写入。
+    """
     
     def __init__(self):
-        self.persist_file = './data/conversations.json'
+        self.legacy_file = './data/conversations.json'
         os.makedirs('./data', exist_ok=True)
+        self.store = ConversationStore('./data/conversations.db')
         self._load_data()
     
     def _load_data(self):
-        if os.path.exists(self.persist_file):
-            with open(self.persist_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                self.conversations = data.get('conversations', [])
-        else:
-            self.conversations = []
-            self._save_data()
-    
-    def _save_data(self):
-        with open(self.persist_file, 'w', encoding='utf-8') as f:
-            json.dump({'conversations': self.conversations}, f, ensure_ascii=False, indent=2)
+        if self.store.import_json(self.legacy_file):
+            print(f"已导入旧版对话记录: {self.legacy_file}")
+        self._reload()
+    
+    def _reload(self):
+        self._data_version = self.store.data_version()
+        with self.store.transaction('DEFERRED'):
+            self._change_seq = self.store.last_change()
+            self.conversations: Dict[str, Dict] = OrderedDict((conv['id'], conv) for conv in reversed(self.store.load()))
+    
+    def _sync(self):
+        """其他worker提交过修改时，只重新加载变更记录中的对话"""
+        if self.store.data_version() == self._data_version:
+            return
+        # 事务同时起线程锁的作用，多个线程不会重复加载
+        with self.store.transaction('DEFERRED'):
+            version = self.store.data_version()
+            if version == self._data_version:
+                return
+            changes = self.store.changes_since(self._change_seq)
+            if changes is None:
+                self._reload()
+                return
+            self._change_seq, changed_ids = changes
+            for conv_id in changed_ids:
+                conv = self.store.load_conversation(conv_id)
+                if conv is None:
+                    self.conversations.pop(conv_id, None)
+                else:
+                    self.conversations[conv_id] = conv
+                    self.conversations.move_to_end(conv_id)
+            self._data_version = version
+    
+    def _touch(self, conv: Dict):
+        conv['updated_at'] = datetime.now().isoformat()
+        self.conversations.move_to_end(conv['id'])
     
     def create_conversation(self, title: str = '新对话') -> Dict:
         """创建新对话"""
@@ -34,58 +72,127 @@ class ConversationService:
             'updated_at': datetime.now().isoformat(),
             'messages': []
         }
-        self.conversations.insert(0, conversation)
-        self._save_data()
+        self.store.put_conversation(conversation)
+        self.conversations[conversation['id']] = conversation
         return conversation
     
     def get_conversation(self, conversation_id: str) -> Optional[Dict]:
         """获取对话详情"""
-        for conv in self.conversations:
-            if conv['id'] == conversation_id:
-                return conv
-        return None
+        self._sync()
+        return self.conversations.get(conversation_id)
     
     def list_conversations(self) -> List[Dict]:
-        """获取所有对话列表"""
-        return self.conversations
+        """获取所有对话列表（最近更新在前）"""
+        self._sync()
+        return list(reversed(self.conversations.values()))
+    
+    def list_conversation_page(self, limit: int = 20, cursor: Optional[str] = None, summary: bool = True) -> Dict:
+        """游标分页获取对话列表，summary=True时只返回摘要字段"""
+        before = self._decode_cursor(cursor) if cursor else None
+        self._sync()
+        rows = self.store.list_recent_ids(limit + 1, before)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        items = []
+        for _, conv_id in rows:
+            conv = self.conversations.get(conv_id)
+            if conv:
+                items.append(self._summarize(conv) if summary else conv)
+        next_cursor = self._encode_cursor(rows[-1]) if has_more else None
+        return {'items': items, 'next_cursor': next_cursor}
+    
+    @staticmethod
+    def _summarize(conv: Dict) -> Dict:
+        last_message = conv['messages'][-1]['content'] if conv['messages'] else ''
+        return {
+            'id': conv['id'],
+            'title': conv['title'],
+            'updated_at': conv['updated_at'],
+            'message_count': len(conv['messages']),
+            'last_message': last_message[:50] + ('...' if len(last_message) > 50 else '')
+        }
+    
+    @staticmethod
+    def _encode_cursor(position) -> str:
+        return base64.urlsafe_b64encode(json.dumps(list(position)).encode('utf-8')).decode('ascii')
+    
+    @staticmethod
+    def _decode_cursor(cursor: str):
+        try:
+            updated_at, conv_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        except Exception:
+            raise ValueError('无效的分页游标')
+        return updated_at, conv_id
     
     def delete_conversation(self, conversation_id: str) -> bool:
         """删除对话"""
-        original_len = len(self.conversations)
-        self.conversations = [c for c in self.conversations if c['id'] != conversation_id]
-        self._save_data()
-        return len(self.conversations) < original_len
+        with self.store.transaction():
+            self._sync()
+            if self.conversations.pop(conversation_id, None) is None:
+                return False
+            self.store.delete_conversation(conversation_id)
+        return True
     
     def add_message(self, conversation_id: str, role: str, content: str, sources: List = None) -> Dict:
         """添加消息到对话"""
-        for conv in self.conversations:
-            if conv['id'] == conversation_id:
-                message = {
-                    'role': role,
-                    'content': content,
-                    'timestamp': datetime.now().isoformat(),
-                    'sources': sources or []
-                }
-                conv['messages'].append(message)
-                conv['updated_at'] = datetime.now().isoformat()
-                
-                if len(conv['messages']) == 1 and role == 'user':
-                    conv['title'] = content[:30] + ('...' if len(content) > 30 else '')
-                
-                self.conversations.remove(conv)
-                self.conversations.insert(0, conv)
-                self._save_data()
-                return message
-        return None
+        message = {
+            'role': role,
+            'content': content,
+            'timestamp': datetime.now().isoformat(),
+            'sources': sources or []
+        }
+        # 在写事务内同步，保证追加在其他worker已写入的消息之后
+        with self.store.transaction():
+            self._sync()
+            conv = self.conversations.get(conversation_id)
+            if not conv:
+                return None
+            conv['messages'].append(message)
+            
+            if len(conv['messages']) == 1 and role == 'user':
+                conv['title'] = content[:30] + ('...' if len(content) > 30 else '')
+            
+            self._touch(conv)
+            self.store.append_message(conversation_id, message)
+            self.store.put_conversation(conv)
+            self._update_symptoms(conv)
+        return message
+    
+    def get_symptoms(self, conversation_id: str) -> List[str]:
+        """对话中患者提到的症状，按首次出现顺序"""
+        self._sync()
+        conv = self.conversations.get(conversation_id)
+        if not conv:
+            return []
+        return self._update_symptoms(conv)['symptoms']
+    
+    def _update_symptoms(self, conv: Dict) -> Dict:
+        # 只扫描上次之后新增的消息；旧版对话首次访问或词表更新后整体重扫一次
+        lexicon = symptom_lexicon.current()
+        state = conv.get('symptom_state')
+        if not state or state.get('lexicon') != lexicon.version:
+            state = conv['symptom_state'] = {'symptoms': [], 'scanned': 0, 'lexicon': lexicon.version}
+        if state['scanned'] >= len(conv['messages']):
+            return state
+        symptoms = dict.fromkeys(state['symptoms'])
+        for message in conv['messages'][state['scanned']:]:
+            if message['role'] == 'user':
+                symptoms.update(dict.fromkeys(lexicon.extract(message['content'])))
+        state['symptoms'] = list(symptoms)
+        state['scanned'] = len(conv['messages'])
+        self.store.put_state(conv['id'], state)
+        return state
     
     def update_title(self, conversation_id: str, title: str) -> bool:
         """更新对话标题"""
-        for conv in self.conversations:
-            if conv['id'] == conversation_id:
-                conv['title'] = title
-                conv['updated_at'] = datetime.now().isoformat()
-                self._save_data()
-                return True
-        return False
+        with self.store.transaction():
+            self._sync()
+            conv = self.conversations.get(conversation_id)
+            if not conv:
+                return False
+            conv['title'] = title
+            self._touch(conv)
+            self.store.put_conversation(conv)
+        return True
 
 conversation_service = ConversationService()
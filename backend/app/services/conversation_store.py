@@ -0,0 +1,124 @@
+from typing import Dict, List, Optional, Tuple
+import os
+import json
+from app.services.sqlite_store import SQLiteStore
+
+class ConversationStore(SQLiteStore):
+    """对话持久化：每个对话一行、每条消息一行，追加消息只写一行
+
+    conversation_changes按顺序记录被修改或删除的对话id，其他worker据此只重新加载变化的对话；
+    只保留最近CHANGE_LOG_SIZE条。
+    """
+
+    CHANGE_LOG_SIZE = 10000
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, title TEXT NOT NULL, created_at TEXT NOT NULL, updated_at TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_conversations_recent ON conversations (updated_at, id);
+        CREATE TABLE IF NOT EXISTS messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, conversation_id TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, timestamp TEXT NOT NULL, sources TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, seq);
+        CREATE TABLE IF NOT EXISTS conversation_state (conversation_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS conversation_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, conversation_id TEXT NOT NULL);
+    """
+
+    def import_json(self, json_file: str) -> bool:
+        """首次启动时导入旧版conversations.json"""
+        if not os.path.exists(json_file):
+            return False
+        # 多个worker同时启动时在写事务内检查和导入，只会导入一次
+        with self.transaction():
+            if self.get_meta('json_imported'):
+                return False
+            with open(json_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for conv in data.get('conversations', []):
+                self.put_conversation(conv)
+                for message in conv.get('messages', []):
+                    self.append_message(conv['id'], message)
+            self.set_meta('json_imported', json_file)
+        return True
+
+    def load(self) -> List[Dict]:
+        """读取全部对话（附带消息和症状状态），按updated_at倒序"""
+        conversations = [
+            {'id': conv_id, 'title': title, 'created_at': created_at, 'updated_at': updated_at, 'messages': []}
+            for conv_id, title, created_at, updated_at in self.conn.execute('SELECT id, title, created_at, updated_at FROM conversations ORDER BY updated_at DESC')
+        ]
+        by_id = {conv['id']: conv for conv in conversations}
+        for conv_id, role, content, timestamp, sources in self.conn.execute('SELECT conversation_id, role, content, timestamp, sources FROM messages ORDER BY seq'):
+            if conv_id in by_id:
+                by_id[conv_id]['messages'].append({'role': role, 'content': content, 'timestamp': timestamp, 'sources': json.loads(sources)})
+        for conv_id, data in self.conn.execute('SELECT conversation_id, data FROM conversation_state'):
+            if conv_id in by_id:
+                by_id[conv_id]['symptom_state'] = json.loads(data)
+        return conversations
+
+    def load_conversation(self, conversation_id: str) -> Optional[Dict]:
+        """读取单个对话（附带消息和症状状态），不存在时返回None"""
+        row = self.conn.execute('SELECT id, title, created_at, updated_at FROM conversations WHERE id = ?', (conversation_id,)).fetchone()
+        if not row:
+            return None
+        conv = {'id': row[0], 'title': row[1], 'created_at': row[2], 'updated_at': row[3], 'messages': [
+            {'role': role, 'content': content, 'timestamp': timestamp, 'sources': json.loads(sources)}
+            for role, content, timestamp, sources in self.conn.execute('SELECT role, content, timestamp, sources FROM messages WHERE conversation_id = ? ORDER BY seq', (conversation_id,))
+        ]}
+        state = self.conn.execute('SELECT data FROM conversation_state WHERE conversation_id = ?', (conversation_id,)).fetchone()
+        if state:
+            conv['symptom_state'] = json.loads(state[0])
+        return conv
+
+    def last_change(self) -> int:
+        return self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM conversation_changes').fetchone()[0]
+
+    def changes_since(self, seq: int) -> Optional[Tuple[int, List[str]]]:
+        """seq之后被修改或删除的对话id（按最后一次修改的顺序）和最新序号；
+        所需记录已被清理时返回None，调用方应整体重新加载"""
+        oldest = self.conn.execute('SELECT MIN(seq) FROM conversation_changes').fetchone()[0]
+        if oldest is not None and oldest > seq + 1:
+            return None
+        rows = self.conn.execute('SELECT conversation_id, MAX(seq) AS last FROM conversation_changes WHERE seq > ? GROUP BY conversation_id ORDER BY last', (seq,)).fetchall()
+        return (rows[-1][1] if rows else seq), [conv_id for conv_id, _ in rows]
+
+    def _log_change(self, conn, conversation_id: str):
+        seq = conn.execute('INSERT INTO conversation_changes (conversation_id) VALUES (?)', (conversation_id,)).lastrowid
+        if seq % 1000 == 0:
+            conn.execute('DELETE FROM conversation_changes WHERE seq <= ?', (seq - self.CHANGE_LOG_SIZE,))
+
+    def list_recent_ids(self, limit: int, before: Optional[Tuple[str, str]] = None) -> List[Tuple[str, str]]:
+        """按(updated_at, id)倒序分页，before为上一页最后一条的(updated_at, id)"""
+        if before:
+            rows = self.conn.execute('SELECT updated_at, id FROM conversations WHERE (updated_at, id) < (?, ?) ORDER BY updated_at DESC, id DESC LIMIT ?', (before[0], before[1], limit))
+        else:
+            rows = self.conn.execute('SELECT updated_at, id FROM conversations ORDER BY updated_at DESC, id DESC LIMIT ?', (limit,))
+        return rows.fetchall()
+
+    def put_conversation(self, conv: Dict):
+        """写入对话元数据（不含消息）"""
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO conversations (id, title, created_at, updated_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET title = excluded.title, updated_at = excluded.updated_at',
+                (conv['id'], conv['title'], conv['created_at'], conv['updated_at'])
+            )
+            self._log_change(conn, conv['id'])
+
+    def delete_conversation(self, conversation_id: str):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM conversations WHERE id = ?', (conversation_id,))
+            conn.execute('DELETE FROM messages WHERE conversation_id = ?', (conversation_id,))
+            conn.execute('DELETE FROM conversation_state WHERE conversation_id = ?', (conversation_id,))
+            self._log_change(conn, conversation_id)
+
+    def append_message(self, conversation_id: str, message: Dict):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO messages (conversation_id, role, content, timestamp, sources) VALUES (?, ?, ?, ?, ?)',
+                (conversation_id, message['role'], message['content'], message['timestamp'], json.dumps(message.get('sources', []), ensure_ascii=False))
+            )
+
+    def put_state(self, conversation_id: str, state: Dict):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO conversation_state (conversation_id, data) VALUES (?, ?) ON CONFLICT(conversation_id) DO UPDATE SET data = excluded.data',
+                (conversation_id, json.dumps(state, ensure_ascii=False))
+            )
@@ -0,0 +1,90 @@
+from typing import Any, Dict, List, Optional, Tuple
+from bisect import bisect_left, bisect_right
+
+class SortedIndex:
+    """按排序键有序的文档id列表：键和id分两个列表存放，插入删除二分定位，分页直接切片"""
+
+    def __init__(self):
+        self.keys: List[Any] = []
+        self.ids: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def insert(self, key: Any, doc_id: str):
+        # 键相同的按插入顺序排列
+        position = bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.ids.insert(position, doc_id)
+
+    def remove(self, key: Any, doc_id: str):
+        start, end = bisect_left(self.keys, key), bisect_right(self.keys, key)
+        for position in range(start, end):
+            if self.ids[position] == doc_id:
+                del self.keys[position]
+                del self.ids[position]
+                return
+
+    def page(self, offset: int, limit: int, descending: bool = False) -> List[str]:
+        if not descending:
+            return self.ids[offset:offset + limit]
+        end = len(self.ids) - offset
+        return self.ids[max(end - limit, 0):max(end, 0)][::-1]
+
+class DocumentCatalog:
+    """文档列表的二级索引：按 (类别, 状态) 组合分桶，每个桶按各排序字段维护有序id列表
+
+    每个文档登记在 (None, None)、(类别, None)、(None, 状态)、(类别, 状态) 四个桶中，
+    任意过滤条件都对应一个现成的桶，分页只切取当前页，与文档总数无关。
+    """
+
+    SORT_FIELDS = {
+        'created_at': lambda doc: doc.created_at or '',
+        'size': lambda doc: doc.size or 0,
+        'name': lambda doc: doc.original_filename or ''
+    }
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[Optional[str], Optional[str]], Dict[str, SortedIndex]] = {}
+        # 登记时的分桶和排序键，文档字段修改后据此从原位置移除
+        self._entries: Dict[str, Tuple[Tuple, Dict[str, Any]]] = {}
+
+    def add(self, doc):
+        buckets = {(None, None), (doc.category_id, None), (None, doc.status), (doc.category_id, doc.status)}
+        keys = {field: key(doc) for field, key in self.SORT_FIELDS.items()}
+        for bucket in buckets:
+            indexes = self._buckets.setdefault(bucket, {field: SortedIndex() for field in self.SORT_FIELDS})
+            for field, index in indexes.items():
+                index.insert(keys[field], doc.id)
+        self._entries[doc.id] = (tuple(buckets), keys)
+
+    def remove(self, doc_id: str):
+        entry = self._entries.pop(doc_id, None)
+        if entry is None:
+            return
+        buckets, keys = entry
+        for bucket in buckets:
+            indexes = self._buckets[bucket]
+            for field, index in indexes.items():
+                index.remove(keys[field], doc_id)
+            if bucket != (None, None) and not len(indexes['created_at']):
+                del self._buckets[bucket]
+
+    def update(self, doc):
+        """文档的类别、状态或排序字段修改后调用"""
+        self.remove(doc.id)
+        self.add(doc)
+
+    def count(self, category_id: Optional[str] = None, status: Optional[str] = None) -> int:
+        indexes = self._buckets.get((category_id or None, status or None))
+        return len(indexes['created_at']) if indexes else 0
+
+    def page(self, category_id: Optional[str] = None, status: Optional[str] = None, sort: str = 'created_at', descending: bool = False, offset: int = 0, limit: int = 10) -> Tuple[int, List[str]]:
+        """返回 (符合条件的总数, 当前页文档id)"""
+        if sort not in self.SORT_FIELDS:
+            raise ValueError(f"不支持的排序字段: {sort}")
+        indexes = self._buckets.get((category_id or None, status or None))
+        if not indexes:
+            return 0, []
+        index = indexes[sort]
+        return len(index), index.page(offset, limit, descending)
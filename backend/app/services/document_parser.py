@@ -1,10 +1,31 @@
 import os
 import docx
 import PyPDF2
-from typing import List, Dict
+from typing import Iterator, List, Dict, Optional, Tuple
+from collections import deque
+from concurrent.futures import Executor
 from pathlib import Path
 import re
 
+def extract_pdf_pages(file_path: str, start: int = 0, stop: Optional[int] = None) -> List[Tuple[int, str]]:
+    """提取[start, stop)页的文本，返回(页码, 文本)，页码从1开始，空白页跳过
+
+    定义在模块顶层，以便提交到进程池按页段并行执行。
+    """
+    pages = []
+    with open(file_path, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        stop = len(reader.pages) if stop is None else min(stop, len(reader.pages))
+        for number in range(start, stop):
+            page_text = reader.pages[number].extract_text()
+            if page_text.strip():
+                pages.append((number + 1, page_text.strip()))
+    return pages
+
+def pdf_page_count(file_path: str) -> int:
+    with open(file_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
 class DocumentParser:
     """文档解析器 - 支持.docx, .md, .pdf"""
     
@@ -54,17 +75,48 @@ class DocumentParser:
     
     def _parse_pdf(self, file_path: str) -> str:
         """解析PDF文档"""
-        text = []
-        
-        with open(file_path, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
-            
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text.strip():
-                    text.append(page_text.strip())
+        return '\n'.join(text for _, text in self.iter_pdf_pages(file_path))
+    
+    def iter_pdf_pages(self, file_path: str, executor: Optional[Executor] = None, pages_per_task: int = 20, max_pending: int = 4) -> Iterator[Tuple[int, str]]:
+        """按页产出(页码, 文本)
         
-        return '\n'.join(text)
+        传入进程池时把页码范围切成页段并行提取，按顺序产出；
+        同时最多提交max_pending个页段，内存占用与总页数无关。
+        """
+        if executor is None:
+            with open(file_path, 'rb') as file:
+                reader = PyPDF2.PdfReader(file)
+                for number, page in enumerate(reader.pages, 1):
+                    page_text = page.extract_text()
+                    if page_text.strip():
+                        yield number, page_text.strip()
+            return
+        total = pdf_page_count(file_path)
+        ranges = iter(range(0, total, pages_per_task))
+        pending = deque()
+        try:
+            for start in ranges:
+                pending.append(executor.submit(extract_pdf_pages, file_path, start, start + pages_per_task))
+                if len(pending) >= max_pending:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+    
+    def parse_pdf(self, file_path: str, executor: Optional[Executor] = None, pages_per_task: int = 20, max_pending: int = 4) -> Dict[str, any]:
+        """解析PDF并记录每页在正文中的起始位置 pages=[[offset, 页码], ...]"""
+        texts, pages = [], []
+        offset = 0
+        for number, text in self.iter_pdf_pages(file_path, executor, pages_per_task, max_pending):
+            text = self._clean_text(text)
+            if not text:
+                continue
+            pages.append([offset, number])
+            texts.append(text)
+            offset += len(text) + 1
+        return {'content': '\n'.join(texts), 'pages': pages}
     
     def _parse_text(self, file_path: str) -> str:
         """解析文本文件(.md, .txt)"""
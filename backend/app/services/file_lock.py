@@ -0,0 +1,54 @@
+from contextlib import contextmanager
+import os
+
+try:
+    import fcntl
+except ImportError:
+    # 非POSIX系统只支持单进程运行，文件锁退化为空操作
+    fcntl = None
+
+class FileLock:
+    """基于flock的进程间文件锁，多个uvicorn worker之间互斥"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, shared: bool = False, blocking: bool = True) -> bool:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if fcntl is None:
+            return True
+        flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(self._fd, flags)
+        except BlockingIOError:
+            return False
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    @contextmanager
+    def hold(self, shared: bool = False, blocking: bool = True):
+        """临时加锁：每次使用独立的文件描述符，同一进程的多个线程之间同样互斥；
+        产出是否加锁成功（blocking=False时可能失败）"""
+        lock = FileLock(self.path)
+        try:
+            yield lock.acquire(shared, blocking)
+        finally:
+            lock.release()
+
+def lock_is_held(path: str) -> bool:
+    """其他进程是否持有该锁文件的锁（进程退出后锁自动释放，据此判断持有者是否存活）"""
+    if fcntl is None or not os.path.exists(path):
+        return False
+    lock = FileLock(path)
+    try:
+        return not lock.acquire(blocking=False)
+    finally:
+        lock.release()
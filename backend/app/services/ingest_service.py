@@ -0,0 +1,352 @@
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+import asyncio
+import multiprocessing
+import os
+import tarfile
+import uuid
+import zipfile
+from app.core.config import settings
+from app.services.rag_service import rag_service
+from app.services.job_store import JobStore
+from app.services.file_lock import FileLock, lock_is_held
+from app.services.document_parser import document_parser
+from app.services.ingest_worker import parse_file, chunk_content
+
+def _archive_name(info: zipfile.ZipInfo) -> str:
+    # 未设置UTF-8标志的zip（Windows压缩工具常见）文件名按GBK解码
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode('cp437').decode('gbk')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return info.filename
+
+def _safe_member_path(dest_dir: str, name: str) -> Optional[str]:
+    """归档成员的落盘路径；绝对路径、越出目标目录、隐藏文件返回None"""
+    parts = [part for part in name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or any(part.startswith('.') or part == '__MACOSX' for part in parts):
+        return None
+    return os.path.join(dest_dir, *parts)
+
+def _extract_member(src, path: str, name: str, total: int) -> int:
+    """逐块写出一个归档成员，返回累计解压字节数；按实际写出的字节数检查大小上限，不依赖归档头声明的大小"""
+    size = 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as dst:
+        while block := src.read(settings.UPLOAD_CHUNK_SIZE):
+            size += len(block)
+            total += len(block)
+            if size > settings.MAX_FILE_SIZE:
+                raise ValueError(f"归档内文件超过大小限制: {name}")
+            if total > settings.MAX_ARCHIVE_UNCOMPRESSED_SIZE:
+                raise ValueError("归档解压后总大小超过限制")
+            dst.write(block)
+    return total
+
+def _check_member(files: List[Tuple[str, str]], name: str, size: int):
+    # 先按归档头声明的大小和文件数拒绝，避免写出大量数据后才发现超限
+    if len(files) >= settings.MAX_ARCHIVE_FILES:
+        raise ValueError(f"归档内文件数超过上限: {settings.MAX_ARCHIVE_FILES}")
+    if size > settings.MAX_FILE_SIZE:
+        raise ValueError(f"归档内文件超过大小限制: {name}")
+
+def extract_archive(archive_path: str, dest_dir: str) -> List[Tuple[str, str]]:
+    """解压zip/tar到dest_dir，返回[(文件路径, 归档内相对路径)]
+
+    单个文件超过MAX_FILE_SIZE、解压总大小超过MAX_ARCHIVE_UNCOMPRESSED_SIZE或文件数超过MAX_ARCHIVE_FILES时报错，
+    已解压的文件由调用方随dest_dir一起删除。
+    """
+    files = []
+    total = 0
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                name = _archive_name(info)
+                path = None if info.is_dir() else _safe_member_path(dest_dir, name)
+                if path is None:
+                    continue
+                _check_member(files, name, info.file_size)
+                with archive.open(info) as src:
+                    total = _extract_member(src, path, name, total)
+                files.append((path, name))
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as archive:
+            for member in archive:
+                path = _safe_member_path(dest_dir, member.name) if member.isfile() else None
+                if path is None:
+                    continue
+                _check_member(files, member.name, member.size)
+                with archive.extractfile(member) as src:
+                    total = _extract_member(src, path, member.name, total)
+                files.append((path, member.name))
+    else:
+        raise ValueError("不支持的归档格式，仅支持zip/tar")
+    return files
+
+class IngestService:
+    """文档入库调度：任务持久化在SQLite，固定数量的工作协程从队列取任务，
+    解析和切分提交到有界进程池执行，不占用接口进程的事件循环。
+
+    任务状态：queued -> parsing -> chunking -> indexing -> done / failed
+
+    多个worker进程时，任务的owner记录执行它的进程；每个进程运行期间持有以自己pid命名的锁文件，
+    启动时只接管无主任务和owner进程已退出（锁已释放）的任务，不会重复执行其他worker的任务。
+    """
+
+    ACTIVE_STATUSES = ('queued', 'parsing', 'chunking', 'indexing')
+    # 重试无意义的错误（文件格式不支持、文件已丢失）直接失败
+    PERMANENT_ERRORS = (ValueError, FileNotFoundError)
+
+    def __init__(self):
+        self.store = JobStore('./data/ingest_jobs.db')
+        self.lock_dir = './data/ingest_locks'
+        self.owner = str(os.getpid())
+        self._owner_lock: Optional[FileLock] = None
+        self.jobs: Dict[str, Dict] = {}
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # 延迟创建；使用spawn避免fork继承线程池和数据库连接
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=settings.INGEST_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def _reset_pool(self):
+        # 子进程崩溃后进程池不可再用，丢弃后重建
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _ensure_workers(self):
+        if self._workers:
+            return
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._workers = [loop.create_task(self._worker()) for _ in range(settings.INGEST_WORKERS)]
+
+    async def start(self):
+        """应用启动时调用：启动工作协程，并恢复上次退出时未完成的任务"""
+        self._ensure_workers()
+        os.makedirs(self.lock_dir, exist_ok=True)
+        self._owner_lock = FileLock(self._owner_lock_path(self.owner))
+        self._owner_lock.acquire()
+        # 在写事务内检查并接管，多个worker同时启动时每个任务只被一个接管
+        with self.store.transaction():
+            recovered = [job for job in self.store.list_jobs(self.ACTIVE_STATUSES, limit=-1) if self._claimable(job)]
+            for job in reversed(recovered):
+                self.jobs[job['id']] = job
+                self._update(job, status='queued', owner=self.owner)
+        for job in reversed(recovered):
+            self._queue.put_nowait(job)
+        if recovered:
+            print(f"恢复未完成的入库任务: {len(recovered)}个")
+
+    async def shutdown(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+        if self._owner_lock is not None:
+            self._owner_lock.release()
+            self._owner_lock = None
+
+    def _owner_lock_path(self, owner: str) -> str:
+        return os.path.join(self.lock_dir, f'{owner}.lock')
+
+    def _claimable(self, job: Dict) -> bool:
+        owner = job.get('owner')
+        return owner is None or owner == self.owner or not lock_is_held(self._owner_lock_path(owner))
+
+    def submit(self, file_path: str, filename: str, original_filename: str, file_type: str, file_size: int, category_id: str, creator: str = 'admin') -> Dict:
+        """创建入库任务并放入队列，需在事件循环中调用"""
+        job = {
+            'id': str(uuid.uuid4()),
+            'status': 'queued',
+            'progress': 0.0,
+            'file_path': file_path,
+            'filename': filename,
+            'original_filename': original_filename,
+            'type': file_type,
+            'size': file_size,
+            'category_id': category_id,
+            'creator': creator,
+            # 文档id预先分配：索引完成但状态未写入时进程退出，恢复后不会重复入库
+            'doc_id': str(uuid.uuid4()),
+            'chunk_count': 0,
+            'attempts': 0,
+            'error': None,
+            'owner': self.owner,
+            'created_at': datetime.now().isoformat(),
+            'updated_at': datetime.now().isoformat()
+        }
+        self.jobs[job['id']] = job
+        self.store.put(job)
+        self._ensure_workers()
+        self._queue.put_nowait(job)
+        return job
+
+    def retry(self, job_id: str) -> Optional[Dict]:
+        """手动重试失败的任务，非failed状态返回None"""
+        job = self.get_job(job_id)
+        if not job or job['status'] != 'failed':
+            return None
+        self.jobs[job['id']] = job
+        self._update(job, status='queued', progress=0.0, attempts=0, error=None, owner=self.owner)
+        self._ensure_workers()
+        self._queue.put_nowait(job)
+        return job
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        job = self.jobs.get(job_id)
+        return job if job is not None else self.store.get(job_id)
+
+    def list_jobs(self, status: Optional[str] = None, limit: int = 50) -> List[Dict]:
+        return self.store.list_jobs([status] if status else None, limit)
+
+    def _update(self, job: Dict, **fields):
+        job.update(fields)
+        job['updated_at'] = datetime.now().isoformat()
+        self.store.put(job)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def import_files(self, files: List[Tuple[str, str]], category_id: str, creator: str = 'admin') -> Dict:
+        """批量导入[(文件路径, 显示文件名)]：最多INGEST_WORKERS个文件同时解析切分，解析完成的文件每凑满
+        IMPORT_COMMIT_BATCH个即提交一个事务，返回逐文件结果；某批提交失败时该批文件记为失败，其余批次不受影响"""
+        if not await asyncio.to_thread(rag_service.get_category, category_id):
+            raise ValueError("类别不存在")
+        # PDF解析在默认线程池中驱动，不限制并发会占满线程池，阻塞检索等其他to_thread调用
+        semaphore = asyncio.Semaphore(settings.INGEST_WORKERS)
+
+        async def prepare(path: str, name: str) -> Dict:
+            async with semaphore:
+                return await self._prepare(path, name, category_id, creator)
+
+        tasks = [asyncio.ensure_future(prepare(path, name)) for path, name in files]
+        batch_size = max(1, settings.IMPORT_COMMIT_BATCH)
+        batch = []
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                if result['status'] == 'done':
+                    batch.append(result)
+                if len(batch) >= batch_size:
+                    await self._commit_batch(batch)
+                    batch = []
+            if batch:
+                await self._commit_batch(batch)
+        finally:
+            for task in tasks:
+                task.cancel()
+        results = [task.result() for task in tasks]
+        succeeded = sum(1 for result in results if result['status'] == 'done')
+        return {'total': len(results), 'succeeded': succeeded, 'failed': len(results) - succeeded, 'files': results}
+
+    async def _commit_batch(self, batch: List[Dict]):
+        items = [result.pop('item') for result in batch]
+        try:
+            # 在线程中提交，不阻塞事件循环；每批只短时间持有知识库写锁，提交期间其余文件继续解析
+            docs = await asyncio.to_thread(rag_service.add_documents, items)
+        except Exception as e:
+            print(f"批量导入提交失败: {e}")
+            for result in batch:
+                result.update(status='failed', error=str(e))
+            return
+        for result, doc in zip(batch, docs):
+            result.update(doc_id=doc['id'], chunk_count=doc['chunk_count'])
+
+    async def _prepare(self, file_path: str, name: str, category_id: str, creator: str) -> Dict:
+        result = {'filename': name, 'status': 'failed', 'doc_id': None, 'chunk_count': 0, 'error': None}
+        if os.path.splitext(name)[1].lower() not in document_parser.supported_formats:
+            result['error'] = f"不支持的文件格式: {os.path.splitext(name)[1] or name}"
+            return result
+        try:
+            parsed = await self._parse(file_path)
+            chunks = await self._chunk(parsed)
+        except BrokenProcessPool as e:
+            self._reset_pool()
+            result['error'] = str(e) or '解析进程异常退出'
+            return result
+        except Exception as e:
+            result['error'] = str(e)
+            return result
+        result['status'] = 'done'
+        result['item'] = {
+            'content': parsed['content'],
+            'filename': name,
+            'file_type': os.path.splitext(name)[1][1:].lower(),
+            'file_size': os.path.getsize(file_path),
+            'category_id': category_id,
+            'creator': creator,
+            'chunks': chunks
+        }
+        return result
+
+    async def parse_and_chunk(self, file_path: str) -> Dict:
+        """在进程池中解析并切分单个文件，返回{'content', 'chunks'}"""
+        parsed = await self._parse(file_path)
+        return {'content': parsed['content'], 'chunks': await self._chunk(parsed)}
+
+    async def _chunk(self, parsed: Dict) -> List[Dict]:
+        return await asyncio.get_running_loop().run_in_executor(self._get_pool(), chunk_content, parsed['content'], parsed['pages'])
+
+    async def _parse(self, file_path: str) -> Dict:
+        if os.path.splitext(file_path)[1].lower() == '.pdf':
+            # 大型PDF按页段分发到进程池并行提取；驱动生成器会阻塞等待结果，放在线程中执行
+            return await asyncio.to_thread(document_parser.parse_pdf, file_path, self._get_pool(), settings.PDF_PAGES_PER_TASK, settings.INGEST_WORKERS * 2)
+        return await asyncio.get_running_loop().run_in_executor(self._get_pool(), parse_file, file_path)
+
+    async def _run(self, job: Dict):
+        loop = asyncio.get_running_loop()
+        try:
+            doc = await asyncio.to_thread(rag_service.get_document, job['doc_id'])
+            if doc is None:
+                self._update(job, status='parsing', progress=0.1, attempts=job['attempts'] + 1)
+                parsed = await self._parse(job['file_path'])
+                self._update(job, status='chunking', progress=0.5)
+                chunks = await self._chunk(parsed)
+                self._update(job, status='indexing', progress=0.8)
+                # 嵌入和写入倒排较慢，在线程中执行，不阻塞事件循环
+                doc = await asyncio.to_thread(
+                    rag_service.add_document,
+                    content=parsed['content'],
+                    filename=job['filename'],
+                    file_type=job['type'],
+                    file_size=job['size'],
+                    category_id=job['category_id'],
+                    creator=job['creator'],
+                    chunks=chunks,
+                    doc_id=job['doc_id'],
+                    original_filename=job.get('original_filename')
+                )
+            self._update(job, status='done', progress=1.0, chunk_count=doc['chunk_count'], error=None)
+            self.jobs.pop(job['id'], None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"文档入库失败 {job['filename']} (第{job['attempts']}次): {e}")
+            if isinstance(e, BrokenProcessPool):
+                self._reset_pool()
+            if isinstance(e, self.PERMANENT_ERRORS) or job['attempts'] >= settings.INGEST_MAX_ATTEMPTS:
+                self._update(job, status='failed', error=str(e))
+                self.jobs.pop(job['id'], None)
+            else:
+                self._update(job, status='queued', error=str(e))
+                delay = settings.INGEST_RETRY_DELAY * 2 ** (job['attempts'] - 1)
+                loop.call_later(delay, self._queue.put_nowait, job)
+
+ingest_service = IngestService()
@@ -0,0 +1,13 @@
+from typing import Dict, List, Optional
+from app.services.document_parser import document_parser
+from app.services.chunker import create_chunker
+
+# 在解析进程中执行的函数；本模块不能导入rag_service等带全局状态的服务
+
+def parse_file(file_path: str) -> Dict:
+    """解析文件为纯文本（CPU密集，运行在进程池中）"""
+    return {'content': document_parser.parse(file_path)['content'], 'pages': None}
+
+def chunk_content(content: str, pages: Optional[List[List[int]]] = None) -> List[Dict]:
+    """切分知识块（运行在进程池中），pages为PDF各页起始位置"""
+    return create_chunker().chunk(content, pages)
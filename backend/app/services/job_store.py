@@ -0,0 +1,32 @@
+from typing import Dict, List, Optional, Sequence
+import json
+from app.services.sqlite_store import SQLiteStore
+
+class JobStore(SQLiteStore):
+    """入库任务持久化：进程重启后可恢复未完成的任务"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS ingest_jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at TEXT NOT NULL, data TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, created_at);
+    """
+
+    def put(self, job: Dict):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO ingest_jobs (id, status, created_at, data) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET status = excluded.status, data = excluded.data',
+                (job['id'], job['status'], job['created_at'], json.dumps(job, ensure_ascii=False))
+            )
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self.conn.execute('SELECT data FROM ingest_jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list_jobs(self, statuses: Optional[Sequence[str]] = None, limit: int = 50) -> List[Dict]:
+        """按创建时间倒序列出任务"""
+        if statuses:
+            placeholders = ','.join('?' * len(statuses))
+            rows = self.conn.execute(f'SELECT data FROM ingest_jobs WHERE status IN ({placeholders}) ORDER BY created_at DESC LIMIT ?', (*statuses, limit))
+        else:
+            rows = self.conn.execute('SELECT data FROM ingest_jobs ORDER BY created_at DESC LIMIT ?', (limit,))
+        return [json.loads(data) for (data,) in rows]
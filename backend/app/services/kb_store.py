@@ -0,0 +1,331 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+from array import array
+import os
+import sys
+import json
+from app.services.sqlite_store import SQLiteStore
+from app.services.chunk_blob import ChunkBlob
+from app.services.chunker import chunk_hash
+
+class DocumentRecord:
+    """常驻内存的文档元数据：__slots__紧凑存储，知识块只保存id（正文哈希）和页码，不含正文"""
+
+    FIELDS = ('id', 'filename', 'original_filename', 'type', 'size', 'category_id', 'status', 'creator', 'created_at', 'updated_at')
+    __slots__ = FIELDS + ('chunk_ids', 'pages', 'extra')
+
+    def __init__(self, data: Dict, chunk_ids: Sequence[str] = (), pages: Optional[array] = None):
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+        # 旧数据中的其他字段原样保留
+        self.extra = {key: value for key, value in data.items() if key not in self.FIELDS and key not in ('chunks', 'chunk_count')} or None
+        self.chunk_ids: Tuple[str, ...] = tuple(chunk_ids)
+        # 各知识块起始页码，0表示无页码；没有页码信息的文档为None
+        self.pages = pages
+
+    @classmethod
+    def from_chunks(cls, data: Dict, chunks: List[Dict]) -> 'DocumentRecord':
+        record = cls(data)
+        record.set_chunks(chunks)
+        return record
+
+    def set_chunks(self, chunks: List[Dict]):
+        self.chunk_ids = tuple(sys.intern(chunk['id']) for chunk in chunks)
+        self.pages = array('i', (chunk.get('page') or 0 for chunk in chunks)) if any('page' in chunk for chunk in chunks) else None
+
+    @property
+    def chunk_count(self) -> int:
+        return len(self.chunk_ids)
+
+    def page_of(self, chunk_id: str) -> Optional[int]:
+        if self.pages is None or chunk_id not in self.chunk_ids:
+            return None
+        return self.pages[self.chunk_ids.index(chunk_id)] or None
+
+    def copy(self, **fields) -> 'DocumentRecord':
+        return DocumentRecord(dict(self.to_dict(), **fields), self.chunk_ids, self.pages)
+
+    def to_dict(self) -> Dict:
+        data = dict(self.extra) if self.extra else {}
+        data.update((field, getattr(self, field)) for field in self.FIELDS)
+        data['chunk_count'] = self.chunk_count
+        return data
+
+class KnowledgeStore(SQLiteStore):
+    """知识库持久化：SQLite(WAL)按记录读写，替代整体重写knowledge_base.json
+
+    categories/documents 以JSON存元数据；
+    知识块正文按内容哈希只存一份，追加写在内存映射的正文文件（ChunkBlob）中，
+    chunk_texts 记录 哈希 -> (offset, length)，内容相同的知识块（如复制的文档）共享；
+    doc_chunks 存文档引用的知识块及其在文档中的位置；
+    index_lengths/postings 按知识块哈希存BM25倒排索引；
+    kb_changes 按顺序记录被修改或删除的文档id，其他worker据此只重新加载变化的文档，
+    只保留最近CHANGE_LOG_SIZE条。
+    """
+
+    CHANGE_LOG_SIZE = 10000
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS categories (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS documents (seq INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE NOT NULL, data TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS chunk_texts (hash TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS doc_chunks (doc_id TEXT NOT NULL, idx INTEGER NOT NULL, hash TEXT NOT NULL, page INTEGER, start_offset INTEGER, end_offset INTEGER, PRIMARY KEY (doc_id, idx)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_doc_chunks_hash ON doc_chunks (hash);
+        CREATE TABLE IF NOT EXISTS index_lengths (chunk_id TEXT PRIMARY KEY, length INTEGER NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS postings (gram TEXT NOT NULL, chunk_id TEXT NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (gram, chunk_id)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings (chunk_id);
+        CREATE TABLE IF NOT EXISTS kb_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, doc_id TEXT NOT NULL);
+    """
+
+    # 正文文件中空洞超过一半且文件超过该字节数时才整理
+    COMPACT_MIN_BYTES = 1024 * 1024
+
+    def __init__(self, db_file: str):
+        super().__init__(db_file)
+        self.blob_dir = os.path.dirname(os.path.abspath(db_file))
+        with self.transaction():
+            self.blob_name = self.get_meta('chunk_blob')
+            if self.blob_name is None:
+                self.blob_name = os.path.splitext(os.path.basename(db_file))[0] + '.chunks.0'
+                self.set_meta('chunk_blob', self.blob_name)
+        self.blob = ChunkBlob(os.path.join(self.blob_dir, self.blob_name))
+        # 多个worker同时启动时迁移在写事务内检查和执行，只会执行一次
+        with self.transaction():
+            self._migrate_inline_texts()
+            self._migrate_chunks()
+
+    def _sync_blob(self, blob_name: Optional[str] = None):
+        """其他进程整理正文文件后会切换到新文件，按meta中记录的文件名重新打开"""
+        blob_name = blob_name or self.get_meta('chunk_blob')
+        if blob_name == self.blob_name:
+            return
+        # 旧文件可能仍有线程在读，不主动关闭，无引用后自动关闭
+        self.blob = ChunkBlob(os.path.join(self.blob_dir, blob_name))
+        self.blob_name = blob_name
+
+    def _migrate_inline_texts(self):
+        """正文存在chunk_texts.content列中的旧库：正文移入正文文件"""
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(chunk_texts)')}
+        if 'content' not in columns:
+            return
+        rows = self.conn.execute('SELECT hash, content FROM chunk_texts').fetchall()
+        with self.transaction() as conn:
+            conn.execute('DROP TABLE chunk_texts')
+            conn.execute('CREATE TABLE chunk_texts (hash TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL) WITHOUT ROWID')
+            self._write_texts(dict(rows))
+
+    def _migrate_chunks(self):
+        """旧版chunks表（每个知识块一行、uuid为id）迁移为按正文哈希存储，倒排索引随后重建"""
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(chunks)')}
+        if not columns:
+            return
+        page = 'page' if 'page' in columns else 'NULL'
+        start, end = ('start_offset', 'end_offset') if 'start_offset' in columns else ('NULL', 'NULL')
+        rows = self.conn.execute(f'SELECT doc_id, idx, content, {page}, {start}, {end} FROM chunks').fetchall()
+        with self.transaction() as conn:
+            texts = {}
+            for doc_id, idx, content, page_no, start_offset, end_offset in rows:
+                digest = chunk_hash(content)
+                texts[digest] = content
+                conn.execute('INSERT OR REPLACE INTO doc_chunks (doc_id, idx, hash, page, start_offset, end_offset) VALUES (?, ?, ?, ?, ?, ?)', (doc_id, idx, digest, page_no, start_offset, end_offset))
+            self._write_texts(texts)
+            conn.execute('DROP TABLE chunks')
+            conn.execute('DROP TABLE IF EXISTS index_chunks')
+            conn.execute('DELETE FROM postings')
+
+    def import_json(self, json_file: str) -> bool:
+        """首次启动时导入旧版knowledge_base.json"""
+        if not os.path.exists(json_file):
+            return False
+        with self.transaction():
+            if self.get_meta('json_imported'):
+                return False
+            with open(json_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for category in data.get('categories', []):
+                self.put_category(category)
+            for doc in data.get('documents', []):
+                chunks = [dict(chunk, id=chunk_hash(chunk['content'])) for chunk in doc.get('chunks', [])]
+                self.put_document(DocumentRecord.from_chunks(doc, chunks))
+                self.put_chunks(doc['id'], chunks)
+            self.set_meta('json_imported', json_file)
+        return True
+
+    def load(self) -> Tuple[List[Dict], List[DocumentRecord]]:
+        """读取全部类别和文档记录（不读取知识块正文）"""
+        categories = self.load_categories()
+        refs: Dict[str, Tuple[List[str], List[int]]] = {}
+        for doc_id, digest, page in self.conn.execute('SELECT doc_id, hash, page FROM doc_chunks ORDER BY doc_id, idx'):
+            ids, pages = refs.setdefault(doc_id, ([], []))
+            ids.append(sys.intern(digest))
+            pages.append(page or 0)
+        documents = []
+        for (data,) in self.conn.execute('SELECT data FROM documents ORDER BY seq'):
+            doc = json.loads(data)
+            ids, pages = refs.get(doc['id'], ((), ()))
+            documents.append(DocumentRecord(doc, ids, array('i', pages) if any(pages) else None))
+        return categories, documents
+
+    def load_categories(self) -> List[Dict]:
+        return [json.loads(data) for (data,) in self.conn.execute('SELECT data FROM categories ORDER BY rowid')]
+
+    def load_document(self, doc_id: str) -> Optional[DocumentRecord]:
+        """读取单个文档记录，不存在时返回None"""
+        row = self.conn.execute('SELECT data FROM documents WHERE id = ?', (doc_id,)).fetchone()
+        if not row:
+            return None
+        refs = self.conn.execute('SELECT hash, page FROM doc_chunks WHERE doc_id = ? ORDER BY idx', (doc_id,)).fetchall()
+        pages = [page or 0 for _, page in refs]
+        return DocumentRecord(json.loads(row[0]), [sys.intern(digest) for digest, _ in refs], array('i', pages) if any(pages) else None)
+
+    def last_change(self) -> int:
+        return self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM kb_changes').fetchone()[0]
+
+    def changes_since(self, seq: int) -> Optional[Tuple[int, List[str]]]:
+        """seq之后被修改或删除的文档id（按最后一次修改的顺序）和最新序号；
+        所需记录已被清理时返回None，调用方应整体重新加载"""
+        oldest = self.conn.execute('SELECT MIN(seq) FROM kb_changes').fetchone()[0]
+        if oldest is not None and oldest > seq + 1:
+            return None
+        rows = self.conn.execute('SELECT doc_id, MAX(seq) AS last FROM kb_changes WHERE seq > ? GROUP BY doc_id ORDER BY last', (seq,)).fetchall()
+        return (rows[-1][1] if rows else seq), [doc_id for doc_id, _ in rows]
+
+    def _log_change(self, conn, doc_id: str):
+        seq = conn.execute('INSERT INTO kb_changes (doc_id) VALUES (?)', (doc_id,)).lastrowid
+        if seq % 1000 == 0:
+            conn.execute('DELETE FROM kb_changes WHERE seq <= ?', (seq - self.CHANGE_LOG_SIZE,))
+
+    def put_category(self, category: Dict):
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO categories (id, data) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data', (category['id'], json.dumps(category, ensure_ascii=False)))
+
+    def delete_category(self, category_id: str):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM categories WHERE id = ?', (category_id,))
+
+    def put_document(self, doc: DocumentRecord):
+        """写入文档元数据（不含知识块）"""
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO documents (id, data) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET data = excluded.data', (doc.id, json.dumps(doc.to_dict(), ensure_ascii=False)))
+            self._log_change(conn, doc.id)
+
+    def delete_document(self, doc_id: str) -> Set[str]:
+        """删除文档，返回不再被任何文档引用的知识块id"""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
+            self._log_change(conn, doc_id)
+            return self._collect_texts(self._delete_refs(doc_id))
+
+    def put_chunks(self, doc_id: str, chunks: List[Dict]) -> Tuple[Set[str], Set[str]]:
+        """替换文档的知识块引用，返回(新写入正文的知识块id, 不再被任何文档引用的知识块id)"""
+        with self.transaction() as conn:
+            old_hashes = self._delete_refs(doc_id)
+            added = self._write_texts({c['id']: c['content'] for c in chunks})
+            conn.executemany(
+                'INSERT INTO doc_chunks (doc_id, idx, hash, page, start_offset, end_offset) VALUES (?, ?, ?, ?, ?, ?)',
+                [(doc_id, c['index'], c['id'], c.get('page'), c.get('start'), c.get('end')) for c in chunks]
+            )
+            released = self._collect_texts(old_hashes - {c['id'] for c in chunks})
+            self._log_change(conn, doc_id)
+        return added, released
+
+    def copy_chunks(self, source_doc_id: str, target_doc_id: str):
+        """复制文档的知识块引用，正文共享"""
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO doc_chunks (doc_id, idx, hash, page, start_offset, end_offset) '
+                'SELECT ?, idx, hash, page, start_offset, end_offset FROM doc_chunks WHERE doc_id = ?',
+                (target_doc_id, source_doc_id)
+            )
+            self._log_change(conn, target_doc_id)
+
+    def read_chunk(self, chunk_id: str) -> Optional[str]:
+        # 地址和正文文件名在同一条语句中读取，保证与其他进程的整理一致
+        row = self.conn.execute("SELECT offset, length, (SELECT value FROM meta WHERE key = 'chunk_blob') FROM chunk_texts WHERE hash = ?", (chunk_id,)).fetchone()
+        if not row:
+            return None
+        self._sync_blob(row[2])
+        return self.blob.read(row[0], row[1])
+
+    def chunk_ids(self) -> Iterator[str]:
+        return (digest for (digest,) in self.conn.execute('SELECT hash FROM chunk_texts'))
+
+    def count_chunks(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM chunk_texts').fetchone()[0]
+
+    def _write_texts(self, texts: Dict[str, str]) -> Set[str]:
+        """写入尚未存储的正文：先追加到正文文件并落盘，再登记地址；返回新写入的知识块id"""
+        self._sync_blob()
+        new = {digest: content for digest, content in texts.items() if not self.conn.execute('SELECT 1 FROM chunk_texts WHERE hash = ?', (digest,)).fetchone()}
+        addresses = self.blob.append(new.values())
+        self.conn.executemany('INSERT INTO chunk_texts (hash, offset, length) VALUES (?, ?, ?)', [(digest, offset, length) for digest, (offset, length) in zip(new, addresses)])
+        return set(new)
+
+    def _delete_refs(self, doc_id: str) -> Set[str]:
+        hashes = {digest for (digest,) in self.conn.execute('SELECT hash FROM doc_chunks WHERE doc_id = ?', (doc_id,))}
+        self.conn.execute('DELETE FROM doc_chunks WHERE doc_id = ?', (doc_id,))
+        return hashes
+
+    def _collect_texts(self, hashes: Iterable[str]) -> Set[str]:
+        """删除不再被引用的正文地址（正文文件中的空洞在整理时回收），返回被删除的知识块id"""
+        released = {digest for digest in hashes if not self.conn.execute('SELECT 1 FROM doc_chunks WHERE hash = ? LIMIT 1', (digest,)).fetchone()}
+        self.conn.executemany('DELETE FROM chunk_texts WHERE hash = ?', [(digest,) for digest in released])
+        return released
+
+    def compact_blob(self) -> bool:
+        """正文文件空洞过多时，把仍被引用的正文重写到下一代文件并切换
+
+        在写事务内完成，其他进程读取时按meta中的文件名切换；旧文件删除后，
+        已打开它的进程仍可读到关闭为止。
+        """
+        with self.transaction() as conn:
+            self._sync_blob()
+            live = conn.execute('SELECT COALESCE(SUM(length), 0) FROM chunk_texts').fetchone()[0]
+            if self.blob.size <= max(live * 2, self.COMPACT_MIN_BYTES):
+                return False
+            stem, generation = self.blob_name.rsplit('.', 1)
+            new_name = f'{stem}.{int(generation) + 1}'
+            new_path = os.path.join(self.blob_dir, new_name)
+            if os.path.exists(new_path):
+                os.remove(new_path)
+            new_blob = ChunkBlob(new_path)
+            rows = conn.execute('SELECT hash, offset, length FROM chunk_texts').fetchall()
+            for start in range(0, len(rows), 1000):
+                batch = rows[start:start + 1000]
+                addresses = new_blob.append([self.blob.read(offset, length) for _, offset, length in batch])
+                conn.executemany('UPDATE chunk_texts SET offset = ?, length = ? WHERE hash = ?', [(offset, length, digest) for (digest, _, _), (offset, length) in zip(batch, addresses)])
+            self.set_meta('chunk_blob', new_name)
+        old_path = self.blob.path
+        self.blob, self.blob_name = new_blob, new_name
+        os.remove(old_path)
+        return True
+
+    def load_index(self) -> Tuple[Dict[str, int], Dict[str, Dict[str, int]]]:
+        chunk_lengths = {sys.intern(chunk_id): length for chunk_id, length in self.conn.execute('SELECT chunk_id, length FROM index_lengths')}
+        postings: Dict[str, Dict[str, int]] = {}
+        for gram, chunk_id, tf in self.conn.execute('SELECT gram, chunk_id, tf FROM postings'):
+            postings.setdefault(gram, {})[sys.intern(chunk_id)] = tf
+        return chunk_lengths, postings
+
+    def load_postings(self, chunk_ids: Iterable[str]) -> Dict[str, Tuple[int, Dict[str, int]]]:
+        """读取指定知识块的 (gram总数, gram词频)，未收录的知识块不在结果中"""
+        result = {}
+        for chunk_id in chunk_ids:
+            row = self.conn.execute('SELECT length FROM index_lengths WHERE chunk_id = ?', (chunk_id,)).fetchone()
+            if row:
+                result[chunk_id] = (row[0], dict(self.conn.execute('SELECT gram, tf FROM postings WHERE chunk_id = ?', (chunk_id,))))
+        return result
+
+    def clear_index(self):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM index_lengths')
+            conn.execute('DELETE FROM postings')
+
+    def put_postings(self, chunk_id: str, tfs: Dict[str, int]):
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO index_lengths (chunk_id, length) VALUES (?, ?)', (chunk_id, sum(tfs.values())))
+            conn.executemany('INSERT OR REPLACE INTO postings (gram, chunk_id, tf) VALUES (?, ?, ?)', [(gram, chunk_id, tf) for gram, tf in tfs.items()])
+
+    def delete_postings(self, chunk_id: str):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM index_lengths WHERE chunk_id = ?', (chunk_id,))
+            conn.execute('DELETE FROM postings WHERE chunk_id = ?', (chunk_id,))
@@ -1,50 +1,19 @@
 from zhipuai import ZhipuAI
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Iterator, List, Dict, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import hashlib
+import json
+import httpx
 from app.core.config import settings
 from app.services.rag_service import rag_service
+from app.services.response_cache import ResponseCache
+from app.services.context_packer import ContextPacker
+from app.services.symptom_lexicon import symptom_lexicon
+from app.services.request_coalescing import SharedStream, SingleFlight, StreamFlight
 
-class LLMService:
-    """智谱AI服务 - 伤寒论跳跃式问诊"""
-
-    def __init__(self):
-        self.client = None
-        self.model = settings.ZHIPUAI_MODEL
-        self._init_client()
-
-    def _init_client(self):
-        if settings.ZHIPUAI_API_KEY:
-            try:
-                self.client = ZhipuAI(api_key=settings.ZHIPUAI_API_KEY)
-            except Exception as e:
-                print(f"智谱AI初始化失败: {e}")
-                self.client = None
-
-    def chat_with_rag(
-        self,
-        message: str,
-        conversation_history: Optional[List[Dict]] = None,
-        session_id: Optional[str] = None
-    ) -> Dict[str, any]:
-        """基于伤寒论的跳跃式问诊"""
-
-        # 获取对话历史，分析已收集的症状
-        collected_symptoms = self._extract_symptoms(conversation_history)
-        symptom_count = len(collected_symptoms)
-
-        # 检索知识库
-        try:
-            relevant_docs = rag_service.similarity_search(message, k=5)
-        except:
-            relevant_docs = []
-
-        # 构建知识库上下文
-        if relevant_docs:
-            kb_content = "\n".join([doc['content'] for doc in relevant_docs])
-        else:
-            kb_content = "头痛\n身体痛"
-
-        # 设计跳跃式问诊prompt
-        system_prompt = """你是"小艾"，一位温柔专业的中医诊疗助手。你精通《伤寒论》，正在为患者进行问诊。
+# 系统提示词保持为不变的常量，每轮请求的前缀一致
+SYSTEM_PROMPT = """你是"小艾"，一位温柔专业的中医诊疗助手。你精通《伤寒论》，正在为患者进行问诊。
 
 【核心原则】
 1. **只使用知识库内容**：你的所有诊断和建议必须基于提供的知识库（伤寒论相关内容）
@@ -116,62 +85,315 @@ class LLMService:
 - 每次回复只问1-2个问题，不要一次问太多
 """
 
-        # 构建对话历史摘要
-        history_summary = ""
-        if conversation_history and len(conversation_history) > 0:
-            for i, item in enumerate(conversation_history[-8:]):
-                role = "您" if item.get('role') == 'user' else "小艾"
-                content = item.get('content', '')
-                history_summary += f"{role}：{content}\n"
+INQUIRY_TEMPLATE = """【知识库内容】
+{knowledge}
 
-        # 判断是否应该做诊断
-        should_diagnose = symptom_count >= 4
+【已收集的症状】
+{symptoms}
 
-        # 调用智谱AI
-        if self.client:
-            try:
-                if should_diagnose:
-                    instruction = f"""【已收集的症状】
-{chr(10).join(f'- {s}' for s in collected_symptoms)}
+【对话历史】
+{history}
 
 【当前问题】
 {message}
 
-请根据知识库内容和已收集的症状，做出诊断判断。"""
-                else:
-                    instruction = f"""【知识库内容】
-{kb_content}
-
-【已收集的症状】
-{chr(10).join(f'- {s}' for s in collected_symptoms) if collected_symptoms else '暂无'}
+请根据知识库内容和对话历史，判断下一步该问什么问题，用大白话询问患者。"""
 
-【对话历史】
-{history_summary}
+DIAGNOSE_TEMPLATE = """【已收集的症状】
+{symptoms}
 
 【当前问题】
 {message}
 
-请根据知识库内容和对话历史，判断下一步该问什么问题，用大白话询问患者。"""
+请根据知识库内容和已收集的症状，做出诊断判断。"""
+
+class LLMService:
+    """智谱AI服务 - 伤寒论跳跃式问诊"""
 
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": instruction}
-                ]
+    def __init__(self):
+        self.client = None
+        self.model = settings.ZHIPUAI_MODEL
+        # 智谱SDK只有同步接口，上游调用放到有界线程池中执行，避免阻塞事件循环
+        self._executor = ThreadPoolExecutor(max_workers=settings.LLM_MAX_CONCURRENCY, thread_name_prefix='llm')
+        self.cache = None
+        self.packer = ContextPacker(settings.PROMPT_TOKEN_BUDGET, settings.PROMPT_KB_SHARE, settings.PROMPT_RECENT_TURNS, settings.CHUNK_OVERLAP * 2)
+        # 进行中的上游调用按提示词合并（突发的相同首轮问诊只调用一次）
+        self.flights = SingleFlight()
+        self.streams = StreamFlight()
+        self._init_client()
+        self._init_cache()
 
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    temperature=0.8,
-                    max_tokens=1200
+    def _init_client(self):
+        if settings.ZHIPUAI_API_KEY:
+            try:
+                # 共享一个带连接池的httpx客户端，复用TCP/TLS连接
+                http_client = httpx.Client(
+                    limits=httpx.Limits(max_connections=settings.LLM_MAX_CONCURRENCY, max_keepalive_connections=settings.LLM_MAX_CONCURRENCY),
+                    timeout=settings.LLM_TIMEOUT
                 )
+                self.client = ZhipuAI(api_key=settings.ZHIPUAI_API_KEY, http_client=http_client, timeout=settings.LLM_TIMEOUT)
+            except Exception as e:
+                print(f"智谱AI初始化失败: {e}")
+                self.client = None
 
-                ai_response = response.choices[0].message.content
+    def _init_cache(self):
+        if not settings.RESPONSE_CACHE_ENABLED:
+            return
+        self.cache = ResponseCache(
+            ttl=settings.RESPONSE_CACHE_TTL,
+            max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+            max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+            similarity=settings.RESPONSE_CACHE_SIMILARITY,
+            embed=self._embed_for_cache if rag_service.vector_store else None
+        )
+        rag_service.add_listener(self.cache.invalidate_document)
+
+    @staticmethod
+    def _embed_for_cache(text: str) -> Optional[List[float]]:
+        vector = rag_service.vector_store.embed_query(text)
+        return vector.tolist() if vector is not None else None
+
+    def _cached_response(self, context: Dict) -> Optional[str]:
+        if not self.cache:
+            return None
+        return self.cache.get(context['cache_key'], context['message'])
+
+    def _cache_response(self, context: Dict, ai_response: str):
+        if self.cache:
+            doc_ids = {doc['metadata']['doc_id'] for doc in context['relevant_docs']}
+            self.cache.put(context['cache_key'], context['message'], ai_response, doc_ids)
+
+    async def _acached_response(self, context: Dict) -> Optional[str]:
+        # 开启相似问题匹配时需要计算问题向量（可能是远程嵌入调用），放到线程池中执行
+        if self.cache and self.cache.embed:
+            return await asyncio.to_thread(self._cached_response, context)
+        return self._cached_response(context)
+
+    async def _acache_response(self, context: Dict, ai_response: str):
+        if self.cache and self.cache.embed:
+            await asyncio.to_thread(self._cache_response, context, ai_response)
+        else:
+            self._cache_response(context, ai_response)
 
-            except Exception as e:
-                print(f"智谱AI调用失败: {e}")
-                ai_response = "抱歉，我现在无法为您服务，请稍后再试~"
+    def coalescing_stats(self) -> Dict:
+        """calls为实际发起的上游调用数，shared为合并到进行中调用的请求数"""
+        return {'completions': self.flights.stats(), 'streams': self.streams.stats(), 'retrieval': rag_service.batch_stats()}
+
+    @staticmethod
+    def _prompt_key(messages: List[Dict]) -> str:
+        return hashlib.sha1(json.dumps(messages, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def _submit_completion(self, messages: List[Dict]) -> Future:
+        """在线程池中调用上游；LLM_SINGLE_FLIGHT开启时与进行中的相同提示词调用共享结果"""
+        if settings.LLM_SINGLE_FLIGHT:
+            return self.flights.submit(self._prompt_key(messages), self._executor, self._complete, messages)[0]
+        return self._executor.submit(self._complete, messages)
+
+    @staticmethod
+    def _retrieval_failed(e: Exception) -> Dict:
+        print(f"知识库检索失败: {e}")
+        return {'results': [], 'mode': rag_service.mode, 'timings': {}}
+
+    def _retrieve(self, message: str) -> Dict:
+        try:
+            return rag_service.retrieve(message, k=settings.TOP_K_RESULTS)
+        except Exception as e:
+            return self._retrieval_failed(e)
+
+    async def _aretrieve(self, message: str) -> Dict:
+        try:
+            return await rag_service.aretrieve(message, k=settings.TOP_K_RESULTS)
+        except Exception as e:
+            return self._retrieval_failed(e)
+
+    def chat_with_rag(
+        self,
+        message: str,
+        conversation_history: Optional[List[Dict]] = None,
+        session_id: Optional[str] = None,
+        collected_symptoms: Optional[List[str]] = None
+    ) -> Dict[str, any]:
+        """基于伤寒论的跳跃式问诊"""
+        context = self._build_request(message, conversation_history, session_id, self._retrieve(message), collected_symptoms)
+        ai_response = self._cached_response(context)
+        if ai_response is None:
+            ai_response, ok = self._submit_completion(context['messages']).result()
+            if ok:
+                self._cache_response(context, ai_response)
+        return self._build_result(context, ai_response)
+
+    async def achat_with_rag(
+        self,
+        message: str,
+        conversation_history: Optional[List[Dict]] = None,
+        session_id: Optional[str] = None,
+        collected_symptoms: Optional[List[str]] = None
+    ) -> Dict[str, any]:
+        """chat_with_rag的异步版本：检索和上游调用在线程池中执行，上游并发数受LLM_MAX_CONCURRENCY限制"""
+        context = self._build_request(message, conversation_history, session_id, await self._aretrieve(message), collected_symptoms)
+        ai_response = await self._acached_response(context)
+        if ai_response is None:
+            # 合并的调用由多个请求共享，某个请求被取消时不取消上游调用
+            ai_response, ok = await asyncio.shield(asyncio.wrap_future(self._submit_completion(context['messages'])))
+            if ok:
+                await self._acache_response(context, ai_response)
+        return self._build_result(context, ai_response)
+
+    async def astream_chat_with_rag(
+        self,
+        message: str,
+        conversation_history: Optional[List[Dict]] = None,
+        session_id: Optional[str] = None,
+        collected_symptoms: Optional[List[str]] = None
+    ) -> AsyncIterator[Dict]:
+        """流式问诊：逐段产出 {'type': 'delta', 'content'}，结束时产出 {'type': 'done', 'result'}
+
+        提示词相同的并发流共享一次上游流式调用，后加入的请求先补发已产出的部分。
+        """
+        context = self._build_request(message, conversation_history, session_id, await self._aretrieve(message), collected_symptoms)
+        cached = await self._acached_response(context)
+        if cached is not None:
+            yield {'type': 'delta', 'content': cached}
+            yield {'type': 'done', 'result': self._build_result(context, cached)}
+            return
+
+        # 关闭合并时每个请求使用唯一的key
+        key = self._prompt_key(context['messages']) if settings.LLM_SINGLE_FLIGHT else object()
+        stream, leader = self.streams.join(key)
+        queue = stream.subscribe()
+
+        def pump():
+            status = {'ok': False}
+            try:
+                for piece in self._stream_complete(context['messages'], status):
+                    # 所有订阅的客户端都已断开时尽早停止读取上游流
+                    if stream.abandoned.is_set():
+                        break
+                    stream.publish(piece)
+            finally:
+                self.streams.finish(key, stream, status['ok'])
+            if status['ok']:
+                self._cache_response(context, ''.join(stream.parts))
+
+        if leader:
+            asyncio.get_running_loop().run_in_executor(self._executor, pump)
+        parts = []
+        try:
+            while True:
+                piece = await queue.get()
+                if piece is SharedStream.END:
+                    break
+                parts.append(piece)
+                yield {'type': 'delta', 'content': piece}
+        finally:
+            self.streams.leave(key, stream, queue)
+        yield {'type': 'done', 'result': self._build_result(context, ''.join(parts))}
+
+    def _build_request(
+        self,
+        message: str,
+        conversation_history: Optional[List[Dict]],
+        session_id: Optional[str],
+        retrieval: Dict,
+        collected_symptoms: Optional[List[str]] = None
+    ) -> Dict:
+        """按检索结果组装发送给模型的消息"""
+
+        # 已收集的症状由对话状态增量维护；未传入时从对话历史中提取
+        if collected_symptoms is None:
+            collected_symptoms = self._extract_symptoms(conversation_history)
+        symptom_count = len(collected_symptoms)
+
+        relevant_docs = retrieval['results']
+
+        # 判断是否应该做诊断
+        should_diagnose = symptom_count >= 4
+        symptoms_text = chr(10).join(f'- {s}' for s in collected_symptoms)
+
+        # 诊断阶段的指令不含知识库内容和对话历史
+        if should_diagnose:
+            template = DIAGNOSE_TEMPLATE
+            chunks, history = [], []
         else:
-            ai_response = "系统提示：请先配置智谱AI API Key。"
+            template = INQUIRY_TEMPLATE
+            symptoms_text = symptoms_text or '暂无'
+            chunks = [doc['content'] for doc in relevant_docs] or ["头痛\n身体痛"]
+            history = conversation_history or []
+
+        # 按token预算放入知识库内容和对话历史
+        packed = self.packer.pack(
+            {'system': SYSTEM_PROMPT, 'instruction': template.format(knowledge='', symptoms=symptoms_text, history='', message=message)},
+            chunks,
+            history
+        )
+        instruction = template.format(knowledge=packed['knowledge'], symptoms=symptoms_text, history=packed['history'], message=message)
+
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": instruction}
+        ]
+
+        return {
+            'message': message,
+            'messages': messages,
+            'cache_key': ResponseCache.context_key(
+                [doc['metadata']['chunk_id'] for doc in relevant_docs],
+                collected_symptoms,
+                conversation_history or []
+            ),
+            'session_id': session_id,
+            'conversation_history': conversation_history,
+            'collected_symptoms': collected_symptoms,
+            'should_diagnose': should_diagnose,
+            'relevant_docs': relevant_docs,
+            'retrieval': retrieval,
+            'prompt_tokens': packed['tokens']
+        }
+
+    def _complete(self, messages: List[Dict]) -> Tuple[str, bool]:
+        """调用智谱AI（同步阻塞），返回(回复, 是否成功)"""
+        if not self.client:
+            return "系统提示：请先配置智谱AI API Key。", False
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.8,
+                max_tokens=1200
+            )
+            return response.choices[0].message.content, True
+        except Exception as e:
+            print(f"智谱AI调用失败: {e}")
+            return "抱歉，我现在无法为您服务，请稍后再试~", False
+
+    def _stream_complete(self, messages: List[Dict], status: Optional[Dict] = None) -> Iterator[str]:
+        """流式调用智谱AI（同步阻塞），逐段产出文本；完整结束时置status['ok']"""
+        if not self.client:
+            yield "系统提示：请先配置智谱AI API Key。"
+            return
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=0.8,
+                max_tokens=1200,
+                stream=True
+            )
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+            if status is not None:
+                status['ok'] = True
+        except Exception as e:
+            print(f"智谱AI调用失败: {e}")
+            yield "抱歉，我现在无法为您服务，请稍后再试~"
+
+    def _build_result(self, context: Dict, ai_response: str) -> Dict[str, any]:
+        conversation_history = context['conversation_history']
+        collected_symptoms = list(context['collected_symptoms'])
+        should_diagnose = context['should_diagnose']
+        relevant_docs = context['relevant_docs']
+        retrieval = context['retrieval']
 
         # 更新症状列表
         if conversation_history:
@@ -181,29 +403,21 @@ class LLMService:
 
         return {
             'response': ai_response,
-            'session_id': session_id or 'session_tcm',
+            'session_id': context['session_id'] or 'session_tcm',
             'need_more_info': not should_diagnose,
             'is_complete': should_diagnose,
             'collected_symptoms': collected_symptoms,
-            'sources': [doc.get('metadata', {}).get('filename', '') for doc in relevant_docs[:3]]
+            'sources': [doc.get('metadata', {}).get('filename', '') for doc in relevant_docs[:3]],
+            'retrieval': {'mode': retrieval['mode'], 'timings': retrieval['timings']},
+            'prompt_tokens': context['prompt_tokens']
         }
 
-    def _extract_symptoms(self, conversation_history: List[Dict]) -> List[str]:
-        """从对话历史中提取症状"""
-        symptoms = []
-        if not conversation_history:
-            return symptoms
-
-        for item in conversation_history:
+    def _extract_symptoms(self, conversation_history: Optional[List[Dict]]) -> List[str]:
+        """从对话历史中提取症状（没有对话状态时使用）"""
+        symptoms = {}
+        for item in conversation_history or []:
             if item.get('role') == 'user':
-                content = item.get('content', '')
-                # 简单的症状关键词提取
-                symptom_keywords = ['头痛', '身痛', '发热', '怕冷', '恶寒', '无汗', '有汗', '酸痛']
-                for keyword in symptom_keywords:
-                    if keyword in content:
-                        symptoms.append(keyword)
-                        break
-
-        return symptoms
+                symptoms.update(dict.fromkeys(symptom_lexicon.extract(item.get('content', ''))))
+        return list(symptoms)
 
 llm_service = LLMService()
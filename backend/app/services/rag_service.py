@@ -1,139 +1,649 @@
-from typing import List, Dict, Optional
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Set, Tuple
 import os
-import json
+import asyncio
 from datetime import datetime
 import uuid
+import heapq
+import time
+import threading
+from collections import OrderedDict
+from functools import partial
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from app.core.config import settings
+from app.services.chunker import create_chunker
+from app.services.kb_store import DocumentRecord, KnowledgeStore
+from app.services.doc_catalog import DocumentCatalog
+from app.services.file_lock import FileLock
+from app.services.search_index import NgramIndex
+from app.services.request_coalescing import MicroBatcher
 
 class RAGService:
+    """知识库服务：文档元数据、倒排索引和向量索引常驻内存，以SQLite存储为准
+
+    多个uvicorn worker共用同一存储：修改在_write()内进行（知识库文件锁 + 数据库写事务），
+    开始修改前先同步其他worker提交的变化；读取前_sync()发现数据库被其他worker修改过时，
+    按变更记录只重新加载变化的文档并增量更新索引。
+    检索在线程池中执行，内存中的文档和索引只在持有self._lock时读写；修改可能较慢
+    （嵌入、写入倒排），需在线程中调用，不要在事件循环中直接调用。
+    """
+
     def __init__(self):
-        self.persist_file = './data/knowledge_base.json'
+        self.legacy_file = './data/knowledge_base.json'
         os.makedirs('./data', exist_ok=True)
+        self.store = KnowledgeStore('./data/knowledge_base.db')
+        self.write_lock = FileLock('./data/knowledge_base.lock')
+        self.index = NgramIndex(k1=settings.BM25_K1, b=settings.BM25_B)
+        self.vector_store = None
+        self.mode = 'keyword'
+        self.chunker = create_chunker()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='retrieval')
+        self._listeners: List[Callable[[str], None]] = []
+        # 知识库代数：任何修改都会递增，检索缓存条目代数不一致即视为过期
+        self.generation = 0
+        self._retrieval_cache: Dict[Tuple, Tuple[int, List[Tuple[str, float]]]] = OrderedDict()
+        self._retrieval_cache_lock = threading.Lock()
+        # 并发检索攒批在默认线程池中执行（不能用self._executor，批内的混合检索还要向其提交任务）；
+        # 单个请求失败只影响该请求
+        self._batcher = MicroBatcher(partial(self.retrieve_many, return_exceptions=True), settings.RETRIEVAL_BATCH_WINDOW_MS / 1000, settings.RETRIEVAL_BATCH_MAX)
+        self._lock = threading.RLock()
+        self._data_version = self.store.data_version()
         self._load_data()
+        self._load_index()
+        if settings.RETRIEVAL_MODE in ('vector', 'hybrid'):
+            self._init_vector_store()
+            if self.vector_store:
+                self.mode = settings.RETRIEVAL_MODE
+
+    def _init_vector_store(self):
+        try:
+            from app.services.vector_store import VectorStore, create_embedder
+            vector_store = VectorStore(settings.CHROMA_PERSIST_DIR, settings.CHROMA_COLLECTION_NAME, create_embedder())
+            with vector_store.lock.hold():
+                vector_store.refresh(lock=False)
+                vector_store.sync(list(self.store.chunk_ids()), self._chunk_text)
+                vector_store.save()
+            self.vector_store = vector_store
+        except Exception as e:
+            print(f"向量检索初始化失败，使用关键词检索: {e}")
+            self.vector_store = None
+
+    def add_listener(self, listener: Callable[[str], None]):
+        """注册文档变更回调，参数为文档id（用于缓存失效）"""
+        self._listeners.append(listener)
+
+    def _changed(self, doc_id: Optional[str] = None):
+        """每次修改知识库后调用：递增代数使检索缓存失效，并通知文档变更"""
+        self.generation += 1
+        if doc_id:
+            for listener in self._listeners:
+                listener(doc_id)
 
     def _load_data(self):
-        if os.path.exists(self.persist_file):
-            with open(self.persist_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                self.categories = data.get('categories', [])
-                self.documents = data.get('documents', [])
-        else:
-            self.categories = []
-            self.documents = []
-            self._save_data()
+        if self.store.import_json(self.legacy_file):
+            print(f"已导入旧版知识库: {self.legacy_file}")
+        with self.store.transaction('DEFERRED'):
+            self._change_seq = self.store.last_change()
+            self.categories, self.documents = self.store.load()
+        if self.store.compact_blob():
+            print("已整理知识块正文文件")
+
+    @contextmanager
+    def _write(self):
+        """修改知识库：持有知识库文件锁、向量索引文件锁和数据库写事务，先同步其他worker的修改；
+        正常退出时提交事务并保存向量索引，异常时回滚事务并丢弃未保存的向量。不可嵌套。"""
+        # 加锁顺序固定为知识库文件锁、向量索引文件锁、self._lock、数据库写锁：等待其他写入方时
+        # 不持有self._lock，检索不受影响；持有self._lock时不会再等待SQLite的写锁
+        vector_lock = self.vector_store.lock.hold() if self.vector_store else nullcontext()
+        with self.write_lock.hold(), vector_lock, self._lock:
+            if self.vector_store:
+                self.vector_store.refresh(lock=False)
+            try:
+                with self.store.transaction():
+                    self._sync_data()
+                    yield
+                    change_seq = self.store.last_change()
+            except BaseException:
+                if self.vector_store:
+                    self.vector_store.discard()
+                raise
+            # 提交成功后才跳过自己写入的变更记录
+            self._change_seq = change_seq
+            if self.vector_store:
+                self.vector_store.save()
+
+    def _sync(self):
+        """读取前调用：其他worker修改过知识库时重新加载"""
+        with self._lock:
+            if self.vector_store:
+                # 不等待正在写入的worker，写入完成后的下一次读取再刷新
+                self.vector_store.refresh(blocking=False)
+            if self.store.data_version() != self._data_version:
+                self._sync_data()
+
+    def _sync_data(self):
+        version = self.store.data_version()
+        if version == self._data_version:
+            return
+        with self.store.transaction('DEFERRED'):
+            changes = self.store.changes_since(self._change_seq)
+            if changes is None:
+                changed_ids = self._reload_data()
+            else:
+                self._change_seq, changed_ids = changes
+                self.categories = self.store.load_categories()
+                for doc_id in changed_ids:
+                    self._apply_document(doc_id, self.store.load_document(doc_id))
+        self._data_version = version
+        for doc_id in changed_ids:
+            self._changed(doc_id)
+        self._changed()
+
+    def _reload_data(self) -> List[str]:
+        """变更记录已被清理时整体重新加载，返回有变化的文档id"""
+        old_docs = self._docs_by_id
+        self._change_seq = self.store.last_change()
+        self.categories, self.documents = self.store.load()
+        self._load_index()
+        new_docs = self._docs_by_id
+        return [doc_id for doc_id in old_docs.keys() | new_docs.keys()
+                if doc_id not in old_docs or doc_id not in new_docs or old_docs[doc_id].updated_at != new_docs[doc_id].updated_at]
+
+    def _apply_document(self, doc_id: str, new: Optional[DocumentRecord]):
+        """按其他worker提交的文档记录（None为已删除）更新内存中的文档和倒排索引，只读取新增知识块的倒排"""
+        old = self._docs_by_id.pop(doc_id, None)
+        if old is not None:
+            self.catalog.remove(doc_id)
+            self.documents.remove(old)
+        old_ids = set(old.chunk_ids) if old is not None and old.status == 'enabled' else set()
+        new_ids = set(new.chunk_ids) if new is not None and new.status == 'enabled' else set()
+        for chunk_id in old_ids - new_ids:
+            self.index.remove(chunk_id, doc_id)
+        added = new_ids - old_ids
+        postings = self.store.load_postings(chunk_id for chunk_id in added if chunk_id not in self.index)
+        for chunk_id in added:
+            if chunk_id in postings:
+                self.index.add_postings(chunk_id, doc_id, *postings[chunk_id])
+            else:
+                self.index.add(chunk_id, doc_id, '' if chunk_id in self.index else self._chunk_text(chunk_id))
+        if new is not None:
+            self._docs_by_id[doc_id] = new
+            self.documents.append(new)
+            self.catalog.add(new)
+
+    def _load_index(self):
+        self._docs_by_id: Dict[str, DocumentRecord] = {d.id: d for d in self.documents}
+        self.catalog = DocumentCatalog()
+        for doc in self.documents:
+            self.catalog.add(doc)
+        expected: Dict[str, Set[str]] = {}
+        for doc in self.documents:
+            if doc.status == 'enabled':
+                for chunk_id in doc.chunk_ids:
+                    expected.setdefault(chunk_id, set()).add(doc.id)
+        chunk_lengths, postings = self.store.load_index()
+        if chunk_lengths.keys() == expected.keys():
+            self.index.restore(expected, chunk_lengths, postings)
+            return
+        self.index.clear()
+        with self.store.transaction():
+            self.store.clear_index()
+            for doc in self.documents:
+                if doc.status == 'enabled':
+                    self._index_chunks(doc.id, doc.chunk_ids)
+
+    def _chunk_text(self, chunk_id: str) -> str:
+        """知识块正文按需从正文文件读取，内存中不常驻"""
+        return self.store.read_chunk(chunk_id) or ''
+
+    def _index_chunks(self, doc_id: str, chunk_ids: Iterable[str]):
+        # 已被收录的知识块只登记引用，不读正文
+        for chunk_id in dict.fromkeys(chunk_ids):
+            content = '' if chunk_id in self.index else self._chunk_text(chunk_id)
+            tfs = self.index.add(chunk_id, doc_id, content)
+            if tfs is not None:
+                self.store.put_postings(chunk_id, tfs)
 
-    def _save_data(self):
-        with open(self.persist_file, 'w', encoding='utf-8') as f:
-            json.dump({'categories': self.categories, 'documents': self.documents}, f, ensure_ascii=False, indent=2)
+    def _unindex_chunks(self, doc_id: str, chunk_ids: Iterable[str]):
+        for chunk_id in dict.fromkeys(chunk_ids):
+            if self.index.remove(chunk_id, doc_id):
+                self.store.delete_postings(chunk_id)
+
+    def _store_chunks(self, doc: DocumentRecord, chunks: List[Dict], vectors: Optional[Dict] = None) -> Set[str]:
+        """写入文档的知识块，新出现的正文补嵌入向量、不再被引用的删除向量；返回新写入正文的知识块id
+
+        vectors为_embed_chunks()在锁外预先嵌入的向量，缺少的才在此嵌入。
+        """
+        added, released = self.store.put_chunks(doc.id, chunks)
+        self._release_vectors(released)
+        if self.vector_store and added:
+            self.vector_store.add([(c['id'], c['content']) for c in chunks if c['id'] in added], vectors)
+        return added
+
+    def _embed_chunks(self, chunks: Iterable[Dict]) -> Dict:
+        """在获取锁之前为向量索引中还没有的知识块嵌入向量，嵌入接口较慢，不在持锁期间调用"""
+        if not self.vector_store:
+            return {}
+        return self.vector_store.embed([(c['id'], c['content']) for c in chunks if c['id'] not in self.vector_store.rows])
+
+    def _release_vectors(self, chunk_ids: Iterable[str]):
+        if self.vector_store and chunk_ids:
+            self.vector_store.remove(list(chunk_ids))
+
+    def _chunk_content(self, content: str) -> List[Dict]:
+        return self.chunker.chunk(content)
 
     def create_category(self, name: str, creator: str = 'admin') -> Dict:
         category = {'id': str(uuid.uuid4()), 'name': name, 'creator': creator, 'created_at': datetime.now().isoformat(), 'document_count': 0}
-        self.categories.append(category)
-        self._save_data()
+        with self._write():
+            self.store.put_category(category)
+            self.categories.append(category)
+        self._changed()
         return category
 
     def list_categories(self) -> List[Dict]:
-        for cat in self.categories:
-            cat['document_count'] = len([d for d in self.documents if d.get('category_id') == cat['id']])
-        return self.categories
+        with self._lock:
+            self._sync()
+            for cat in self.categories:
+                cat['document_count'] = self.catalog.count(cat['id'])
+            return list(self.categories)
+
+    def rename_category(self, category_id: str, name: str) -> bool:
+        with self._write():
+            for cat in self.categories:
+                if cat['id'] == category_id:
+                    cat['name'] = name
+                    self.store.put_category(cat)
+                    break
+            else:
+                return False
+        self._changed()
+        return True
 
     def delete_category(self, category_id: str) -> bool:
-        self.categories = [c for c in self.categories if c['id'] != category_id]
-        self.documents = [d for d in self.documents if d.get('category_id') != category_id]
-        self._save_data()
+        with self._write():
+            self.store.delete_category(category_id)
+            for doc in self.documents:
+                if doc.category_id == category_id:
+                    self._unindex_chunks(doc.id, doc.chunk_ids)
+                    self._release_vectors(self.store.delete_document(doc.id))
+                    self._docs_by_id.pop(doc.id, None)
+                    self.catalog.remove(doc.id)
+                    self._changed(doc.id)
+            self.categories = [c for c in self.categories if c['id'] != category_id]
+            self.documents = [d for d in self.documents if d.category_id != category_id]
+        self._changed()
         return True
 
-    def add_document(self, content: str, filename: str, file_type: str, file_size: int, category_id: str, creator: str = 'admin') -> Dict:
-        chunk_size = 500
-        chunks = []
-        for i in range(0, len(content), chunk_size):
-            chunks.append({'id': str(uuid.uuid4()), 'content': content[i:i+chunk_size], 'index': i // chunk_size})
-        doc = {'id': str(uuid.uuid4()), 'filename': filename, 'original_filename': filename, 'type': file_type, 'size': file_size, 'category_id': category_id, 'chunks': chunks, 'chunk_count': len(chunks), 'status': 'enabled', 'creator': creator, 'created_at': datetime.now().isoformat(), 'updated_at': datetime.now().isoformat()}
-        self.documents.append(doc)
-        self._save_data()
-        return doc
-
-    def list_documents(self, category_id: Optional[str] = None, page: int = 1, page_size: int = 10, status: Optional[str] = None) -> Dict:
-        filtered_docs = self.documents
-        if category_id:
-            filtered_docs = [d for d in filtered_docs if d.get('category_id') == category_id]
-        if status:
-            filtered_docs = [d for d in filtered_docs if d.get('status') == status]
-        total = len(filtered_docs)
-        start = (page - 1) * page_size
-        paged_docs = filtered_docs[start:start + page_size]
+    def add_document(self, content: str, filename: str, file_type: str, file_size: int, category_id: str, creator: str = 'admin', chunks: Optional[List[Dict]] = None, doc_id: Optional[str] = None, original_filename: Optional[str] = None) -> Dict:
+        return self.add_documents([{
+            'content': content, 'filename': filename, 'file_type': file_type, 'file_size': file_size,
+            'category_id': category_id, 'creator': creator, 'chunks': chunks, 'doc_id': doc_id,
+            'original_filename': original_filename
+        }])[0]
+
+    def add_documents(self, items: List[Dict]) -> List[Dict]:
+        """批量入库：items每项为add_document的参数，全部文档、知识块和倒排索引在同一事务中提交"""
+        entries = [self._new_document(**item) for item in items]
+        if not entries:
+            return []
+        vectors = self._embed_chunks(chunk for _, chunks in entries for chunk in chunks)
+        docs = [doc for doc, _ in entries]
+        try:
+            with self._write():
+                for doc, chunks in entries:
+                    self.store.put_document(doc)
+                    self._store_chunks(doc, chunks, vectors)
+                    self._docs_by_id[doc.id] = doc
+                    self._index_chunks(doc.id, doc.chunk_ids)
+                self.documents.extend(docs)
+                for doc in docs:
+                    self.catalog.add(doc)
+        except Exception:
+            # 事务已回滚、未保存的向量已丢弃，按存储重建内存索引
+            with self._lock:
+                self.documents = [d for d in self.documents if d.id not in {doc.id for doc in docs}]
+                self._load_index()
+            raise
+        for doc in docs:
+            self._changed(doc.id)
+        return [doc.to_dict() for doc in docs]
+
+    def _new_document(self, content: str, filename: str, file_type: str, file_size: int, category_id: str, creator: str = 'admin', chunks: Optional[List[Dict]] = None, doc_id: Optional[str] = None, original_filename: Optional[str] = None) -> Tuple[DocumentRecord, List[Dict]]:
+        # chunks可由后台解析进程预先切分好传入；doc_id由入库任务预先分配，保证重试幂等；
+        # filename为保存的文件名，original_filename为显示用的文件名（默认与filename相同）
+        if chunks is None:
+            chunks = self._chunk_content(content)
+        now = datetime.now().isoformat()
+        data = {'id': doc_id or str(uuid.uuid4()), 'filename': filename, 'original_filename': original_filename or filename, 'type': file_type, 'size': file_size, 'category_id': category_id, 'status': 'enabled', 'creator': creator, 'created_at': now, 'updated_at': now}
+        return DocumentRecord.from_chunks(data, chunks), chunks
+
+    def get_document(self, doc_id: str) -> Optional[Dict]:
+        with self._lock:
+            self._sync()
+            doc = self._docs_by_id.get(doc_id)
+            return doc.to_dict() if doc else None
+
+    def get_category(self, category_id: str) -> Optional[Dict]:
+        with self._lock:
+            self._sync()
+            return next((c for c in self.categories if c['id'] == category_id), None)
+
+    def category_version(self, category_name: str) -> Tuple:
+        """类别下启用文档的(id, 更新时间)，用于判断配置类文档是否变化"""
+        with self._lock:
+            self._sync()
+            version = []
+            for category in self.categories:
+                if category['name'] == category_name:
+                    _, doc_ids = self.catalog.page(category['id'], 'enabled', limit=self.catalog.count(category['id'], 'enabled'))
+                    version.extend((doc_id, self._docs_by_id[doc_id].updated_at) for doc_id in doc_ids)
+            return tuple(version)
+
+    def category_texts(self, category_name: str) -> Iterator[str]:
+        """按类别名读取其下启用文档的知识块正文（用于症状词表等配置类文档）"""
+        chunk_ids = []
+        with self._lock:
+            self._sync()
+            for category in self.categories:
+                if category['name'] != category_name:
+                    continue
+                _, doc_ids = self.catalog.page(category['id'], 'enabled', limit=self.catalog.count(category['id'], 'enabled'))
+                for doc_id in doc_ids:
+                    chunk_ids.extend(self._docs_by_id[doc_id].chunk_ids)
+        for chunk_id in chunk_ids:
+            yield self._chunk_text(chunk_id)
+
+    def copy_document(self, doc_id: str, target_category_id: str) -> Optional[Dict]:
+        with self._write():
+            doc = self._docs_by_id.get(doc_id)
+            if not doc:
+                return None
+            # 知识块按内容寻址，副本只复制引用，正文、向量和倒排索引共享
+            now = datetime.now().isoformat()
+            new_doc = doc.copy(id=str(uuid.uuid4()), category_id=target_category_id, created_at=now, updated_at=now)
+            self.store.put_document(new_doc)
+            self.store.copy_chunks(doc.id, new_doc.id)
+            self._docs_by_id[new_doc.id] = new_doc
+            if new_doc.status == 'enabled':
+                self._index_chunks(new_doc.id, new_doc.chunk_ids)
+            self.documents.append(new_doc)
+            self.catalog.add(new_doc)
+        self._changed(new_doc.id)
+        return new_doc.to_dict()
+
+    def list_documents(self, category_id: Optional[str] = None, page: int = 1, page_size: int = 10, status: Optional[str] = None, sort: str = 'created_at', order: str = 'asc') -> Dict:
+        """分页列出文档元数据（不含知识块），sort取created_at/size/name，order取asc/desc"""
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"不支持的排序方向: {order}")
+        page, page_size = max(page, 1), max(page_size, 1)
+        with self._lock:
+            self._sync()
+            total, doc_ids = self.catalog.page(category_id, status, sort, order == 'desc', (page - 1) * page_size, page_size)
+            paged_docs = [self._docs_by_id[doc_id].to_dict() for doc_id in doc_ids]
         return {'documents': paged_docs, 'total': total, 'page': page, 'page_size': page_size, 'total_pages': (total + page_size - 1) // page_size}
 
     def delete_document(self, doc_id: str) -> bool:
-        self.documents = [d for d in self.documents if d['id'] != doc_id]
-        self._save_data()
+        with self._write():
+            doc = self._docs_by_id.get(doc_id)
+            if not doc:
+                return True
+            self._unindex_chunks(doc.id, doc.chunk_ids)
+            self._release_vectors(self.store.delete_document(doc_id))
+            self._docs_by_id.pop(doc_id, None)
+            self.catalog.remove(doc_id)
+            self.documents.remove(doc)
+        self._changed(doc_id)
         return True
 
     def disable_document(self, doc_id: str) -> bool:
-        for doc in self.documents:
-            if doc['id'] == doc_id:
-                doc['status'] = 'disabled'
-                doc['updated_at'] = datetime.now().isoformat()
-                self._save_data()
-                return True
-        return False
+        with self._write():
+            doc = self._docs_by_id.get(doc_id)
+            if not doc:
+                return False
+            self._unindex_chunks(doc.id, doc.chunk_ids)
+            doc.status = 'disabled'
+            doc.updated_at = datetime.now().isoformat()
+            self.store.put_document(doc)
+            self.catalog.update(doc)
+        self._changed(doc_id)
+        return True
 
     def enable_document(self, doc_id: str) -> bool:
-        for doc in self.documents:
-            if doc['id'] == doc_id:
-                doc['status'] = 'enabled'
-                doc['updated_at'] = datetime.now().isoformat()
-                self._save_data()
-                return True
-        return False
+        with self._write():
+            doc = self._docs_by_id.get(doc_id)
+            if not doc:
+                return False
+            doc.status = 'enabled'
+            doc.updated_at = datetime.now().isoformat()
+            self.store.put_document(doc)
+            self._index_chunks(doc.id, doc.chunk_ids)
+            self.catalog.update(doc)
+        self._changed(doc_id)
+        return True
 
     def rename_document(self, doc_id: str, new_name: str) -> bool:
-        for doc in self.documents:
-            if doc['id'] == doc_id:
-                doc['original_filename'] = new_name
-                doc['updated_at'] = datetime.now().isoformat()
-                self._save_data()
-                return True
-        return False
+        with self._write():
+            doc = self._docs_by_id.get(doc_id)
+            if not doc:
+                return False
+            doc.original_filename = new_name
+            doc.updated_at = datetime.now().isoformat()
+            self.store.put_document(doc)
+            self.catalog.update(doc)
+        self._changed(doc_id)
+        return True
 
     def migrate_document(self, doc_id: str, new_category_id: str) -> bool:
-        for doc in self.documents:
-            if doc['id'] == doc_id:
-                doc['category_id'] = new_category_id
-                doc['updated_at'] = datetime.now().isoformat()
-                self._save_data()
-                return True
-        return False
+        # 索引只记录知识块所属文档，类别在检索时从文档读取，迁移无需重建索引
+        with self._write():
+            doc = self._docs_by_id.get(doc_id)
+            if not doc:
+                return False
+            doc.category_id = new_category_id
+            doc.updated_at = datetime.now().isoformat()
+            self.store.put_document(doc)
+            self.catalog.update(doc)
+        self._changed(doc_id)
+        return True
 
-    def update_document_content(self, doc_id: str, new_content: str) -> bool:
-        for doc in self.documents:
-            if doc['id'] == doc_id:
-                chunk_size = 500
-                chunks = []
-                for i in range(0, len(new_content), chunk_size):
-                    chunks.append({'id': str(uuid.uuid4()), 'content': new_content[i:i+chunk_size], 'index': i // chunk_size})
-                doc['chunks'] = chunks
-                doc['chunk_count'] = len(chunks)
-                doc['updated_at'] = datetime.now().isoformat()
-                self._save_data()
-                return True
-        return False
+    def update_document_content(self, doc_id: str, new_content: str, chunks: Optional[List[Dict]] = None, file_size: Optional[int] = None) -> bool:
+        if chunks is None:
+            chunks = self._chunk_content(new_content)
+        vectors = self._embed_chunks(chunks)
+        with self._write():
+            doc = self._docs_by_id.get(doc_id)
+            if not doc:
+                return False
+            # 只对内容哈希发生变化的知识块重建索引，未变的知识块保持原样
+            old_ids = set(doc.chunk_ids)
+            new_ids = {chunk['id'] for chunk in chunks}
+            self._unindex_chunks(doc.id, old_ids - new_ids)
+            self._store_chunks(doc, chunks, vectors)
+            doc.set_chunks(chunks)
+            if doc.status == 'enabled':
+                self._index_chunks(doc.id, [chunk_id for chunk_id in doc.chunk_ids if chunk_id not in old_ids])
+            if file_size is not None:
+                doc.size = file_size
+            doc.updated_at = datetime.now().isoformat()
+            self.store.put_document(doc)
+            self.catalog.update(doc)
+        self._changed(doc_id)
+        return True
 
     def similarity_search(self, query: str, k: int = 3, category_id: Optional[str] = None) -> List[Dict]:
+        return self.retrieve(query, k, category_id)['results']
+
+    def retrieve(self, query: str, k: int = 3, category_id: Optional[str] = None) -> Dict:
+        """按当前检索模式检索，返回结果及各阶段耗时(毫秒)"""
+        return self.retrieve_many([(query, k, category_id)])[0]
+
+    async def aretrieve(self, query: str, k: int = 3, category_id: Optional[str] = None) -> Dict:
+        """异步检索：在线程池中执行，RETRIEVAL_BATCH_WINDOW_MS内到达的并发检索合并为一批"""
+        if settings.RETRIEVAL_BATCH_WINDOW_MS <= 0:
+            return await asyncio.to_thread(self.retrieve, query, k, category_id)
+        return await self._batcher.submit((query, k, category_id))
+
+    def batch_stats(self) -> Dict:
+        """检索微批统计：batches为执行的批数，items为其中的检索请求数"""
+        return self._batcher.stats()
+
+    def retrieve_many(self, requests: List[Tuple[str, int, Optional[str]]], return_exceptions: bool = False) -> List:
+        """批量检索 [(query, k, category_id)]：相同的请求只检索一次，未命中缓存的查询向量在锁外一次批量嵌入，
+        排序和读取正文持有self._lock；return_exceptions为True时单个请求的异常作为其结果返回"""
+        start = time.perf_counter()
+        unique = list(dict.fromkeys(requests))
+        timings: Dict[Tuple, Dict] = {key: {} for key in unique}
+        with self._lock:
+            self._sync()
+            rankings = {key: self._cached_ranking(key, self.generation) for key in unique}
+        missing = [key for key, ranking in rankings.items() if ranking is None]
+        vectors = {}
+        if missing and self.mode in ('vector', 'hybrid'):
+            queries = list(dict.fromkeys(query for query, _, _ in missing))
+            vectors, embed_ms = self._timed(self._embed_queries, queries)
+            for key in missing:
+                timings[key]['embed_ms'] = embed_ms
+        results = {}
+        # 两次加锁之间知识库可能被修改：排序使用修改后的状态，已缓存的排序物化时跳过已删除或禁用的文档
+        with self._lock:
+            self._sync()
+            generation = self.generation
+            for key in unique:
+                query, k, category_id = key
+                key_timings = timings[key]
+                try:
+                    ranking = rankings[key]
+                    if ranking is None:
+                        vector = vectors.get(query)
+                        if isinstance(vector, Exception):
+                            raise vector
+                        ranking = self._rank(query, k, category_id, key_timings, vector)
+                        self._cache_ranking(key, generation, ranking)
+                    materialized, key_timings['materialize_ms'] = self._timed(self._materialize, ranking, category_id)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    results[key] = e
+                    continue
+                key_timings['total_ms'] = round((time.perf_counter() - start) * 1000, 2)
+                results[key] = {'results': materialized, 'mode': self.mode, 'cached': key not in missing, 'timings': key_timings}
+        return [results[key] for key in requests]
+
+    def _embed_queries(self, queries: List[str]) -> Dict[str, object]:
+        """查询 -> 向量；批量嵌入失败时逐条重试，仍失败的查询对应其异常"""
+        try:
+            return dict(zip(queries, self.vector_store.embed_queries(queries)))
+        except Exception as e:
+            if len(queries) == 1:
+                return {queries[0]: e}
+            print(f"批量嵌入查询失败，逐条重试: {e}")
+        vectors = {}
+        for query in queries:
+            try:
+                vectors[query] = self.vector_store.embed_query(query)
+            except Exception as e:
+                vectors[query] = e
+        return vectors
+
+    def _rank(self, query: str, k: int, category_id: Optional[str], timings: Dict, vector=None) -> List[Tuple[str, float]]:
+        if self.mode == 'hybrid':
+            pool = max(k, settings.RETRIEVAL_CANDIDATES)
+            keyword_future = self._executor.submit(self._timed, self._keyword_ranking, query, pool, category_id)
+            vector_future = self._executor.submit(self._timed, self._vector_ranking, query, pool, category_id, vector)
+            keyword_ranking, timings['keyword_ms'] = keyword_future.result()
+            vector_ranking, timings['vector_ms'] = vector_future.result()
+            ranking, timings['fusion_ms'] = self._timed(self._fuse, [keyword_ranking, vector_ranking], k)
+        elif self.mode == 'vector':
+            ranking, timings['vector_ms'] = self._timed(self._vector_ranking, query, k, category_id, vector)
+        else:
+            ranking, timings['keyword_ms'] = self._timed(self._keyword_ranking, query, k, category_id)
+        return ranking
+
+    def _cached_ranking(self, key: Tuple, generation: int) -> Optional[List[Tuple[str, float]]]:
+        with self._retrieval_cache_lock:
+            entry = self._retrieval_cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] != generation:
+                del self._retrieval_cache[key]
+                return None
+            self._retrieval_cache.move_to_end(key)
+            return entry[1]
+
+    def _cache_ranking(self, key: Tuple, generation: int, ranking: List[Tuple[str, float]]):
+        if settings.RETRIEVAL_CACHE_SIZE <= 0:
+            return
+        with self._retrieval_cache_lock:
+            self._retrieval_cache[key] = (generation, ranking)
+            self._retrieval_cache.move_to_end(key)
+            while len(self._retrieval_cache) > settings.RETRIEVAL_CACHE_SIZE:
+                self._retrieval_cache.popitem(last=False)
+
+    @staticmethod
+    def _timed(func, *args):
+        start = time.perf_counter()
+        value = func(*args)
+        return value, round((time.perf_counter() - start) * 1000, 2)
+
+    def _keyword_ranking(self, query: str, k: int, category_id: Optional[str] = None) -> List[Tuple[str, float]]:
+        results = []
+        for chunk_id, score in self.index.search(query).items():
+            if category_id and self._chunk_doc(chunk_id, category_id) is None:
+                continue
+            results.append((chunk_id, score))
+        return heapq.nlargest(k, results, key=lambda x: x[1])
+
+    def _vector_ranking(self, query: str, k: int, category_id: Optional[str] = None, vector=None) -> List[Tuple[str, float]]:
+        # 索引只收录启用文档的知识块，借此过滤禁用文档
+        def accept(chunk_id: str) -> bool:
+            return chunk_id in self.index and (not category_id or self._chunk_doc(chunk_id, category_id) is not None)
+        return self.vector_store.search(query, k, accept, vector=vector)
+
+    @staticmethod
+    def _fuse(rankings: List[List[Tuple[str, float]]], k: int) -> List[Tuple[str, float]]:
+        """倒数排名融合(RRF)：score = Σ 1 / (RRF_K + rank)"""
+        fused: Dict[str, float] = {}
+        for ranking in rankings:
+            for rank, (chunk_id, _) in enumerate(ranking, 1):
+                fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (settings.RRF_K + rank)
+        return heapq.nlargest(k, fused.items(), key=lambda x: x[1])
+
+    def _chunk_doc(self, chunk_id: str, category_id: Optional[str] = None) -> Optional[DocumentRecord]:
+        """引用该知识块的启用文档（限定类别时取该类别下的），多个时取id最小的以保证结果稳定"""
+        for doc_id in sorted(self.index.chunk_docs.get(chunk_id, ())):
+            doc = self._docs_by_id.get(doc_id)
+            if doc is not None and (not category_id or doc.category_id == category_id):
+                return doc
+        return None
+
+    def _materialize(self, ranking: List[Tuple[str, float]], category_id: Optional[str] = None) -> List[Dict]:
+        """只为命中的知识块读取正文，按上下文字数预算截断；排序后被删除或禁用的文档跳过"""
         results = []
-        query_lower = query.lower()
-        enabled_docs = [d for d in self.documents if d.get('status') == 'enabled']
-        if category_id:
-            enabled_docs = [d for d in enabled_docs if d.get('category_id') == category_id]
-        for doc in enabled_docs:
-            for chunk in doc.get('chunks', []):
-                content = chunk['content'].lower()
-                if any(word in content for word in query_lower.split()[:5]):
-                    results.append({'content': chunk['content'], 'metadata': {'filename': doc['original_filename'], 'doc_id': doc['id'], 'category_id': doc['category_id']}, 'score': query_lower.count(chunk['content'][:50].lower())})
-        results.sort(key=lambda x: x['score'], reverse=True)
-        return results[:k]
+        budget = settings.RETRIEVAL_CONTEXT_CHARS
+        for chunk_id, score in ranking:
+            doc = self._chunk_doc(chunk_id, category_id)
+            if doc is None:
+                continue
+            content = self._chunk_text(chunk_id)
+            if results and len(content) > budget:
+                break
+            budget -= len(content)
+            results.append(self._make_result(chunk_id, score, content, doc))
+        return results
+
+    def _make_result(self, chunk_id: str, score: float, content: str, doc: DocumentRecord) -> Dict:
+        metadata = {'filename': doc.original_filename, 'doc_id': doc.id, 'category_id': doc.category_id, 'chunk_id': chunk_id}
+        # 页码按所选文档中的那一处取
+        page = doc.page_of(chunk_id)
+        if page is not None:
+            metadata['page'] = page
+        return {'content': content, 'metadata': metadata, 'score': round(score, 4)}
 
     def get_stats(self) -> Dict:
-        enabled_docs = [d for d in self.documents if d.get('status') == 'enabled']
-        return {'total_categories': len(self.categories), 'total_documents': len(self.documents), 'enabled_documents': len(enabled_docs), 'total_chunks': sum(d['chunk_count'] for d in enabled_docs), 'collection_name': 'tcm_knowledge'}
+        with self._lock:
+            self._sync()
+            enabled_docs = [d for d in self.documents if d.status == 'enabled']
+            return {'total_categories': len(self.categories), 'total_documents': self.catalog.count(), 'enabled_documents': self.catalog.count(status='enabled'), 'total_chunks': sum(d.chunk_count for d in enabled_docs), 'unique_chunks': self.store.count_chunks(), 'collection_name': settings.CHROMA_COLLECTION_NAME, 'retrieval_mode': self.mode, 'vector_count': len(self.vector_store) if self.vector_store else 0}
 
 rag_service = RAGService()
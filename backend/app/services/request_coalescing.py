@@ -0,0 +1,172 @@
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+from concurrent.futures import Executor, Future
+import asyncio
+import threading
+
+class SingleFlight:
+    """相同key的并发调用合并为一次：第一个调用者提交执行，其余调用者等待同一个Future"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def submit(self, key: Hashable, executor: Executor, func: Callable, *args) -> Tuple[Future, bool]:
+        """返回 (Future, 是否与进行中的调用合并)；调用结束后key即移除，之后的调用重新执行"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, True
+            self.calls += 1
+            future = executor.submit(func, *args)
+            self._calls[key] = future
+        future.add_done_callback(lambda _: self._forget(key, future))
+        return future, False
+
+    def _forget(self, key: Hashable, future: Future):
+        with self._lock:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+    def stats(self) -> Dict:
+        return {'calls': self.calls, 'shared': self.shared}
+
+class SharedStream:
+    """一次上游流式调用的输出，分发给所有订阅者；后加入的订阅者先补发已产出的部分"""
+
+    END = object()
+
+    def __init__(self, lock: threading.Lock):
+        self._lock = lock
+        self.parts: List[str] = []
+        self.finished = False
+        self.ok = False
+        # 所有订阅者都离开后置位，生产者据此停止读取上游流
+        self.abandoned = threading.Event()
+        self._subscribers: List[Tuple[asyncio.AbstractEventLoop, asyncio.Queue]] = []
+
+    def subscribe(self) -> asyncio.Queue:
+        """在事件循环中调用，返回逐段产出文本、以END结束的队列"""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            for piece in self.parts:
+                queue.put_nowait(piece)
+            if self.finished:
+                queue.put_nowait(self.END)
+            else:
+                self._subscribers.append((loop, queue))
+        return queue
+
+    def publish(self, piece: str):
+        """生产者线程调用"""
+        with self._lock:
+            self.parts.append(piece)
+            for loop, queue in self._subscribers:
+                loop.call_soon_threadsafe(queue.put_nowait, piece)
+
+    def _finish(self, ok: bool):
+        self.finished = True
+        self.ok = ok
+        for loop, queue in self._subscribers:
+            loop.call_soon_threadsafe(queue.put_nowait, self.END)
+        self._subscribers = []
+
+    def _leave(self, queue: asyncio.Queue) -> bool:
+        self._subscribers = [(loop, q) for loop, q in self._subscribers if q is not queue]
+        if not self._subscribers and not self.finished:
+            self.abandoned.set()
+            return True
+        return False
+
+class StreamFlight:
+    """流式调用的single-flight：相同key的并发流共享一次上游调用"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams: Dict[Hashable, SharedStream] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def join(self, key: Hashable) -> Tuple[SharedStream, bool]:
+        """返回 (共享流, 是否为发起者)；发起者负责在线程中产出并调用finish"""
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None and not stream.abandoned.is_set():
+                self.shared += 1
+                return stream, False
+            self.calls += 1
+            stream = self._streams[key] = SharedStream(self._lock)
+            return stream, True
+
+    def finish(self, key: Hashable, stream: SharedStream, ok: bool):
+        with self._lock:
+            stream._finish(ok)
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+
+    def leave(self, key: Hashable, stream: SharedStream, queue: asyncio.Queue):
+        """订阅者结束（含客户端断开）时调用；最后一个订阅者离开时放弃该流，之后的请求重新发起"""
+        with self._lock:
+            if stream._leave(queue) and self._streams.get(key) is stream:
+                del self._streams[key]
+
+    def stats(self) -> Dict:
+        return {'calls': self.calls, 'shared': self.shared}
+
+class MicroBatcher:
+    """微批：窗口内到达的请求攒成一批，在线程池中调用一次func(items) -> 等长的结果列表
+
+    窗口从一批中第一个请求到达时开始计时，攒满max_size立即执行；只在同一个事件循环中使用。
+    结果列表中的异常对象只作为对应请求的异常抛出，func本身抛出异常时整批失败。
+    """
+
+    def __init__(self, func: Callable[[List[Any]], Sequence[Any]], window: float, max_size: int, executor: Optional[Executor] = None):
+        self.func = func
+        self.window = window
+        self.max_size = max_size
+        self.executor = executor
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.batches += 1
+        self.items += len(batch)
+        task = asyncio.get_running_loop().run_in_executor(self.executor, self.func, [item for item, _ in batch])
+        task.add_done_callback(lambda done: self._deliver(batch, done))
+
+    @staticmethod
+    def _deliver(batch: List[Tuple[Any, asyncio.Future]], done: asyncio.Future):
+        error = done.exception()
+        results = done.result() if error is None else [error] * len(batch)
+        for (_, future), result in zip(batch, results):
+            # 等待方已取消（客户端断开）的跳过
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict:
+        return {'batches': self.batches, 'items': self.items}
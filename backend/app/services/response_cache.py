@@ -0,0 +1,142 @@
+from typing import Callable, Dict, Iterable, List, Optional, Set
+from collections import OrderedDict
+import json
+import time
+import hashlib
+import threading
+from app.services.search_index import normalize_text
+
+class ResponseCache:
+    """问诊回复缓存：LRU + TTL + 内存上限，按文档失效
+
+    精确键 = 上下文键(检索到的知识块、已收集症状、对话历史) + 归一化消息；
+    配置了嵌入函数时，同一上下文内消息向量余弦相似度达到阈值也视为命中。
+    """
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int, similarity: float = 0.0, embed: Optional[Callable[[str], List[float]]] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.similarity = similarity
+        self.embed = embed if similarity > 0 else None
+        self._entries: Dict[str, Dict] = OrderedDict()
+        self._by_doc: Dict[str, Set[str]] = {}
+        self._by_context: Dict[str, Set[str]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def context_key(chunk_ids: Iterable[str], symptoms: Iterable[str], history: Iterable[Dict]) -> str:
+        payload = [sorted(chunk_ids), sorted(symptoms), [[h.get('role'), h.get('content')] for h in history]]
+        return hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, context: str, message: str) -> Optional[str]:
+        normalized = normalize_text(message)
+        key = f'{context}:{normalized}'
+        now = time.time()
+        # 向量计算可能较慢（远程嵌入），放在锁外
+        vector = None
+        if self.embed and key not in self._entries and context in self._by_context:
+            vector = self._embed(normalized)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry['expires'] < now:
+                self._remove(key)
+                entry = None
+            if entry is None and vector is not None and context in self._by_context:
+                entry = self._similar(context, vector, now)
+                if entry:
+                    self.semantic_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry['key'])
+            self.hits += 1
+            return entry['response']
+
+    def put(self, context: str, message: str, response: str, doc_ids: Iterable[str]):
+        normalized = normalize_text(message)
+        key = f'{context}:{normalized}'
+        size = len(key) + len(response.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        vector = self._embed(normalized) if self.embed else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            doc_ids = set(doc_ids)
+            self._entries[key] = {'key': key, 'context': context, 'response': response, 'expires': time.time() + self.ttl, 'size': size, 'doc_ids': doc_ids, 'vector': vector}
+            self._bytes += size
+            for doc_id in doc_ids:
+                self._by_doc.setdefault(doc_id, set()).add(key)
+            self._by_context.setdefault(context, set()).add(key)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_document(self, doc_id: str):
+        """文档被修改/禁用/删除时清除引用它的缓存"""
+        with self._lock:
+            for key in list(self._by_doc.get(doc_id, ())):
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_doc.clear()
+            self._by_context.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+    def _embed(self, text: str) -> Optional[List[float]]:
+        try:
+            return self.embed(text)
+        except Exception as e:
+            print(f"缓存向量计算失败: {e}")
+            return None
+
+    def _similar(self, context: str, vector: List[float], now: float) -> Optional[Dict]:
+        best, best_score = None, self.similarity
+        for key in self._by_context[context]:
+            entry = self._entries[key]
+            if entry['vector'] is None or entry['expires'] < now:
+                continue
+            score = sum(a * b for a, b in zip(vector, entry['vector']))
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry['size']
+        for doc_id in entry['doc_ids']:
+            keys = self._by_doc.get(doc_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_doc[doc_id]
+        keys = self._by_context.get(entry['context'])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_context[entry['context']]
@@ -0,0 +1,132 @@
+from typing import Dict, List, Optional, Set, Tuple
+from collections import Counter
+import re
+import math
+
+_SPLIT_RE = re.compile(r'[\W_]+')
+
+def char_ngrams(text: str, n: int = 2) -> List[str]:
+    """按空白和标点切分后生成字符n-gram（中文没有空格分词）"""
+    grams = []
+    for run in _SPLIT_RE.split(text.lower()):
+        if not run:
+            continue
+        if len(run) <= n:
+            grams.append(run)
+        else:
+            grams.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return grams
+
+def normalize_text(text: str) -> str:
+    """小写并去掉空白和标点"""
+    return ''.join(_SPLIT_RE.split(text.lower()))
+
+class NgramIndex:
+    """字符n-gram倒排索引 + BM25打分，只收录启用文档的知识块
+
+    知识块id为正文哈希，内容相同的知识块只收录一次：
+    postings: gram -> {知识块id: 词频}，文档频率即倒排表长度；
+    chunk_docs: 知识块id -> 引用它的文档id集合，最后一个引用移除时才删除倒排；
+    chunk_lengths: 知识块id -> gram总数，用于BM25长度归一化；
+    chunk_grams: 知识块id -> 其出现的gram，移除时据此删除倒排，无需正文。
+    持久化由KnowledgeStore负责。
+    """
+
+    def __init__(self, n: int = 2, k1: float = 1.5, b: float = 0.75):
+        self.n = n
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.chunk_docs: Dict[str, Set[str]] = {}
+        self.chunk_lengths: Dict[str, int] = {}
+        self.chunk_grams: Dict[str, Tuple[str, ...]] = {}
+        self.total_length = 0
+
+    def restore(self, chunk_docs: Dict[str, Set[str]], chunk_lengths: Dict[str, int], postings: Dict[str, Dict[str, int]]):
+        """从持久化存储恢复索引"""
+        self.chunk_docs = chunk_docs
+        self.chunk_lengths = chunk_lengths
+        self.total_length = sum(chunk_lengths.values())
+        self.postings = postings
+        grams: Dict[str, List[str]] = {}
+        for gram, tfs in postings.items():
+            for chunk_id in tfs:
+                grams.setdefault(chunk_id, []).append(gram)
+        self.chunk_grams = {chunk_id: tuple(chunk_grams) for chunk_id, chunk_grams in grams.items()}
+
+    def clear(self):
+        self.postings = {}
+        self.chunk_docs = {}
+        self.chunk_lengths = {}
+        self.chunk_grams = {}
+        self.total_length = 0
+
+    def add(self, chunk_id: str, doc_id: str, content: str) -> Optional[Dict[str, int]]:
+        """为文档收录一个知识块，返回其gram词频（已被其他文档收录时只登记引用，返回None）"""
+        docs = self.chunk_docs.get(chunk_id)
+        if docs is not None:
+            docs.add(doc_id)
+            return None
+        grams = char_ngrams(content, self.n)
+        tfs = Counter(grams)
+        self._insert(chunk_id, doc_id, len(grams), tfs)
+        return tfs
+
+    def add_postings(self, chunk_id: str, doc_id: str, length: int, tfs: Dict[str, int]):
+        """按已持久化的gram词频为文档收录知识块（其他worker写入的），已被收录时只登记引用"""
+        docs = self.chunk_docs.get(chunk_id)
+        if docs is not None:
+            docs.add(doc_id)
+            return
+        self._insert(chunk_id, doc_id, length, tfs)
+
+    def _insert(self, chunk_id: str, doc_id: str, length: int, tfs: Dict[str, int]):
+        self.chunk_docs[chunk_id] = {doc_id}
+        self.chunk_lengths[chunk_id] = length
+        self.chunk_grams[chunk_id] = tuple(tfs)
+        self.total_length += length
+        for gram, tf in tfs.items():
+            self.postings.setdefault(gram, {})[chunk_id] = tf
+
+    def remove(self, chunk_id: str, doc_id: str) -> bool:
+        """移除文档对知识块的引用，最后一个引用移除时删除倒排并返回True"""
+        docs = self.chunk_docs.get(chunk_id)
+        if docs is None:
+            return False
+        docs.discard(doc_id)
+        if docs:
+            return False
+        del self.chunk_docs[chunk_id]
+        self.total_length -= self.chunk_lengths.pop(chunk_id, 0)
+        for gram in self.chunk_grams.pop(chunk_id, ()):
+            tfs = self.postings.get(gram)
+            if tfs is None:
+                continue
+            tfs.pop(chunk_id, None)
+            if not tfs:
+                del self.postings[gram]
+        return True
+
+    def search(self, query: str) -> Dict[str, float]:
+        """BM25打分，只访问查询gram的倒排表"""
+        total = len(self.chunk_docs)
+        if not total:
+            return {}
+        avg_length = self.total_length / total or 1.0
+        scores: Dict[str, float] = {}
+        for gram in set(char_ngrams(query, self.n)):
+            tfs = self.postings.get(gram)
+            if not tfs:
+                continue
+            df = len(tfs)
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for chunk_id, tf in tfs.items():
+                norm = self.k1 * (1 - self.b + self.b * self.chunk_lengths[chunk_id] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self.chunk_docs
+
+    def __len__(self) -> int:
+        return len(self.chunk_docs)
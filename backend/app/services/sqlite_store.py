@@ -0,0 +1,53 @@
+from typing import Optional
+from contextlib import contextmanager
+import sqlite3
+import threading
+
+class SQLiteStore:
+    """SQLite(WAL)存储基类：连接、可嵌套事务、meta键值表
+
+    多个worker进程可同时打开同一数据库：写事务由SQLite串行化（等待写锁最多BUSY_TIMEOUT秒），
+    data_version()可判断其他连接是否提交过修改。
+    """
+
+    SCHEMA = ''
+    BUSY_TIMEOUT = 30.0
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        self._depth = 0
+        self.conn = sqlite3.connect(db_file, timeout=self.BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);' + self.SCHEMA)
+
+    @contextmanager
+    def transaction(self, mode: str = 'IMMEDIATE'):
+        """可嵌套的事务，最外层提交；mode='DEFERRED'用于需要一致快照的多条读取"""
+        with self._lock:
+            if self._depth == 0:
+                self.conn.execute(f'BEGIN {mode}')
+            self._depth += 1
+            try:
+                yield self.conn
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.conn.execute('ROLLBACK')
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self.conn.execute('COMMIT')
+
+    def data_version(self) -> int:
+        """其他连接（包括其他进程）提交修改后该值会变化，本连接的提交不影响"""
+        return self.conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, value))
@@ -0,0 +1,237 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from collections import deque
+import hashlib
+import os
+import re
+import threading
+import time
+from app.core.config import settings
+
+# 词条之间的分隔符
+_TERM_SPLIT_RE = re.compile(r'[\s,，、;；]+')
+# 否定词与症状之间出现这些字符时不再视为否定（已是另一分句）
+_CLAUSE_BREAK_RE = re.compile(r'[，。,.;；！？!?、\s]')
+NEGATION_HEADER = '否定词'
+
+class AhoCorasick:
+    """Aho-Corasick多模式匹配自动机：一次扫描找出文本中所有词条的出现位置，耗时与词条数无关"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+        for pattern in dict.fromkeys(p for p in patterns if p):
+            self._insert(pattern)
+        self._link()
+
+    def _insert(self, pattern: str):
+        node = 0
+        for char in pattern:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = nxt
+        self._output[node].append(len(self.patterns))
+        self.patterns.append(pattern)
+
+    def _link(self):
+        # 广度优先计算失败指针，并把失败指针所指节点的输出并入当前节点
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, int, str]]:
+        """逐个产出 (start, end, 词条)，包括相互重叠的匹配"""
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for index in self._output[node]:
+                pattern = self.patterns[index]
+                yield position + 1 - len(pattern), position + 1, pattern
+
+def parse_lexicon(lines: Iterable[str], synonyms: Dict[str, str], negations: Dict[str, None]):
+    """解析词表文本，结果并入synonyms(词条 -> 标准名)和negations
+
+    每行“标准名: 同义词, 同义词”，标准名本身也是词条；没有冒号的行每个词条各自为标准名；
+    “否定词: 不, 没有”行列出否定词；#开头为注释。
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        name, sep, rest = line.replace('：', ':').partition(':')
+        name = name.strip()
+        if not sep:
+            for term in _TERM_SPLIT_RE.split(line):
+                if term:
+                    synonyms.setdefault(term, term)
+            continue
+        terms = [term for term in _TERM_SPLIT_RE.split(rest) if term]
+        if name == NEGATION_HEADER:
+            negations.update(dict.fromkeys(terms))
+            continue
+        for term in [name] + terms:
+            synonyms[term] = name
+
+class CompiledLexicon:
+    """编译好的词表：症状词条和否定词放在同一个自动机中，一次扫描得到全部匹配"""
+
+    def __init__(self, synonyms: Dict[str, str], negations: Iterable[str], negation_window: int = 2):
+        self.synonyms = synonyms
+        self.negations = set(negations)
+        self.negation_window = negation_window
+        self.matcher = AhoCorasick(list(synonyms) + sorted(self.negations))
+        payload = repr((sorted(synonyms.items()), sorted(self.negations), negation_window))
+        self.version = hashlib.blake2b(payload.encode('utf-8'), digest_size=8).hexdigest()
+
+    def match(self, text: str) -> List[Dict]:
+        """文本中全部症状词条的出现：{'term', 'symptom'(标准名), 'start', 'end', 'negated'}"""
+        cues, matches = [], []
+        for start, end, term in self.matcher.finditer(text):
+            if term in self.negations:
+                cues.append((start, end))
+            if term in self.synonyms:
+                matches.append({'term': term, 'symptom': self.synonyms[term], 'start': start, 'end': end, 'negated': False})
+        # 落在症状词条内部的否定词（如“无汗”的“无”、“没有汗”的“没有”）是词条的一部分，不否定后面的症状
+        cues = [cue for cue in cues if not any(m['start'] <= cue[0] and cue[1] <= m['end'] for m in matches)]
+        for match in matches:
+            match['negated'] = any(self._negates(text, cue, match['start']) for cue in cues)
+        return matches
+
+    def _negates(self, text: str, cue: Tuple[int, int], start: int) -> bool:
+        # 否定词须在症状之前（可与症状首字重叠，如“没有汗”），中间不超过negation_window个字且不跨分句
+        cue_start, cue_end = cue
+        if cue_start >= start or start - cue_end > self.negation_window:
+            return False
+        return not _CLAUSE_BREAK_RE.search(text, cue_end, max(cue_end, start))
+
+    def extract(self, text: str) -> List[str]:
+        """文本中出现且未被否定的症状标准名，按首次出现顺序去重；被更长匹配包含的匹配忽略"""
+        matches = self.match(text)
+        symptoms = {}
+        for match in matches:
+            if match['negated'] or any(other is not match and other['start'] <= match['start'] and match['end'] <= other['end'] and other['end'] - other['start'] > match['end'] - match['start'] for other in matches):
+                continue
+            symptoms[match['symptom']] = None
+        return list(symptoms)
+
+class SymptomLexicon:
+    """症状词表：来自词表文件（SYMPTOM_LEXICON_FILE，不存在时使用内置SYMPTOM_KEYWORDS）
+    和知识库中SYMPTOM_LEXICON_CATEGORY类别下的文档，两者格式相同。
+
+    编译结果整体替换；每隔SYMPTOM_LEXICON_RELOAD_INTERVAL秒检查一次文件修改时间和知识库类别，
+    有变化时重新编译，无需重启进程。检查在后台线程中进行（需要加知识库锁，调用方可能在事件循环上），
+    期间继续使用当前版本；只有首次加载在调用线程中同步完成。
+    """
+
+    def __init__(self):
+        self._compiled: Optional[CompiledLexicon] = None
+        self._signature = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> str:
+        return self.current().version
+
+    def current(self) -> CompiledLexicon:
+        compiled = self._compiled
+        if compiled is None:
+            with self._lock:
+                if self._compiled is None:
+                    self._reload_if_changed()
+            return self._compiled
+        if time.monotonic() - self._checked >= settings.SYMPTOM_LEXICON_RELOAD_INTERVAL and self._lock.acquire(blocking=False):
+            try:
+                # 先记下检查时间，间隔内不会重复启动后台检查
+                self._checked = time.monotonic()
+            finally:
+                self._lock.release()
+            threading.Thread(target=self._refresh, daemon=True).start()
+        return compiled
+
+    def _refresh(self):
+        with self._lock:
+            try:
+                self._reload_if_changed()
+            except Exception as e:
+                print(f"症状词表检查失败: {e}")
+
+    def reload(self) -> CompiledLexicon:
+        """立即重新加载"""
+        with self._lock:
+            self._signature = None
+            self._reload_if_changed()
+        return self._compiled
+
+    def _reload_if_changed(self):
+        self._checked = time.monotonic()
+        signature = self._source_signature()
+        if self._compiled is not None and signature == self._signature:
+            return
+        try:
+            compiled = self._compile()
+        except Exception as e:
+            # 词表有误时保留当前版本
+            print(f"症状词表加载失败: {e}")
+            if self._compiled is not None:
+                return
+            compiled = CompiledLexicon({term: term for term in settings.SYMPTOM_KEYWORDS}, settings.SYMPTOM_NEGATIONS, settings.SYMPTOM_NEGATION_WINDOW)
+        if self._compiled is not None and compiled.version != self._compiled.version:
+            print(f"症状词表已更新: {len(compiled.synonyms)}个词条")
+        self._compiled = compiled
+        self._signature = signature
+
+    def _source_signature(self) -> Tuple:
+        path = settings.SYMPTOM_LEXICON_FILE
+        try:
+            stat = os.stat(path)
+            file_signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            file_signature = None
+        return file_signature, self._category_version()
+
+    @staticmethod
+    def _category_version() -> Tuple:
+        if not settings.SYMPTOM_LEXICON_CATEGORY:
+            return ()
+        # 延迟导入，避免对话服务在导入时加载知识库
+        from app.services.rag_service import rag_service
+        return rag_service.category_version(settings.SYMPTOM_LEXICON_CATEGORY)
+
+    def _compile(self) -> CompiledLexicon:
+        synonyms: Dict[str, str] = {}
+        negations: Dict[str, None] = dict.fromkeys(settings.SYMPTOM_NEGATIONS)
+        if os.path.exists(settings.SYMPTOM_LEXICON_FILE):
+            with open(settings.SYMPTOM_LEXICON_FILE, 'r', encoding='utf-8') as f:
+                parse_lexicon(f, synonyms, negations)
+        else:
+            parse_lexicon(settings.SYMPTOM_KEYWORDS, synonyms, negations)
+        if settings.SYMPTOM_LEXICON_CATEGORY:
+            from app.services.rag_service import rag_service
+            for text in rag_service.category_texts(settings.SYMPTOM_LEXICON_CATEGORY):
+                parse_lexicon(text.splitlines(), synonyms, negations)
+        return CompiledLexicon(synonyms, negations, settings.SYMPTOM_NEGATION_WINDOW)
+
+    def match(self, text: str) -> List[Dict]:
+        return self.current().match(text)
+
+    def extract(self, text: str) -> List[str]:
+        """文本中出现且未被否定的症状（标准名），按首次出现顺序"""
+        return self.current().extract(text)
+
+symptom_lexicon = SymptomLexicon()
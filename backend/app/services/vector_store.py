@@ -0,0 +1,390 @@
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import os
+import json
+import zlib
+import numpy as np
+from zhipuai import ZhipuAI
+from app.core.config import settings
+from app.services.file_lock import FileLock
+from app.services.search_index import char_ngrams
+
+class HashingEmbedder:
+    """本地CPU嵌入：字符unigram/bigram特征哈希，无需下载模型"""
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f'hashing-{dim}'
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for gram in char_ngrams(text, 1) + char_ngrams(text, 2):
+                h = zlib.crc32(gram.encode('utf-8'))
+                matrix[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return matrix
+
+class ZhipuEmbedder:
+    """智谱AI嵌入接口"""
+
+    def __init__(self, model: str, batch_size: int = 16):
+        if not settings.ZHIPUAI_API_KEY:
+            raise ValueError('未配置ZHIPUAI_API_KEY')
+        self.client = ZhipuAI(api_key=settings.ZHIPUAI_API_KEY)
+        self.model = model
+        self.batch_size = batch_size
+        self.name = f'zhipuai-{model}'
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            response = self.client.embeddings.create(model=self.model, input=list(texts[i:i + self.batch_size]))
+            vectors.extend(item.embedding for item in response.data)
+        return np.asarray(vectors, dtype=np.float32)
+
+def create_embedder():
+    if settings.EMBEDDING_PROVIDER == 'zhipuai':
+        return ZhipuEmbedder(settings.EMBEDDING_MODEL)
+    return HashingEmbedder(settings.EMBEDDING_DIM)
+
+class VectorStore:
+    """向量索引：行向量已L2归一化的float32矩阵，只追加写入文件并以内存映射方式加载
+
+    文件（同一代共用代号gen）：
+      <collection>.json       {'embedder', 'dim', 'generation'}，只在压缩时整体替换；
+      <collection>.<gen>.f32  行向量，按行追加；
+      <collection>.<gen>.ids  每行一个知识块id，与向量逐行对应，空行为保存前已删除的行；
+      <collection>.<gen>.del  删除标记，每行一个行号。
+    每次保存只追加新增的行和删除标记，删除的行累计超过一半时才压缩为新一代文件。
+    ids[row]为该行对应的知识块id，已删除的行为None。
+    多个worker共用同一份文件：修改前持有lock（排他）并refresh()，保存后其他worker
+    发现文件变化即增量读取新追加的部分；读取文件时持有共享锁，不会读到写了一半的行。
+    """
+
+    def __init__(self, persist_dir: str, collection: str, embedder):
+        os.makedirs(persist_dir, exist_ok=True)
+        self.persist_dir = persist_dir
+        self.collection = collection
+        self.meta_file = os.path.join(persist_dir, f'{collection}.json')
+        # 旧版整体保存的.npy，首次保存时迁移
+        self.legacy_matrix_file = os.path.join(persist_dir, f'{collection}.npy')
+        self.embedder = embedder
+        self.matrix: Optional[np.ndarray] = None
+        self.pending: Optional[np.ndarray] = None
+        self.ids: List[Optional[str]] = []
+        self.rows: Dict[str, int] = {}
+        self.dim: Optional[int] = None
+        # 当前一代的代号和元数据中记录的维度；None表示还没有新格式的文件
+        self.generation: Optional[int] = None
+        self._meta_dim: Optional[int] = None
+        self._deleted: List[int] = []
+        self._dead = 0
+        # 已读取（或已写入）的文件字节数，refresh时只读取其后追加的部分
+        self._ids_size = 0
+        self._del_size = 0
+        self.lock = FileLock(os.path.join(persist_dir, f'{collection}.lock'))
+        self._version = None
+        self.refresh()
+
+    @property
+    def dirty(self) -> bool:
+        return self.pending is not None or bool(self._deleted)
+
+    def _path(self, suffix: str, generation: Optional[int] = None) -> str:
+        generation = self.generation if generation is None else generation
+        return os.path.join(self.persist_dir, f'{self.collection}.{generation}.{suffix}')
+
+    def _file_version(self) -> Optional[Tuple]:
+        # 压缩时整体替换元数据文件；同一代内追加写入，ids/del文件大小变化即说明其他worker保存过
+        try:
+            stat = os.stat(self.meta_file)
+        except OSError:
+            return None
+        sizes = []
+        if self.generation is not None:
+            for suffix in ('ids', 'del'):
+                try:
+                    sizes.append(os.path.getsize(self._path(suffix)))
+                except OSError:
+                    sizes.append(None)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size, *sizes)
+
+    def refresh(self, lock: bool = True, blocking: bool = True) -> bool:
+        """文件被其他worker更新过时重新加载（同一代内只读取追加的部分），未保存的修改丢弃；
+        已持有lock时传lock=False，blocking=False时有写入方持有lock则跳过本次刷新"""
+        if self._file_version() == self._version:
+            return False
+        if not lock:
+            return self._load()
+        with self.lock.hold(shared=True, blocking=blocking) as locked:
+            return self._load() if locked else False
+
+    def discard(self):
+        """丢弃未保存的修改（修改所在的事务回滚时调用），需持有lock"""
+        self._reset(None, None)
+        self._version = None
+        self._load()
+
+    def _load(self) -> bool:
+        try:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get('embedder') != self.embedder.name:
+            return False
+        if 'ids' in meta:
+            return self._load_legacy(meta)
+        generation = meta['generation']
+        if generation != self.generation or self.dirty:
+            self._reset(generation, meta.get('dim'))
+        try:
+            self._read_ids()
+            self._read_deleted()
+            self._map()
+        except (OSError, ValueError):
+            self._reset(None, None)
+            return False
+        self._version = self._file_version()
+        return True
+
+    def _load_legacy(self, meta: Dict) -> bool:
+        """旧版格式（整体保存的.npy + 元数据中的ids）：内存映射读取，下次保存时写成新格式"""
+        try:
+            matrix = np.load(self.legacy_matrix_file, mmap_mode='r')
+        except (OSError, ValueError):
+            return False
+        if matrix.shape[0] != len(meta['ids']):
+            return False
+        self._reset(None, matrix.shape[1] if matrix.shape[0] else None)
+        self.matrix = matrix if matrix.shape[0] else None
+        self.ids = list(meta['ids'])
+        self.rows = {chunk_id: row for row, chunk_id in enumerate(self.ids) if chunk_id is not None}
+        self._dead = len(self.ids) - len(self.rows)
+        self._version = self._file_version()
+        return True
+
+    def _reset(self, generation: Optional[int], dim: Optional[int]):
+        self.generation = generation
+        self.dim = dim
+        self._meta_dim = dim
+        # 整体替换，检索中的线程仍使用旧的矩阵和ids
+        self.matrix = None
+        self.pending = None
+        self.ids = []
+        self.rows = {}
+        self._deleted = []
+        self._dead = 0
+        self._ids_size = 0
+        self._del_size = 0
+
+    @staticmethod
+    def _read_lines(path: str, offset: int) -> Tuple[List[str], int]:
+        """读取offset之后完整的行（写了一半的行留到下次），返回(行, 新的offset)"""
+        if not os.path.exists(path):
+            return [], offset
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        return data[:end].decode('utf-8').splitlines(), offset + end
+
+    def _read_ids(self):
+        lines, self._ids_size = self._read_lines(self._path('ids'), self._ids_size)
+        for chunk_id in lines:
+            row = len(self.ids)
+            if chunk_id:
+                self.ids.append(chunk_id)
+                self.rows[chunk_id] = row
+            else:
+                self.ids.append(None)
+                self._dead += 1
+
+    def _read_deleted(self):
+        lines, self._del_size = self._read_lines(self._path('del'), self._del_size)
+        for line in lines:
+            row = int(line)
+            chunk_id = self.ids[row] if row < len(self.ids) else None
+            if chunk_id is not None:
+                self.ids[row] = None
+                self.rows.pop(chunk_id, None)
+                self._dead += 1
+
+    def _map(self):
+        if not self.ids:
+            self.matrix = None
+            return
+        self.matrix = np.memmap(self._path('f32'), dtype=np.float32, mode='r', shape=(len(self.ids), self.dim))
+
+    def save(self):
+        """保存未保存的修改：追加新行和删除标记；删除的行超过一半或仍为旧版格式时压缩为新一代文件。需持有lock"""
+        if not self.dirty and (self.generation is not None or not self.ids):
+            return
+        # 元数据中还没有维度（空索引首次收录）时同样重写一代，保证其他worker能按维度映射文件
+        if self.generation is None or self._meta_dim != self.dim or self._dead > len(self.ids) / 2:
+            self._compact()
+        else:
+            self._append()
+        self._version = self._file_version()
+
+    def _append(self):
+        persisted = len(self.ids) - (len(self.pending) if self.pending is not None else 0)
+        if self.pending is not None:
+            # 先截掉上次写入中断留下的残余，再追加向量，最后追加ids（ids为准，决定有效行数）
+            with open(self._path('f32'), 'ab') as f:
+                f.truncate(persisted * self.dim * 4)
+                f.write(np.ascontiguousarray(self.pending, dtype=np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._ids_size = self._append_lines(self._path('ids'), self._ids_size, [chunk_id or '' for chunk_id in self.ids[persisted:]])
+            self.pending = None
+        if self._deleted:
+            self._del_size = self._append_lines(self._path('del'), self._del_size, [str(row) for row in self._deleted])
+            self._deleted = []
+        self._map()
+
+    @staticmethod
+    def _append_lines(path: str, offset: int, lines: List[str]) -> int:
+        with open(path, 'ab') as f:
+            f.truncate(offset)
+            f.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            return f.tell()
+
+    def _compact(self):
+        """只保留存活的行写入下一代文件，替换元数据后删除上一代（已映射旧文件的worker仍可读到重新加载为止）"""
+        old_generation = self.generation
+        generation = (old_generation + 1) if old_generation is not None else self._next_generation()
+        live = [row for row, chunk_id in enumerate(self.ids) if chunk_id is not None]
+        persisted = self.matrix if self.matrix is not None else np.zeros((0, self.dim or 0), dtype=np.float32)
+        with open(self._path('f32', generation), 'wb') as f:
+            for start in range(0, len(live), 4096):
+                batch = live[start:start + 4096]
+                vectors = [persisted[row] if row < len(persisted) else self.pending[row - len(persisted)] for row in batch]
+                f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        ids = [self.ids[row] for row in live]
+        ids_size = self._append_lines(self._path('ids', generation), 0, ids)
+        self._append_lines(self._path('del', generation), 0, [])
+        tmp_file = self.meta_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({'embedder': self.embedder.name, 'dim': self.dim, 'generation': generation}, f)
+        os.replace(tmp_file, self.meta_file)
+        for suffix in ('f32', 'ids', 'del'):
+            if old_generation is not None and os.path.exists(self._path(suffix, old_generation)):
+                os.remove(self._path(suffix, old_generation))
+        if os.path.exists(self.legacy_matrix_file):
+            os.remove(self.legacy_matrix_file)
+        self.generation = generation
+        self._meta_dim = self.dim
+        self.pending = None
+        self._deleted = []
+        self._dead = 0
+        self.ids = ids
+        self.rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+        self._ids_size = ids_size
+        self._del_size = 0
+        self._map()
+
+    def _next_generation(self) -> int:
+        # 没有已加载的一代时（新建或迁移旧版），跳过目录中残留的文件
+        generation = 0
+        while os.path.exists(self._path('ids', generation)):
+            generation += 1
+        return generation
+
+    def embed(self, items: Sequence[Tuple[str, str]]) -> Dict[str, np.ndarray]:
+        """嵌入(知识块id, 文本)并L2归一化，返回id -> 向量，不修改索引（可在不持锁时调用）"""
+        texts = dict(items)
+        if not texts:
+            return {}
+        vectors = self.embedder.embed(list(texts.values()))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1.0, norms)
+        return dict(zip(texts, vectors))
+
+    def add(self, items: Sequence[Tuple[str, str]], vectors: Optional[Dict[str, np.ndarray]] = None):
+        """收录(知识块id, 文本)，已收录或重复的id跳过；vectors为embed()预先嵌入的向量，缺少的在此嵌入"""
+        items = list({chunk_id: text for chunk_id, text in items if chunk_id not in self.rows}.items())
+        if not items:
+            return
+        vectors = dict(vectors or {})
+        vectors.update(self.embed([(chunk_id, text) for chunk_id, text in items if chunk_id not in vectors]))
+        vectors = np.stack([vectors[chunk_id] for chunk_id, _ in items]).astype(np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        # 新行先留在内存中，保存时追加到文件
+        self.pending = vectors if self.pending is None else np.vstack([self.pending, vectors])
+        start = len(self.ids)
+        for offset, (chunk_id, _) in enumerate(items):
+            self.ids.append(chunk_id)
+            self.rows[chunk_id] = start + offset
+
+    def remove(self, chunk_ids: Sequence[str]):
+        persisted = len(self.ids) - (len(self.pending) if self.pending is not None else 0)
+        for chunk_id in chunk_ids:
+            row = self.rows.pop(chunk_id, None)
+            if row is not None:
+                self.ids[row] = None
+                self._dead += 1
+                # 尚未保存的行保存时写为空行，无需删除标记
+                if row < persisted:
+                    self._deleted.append(row)
+
+    def sync(self, chunk_ids: Iterable[str], text_of: Callable[[str], str], batch_size: int = 256):
+        """与知识库对齐：补嵌入缺失的知识块（按需读取正文，分批嵌入），删除多余的行"""
+        wanted = set(chunk_ids)
+        self.remove([chunk_id for chunk_id in self.rows if chunk_id not in wanted])
+        missing = [chunk_id for chunk_id in wanted if chunk_id not in self.rows]
+        for start in range(0, len(missing), batch_size):
+            self.add([(chunk_id, text_of(chunk_id)) for chunk_id in missing[start:start + batch_size]])
+
+    def embed_query(self, text: str) -> Optional[np.ndarray]:
+        """嵌入查询并L2归一化，零向量返回None"""
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """批量嵌入查询（一次嵌入调用），逐条L2归一化，零向量为None"""
+        if not texts:
+            return []
+        vectors = []
+        for vector in self.embedder.embed(list(texts)):
+            norm = np.linalg.norm(vector)
+            vectors.append(vector / norm if norm else None)
+        return vectors
+
+    def search(self, query: str, k: int, accept: Callable[[str], bool], min_score: float = 0.0, vector: Optional[np.ndarray] = None) -> List[Tuple[str, float]]:
+        """余弦相似度top-k，accept过滤禁用文档/其他类别的知识块；vector为已嵌入的查询向量（批量检索时传入）"""
+        matrix, pending, ids = self.matrix, self.pending, self.ids
+        if not self.rows or k <= 0:
+            return []
+        if vector is None:
+            vector = self.embed_query(query)
+        if vector is None:
+            return []
+        parts = [np.asarray(m @ vector) for m in (matrix, pending) if m is not None]
+        scores = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        total = scores.shape[0]
+        width = min(total, max(k * 4, 32))
+        while True:
+            if width < total:
+                top = np.argpartition(-scores, width - 1)[:width]
+                top = top[np.argsort(-scores[top])]
+            else:
+                top = np.argsort(-scores)
+            results = []
+            for row in top:
+                if scores[row] <= min_score:
+                    return results
+                chunk_id = ids[row]
+                if chunk_id is not None and accept(chunk_id):
+                    results.append((chunk_id, float(scores[row])))
+                    if len(results) == k:
+                        return results
+            if width >= total:
+                return results
+            width = min(total, width * 4)
+
+    def __len__(self) -> int:
+        return len(self.rows)
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# 服务模块导入时即在./data下创建数据库：测试在临时目录中运行，不触碰backend/data
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.chdir(tempfile.mkdtemp(prefix='tcm-tests-'))
@@ -0,0 +1,56 @@
+import pytest
+from app.services.conversation_service import ConversationService
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    service = ConversationService()
+    for i in range(7):
+        service.create_conversation(f'对话{i}')
+    return service
+
+def _pages(service, limit, summary=True):
+    pages, cursor = [], None
+    while True:
+        page = service.list_conversation_page(limit=limit, cursor=cursor, summary=summary)
+        pages.append(page['items'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            return pages
+
+def test_pages_cover_every_conversation_once_newest_first(service):
+    pages = _pages(service, 3)
+    assert [len(page) for page in pages] == [3, 3, 1]
+    ids = [item['id'] for page in pages for item in page]
+    assert ids == [conv['id'] for conv in service.list_conversations()]
+    assert len(set(ids)) == 7
+
+def test_exact_multiple_has_no_empty_trailing_page(service):
+    service.create_conversation('对话7')
+    assert [len(page) for page in _pages(service, 4)] == [4, 4]
+
+def test_updated_conversation_moves_to_first_page(service):
+    oldest = service.list_conversations()[-1]
+    service.add_message(oldest['id'], 'user', '头痛发热' * 20)
+    first = service.list_conversation_page(limit=2)['items'][0]
+    assert first['id'] == oldest['id']
+    assert first['message_count'] == 1
+    assert first['last_message'] == ('头痛发热' * 20)[:50] + '...'
+    assert set(first) == {'id', 'title', 'updated_at', 'message_count', 'last_message'}
+
+def test_full_items_without_summary(service):
+    item = service.list_conversation_page(limit=1, summary=False)['items'][0]
+    assert 'messages' in item
+
+def test_cursor_survives_deleting_the_boundary_conversation(service):
+    page = service.list_conversation_page(limit=3)
+    service.delete_conversation(page['items'][-1]['id'])
+    rest = service.list_conversation_page(limit=10, cursor=page['next_cursor'])
+    expected = [conv['id'] for conv in service.list_conversations()][2:]
+    assert [item['id'] for item in rest['items']] == expected
+    assert rest['next_cursor'] is None
+
+@pytest.mark.parametrize('cursor', ['not-base64!', 'bm90IGpzb24=', 'WzFd'])
+def test_invalid_cursor(service, cursor):
+    with pytest.raises(ValueError, match='无效的分页游标'):
+        service.list_conversation_page(cursor=cursor)
@@ -0,0 +1,54 @@
+import io
+import tarfile
+import zipfile
+import pytest
+from app.core.config import settings
+from app.services.ingest_service import extract_archive
+
+def _zip(path, members):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+
+def _tar(path, members):
+    with tarfile.open(path, 'w:gz') as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+@pytest.fixture(params=[('a.zip', _zip), ('a.tar.gz', _tar)], ids=['zip', 'tar'])
+def archive(request, tmp_path):
+    filename, write = request.param
+    def build(members):
+        path = tmp_path / filename
+        write(str(path), members)
+        return str(path)
+    return build
+
+def test_extracts_safe_members(archive, tmp_path):
+    path = archive({'伤寒论/太阳病.txt': '太阳之为病'.encode('utf-8'), '../escape.txt': b'x', '.hidden': b'x'})
+    files = extract_archive(path, str(tmp_path / 'out'))
+    assert [name for _, name in files] == ['伤寒论/太阳病.txt']
+    with open(files[0][0], encoding='utf-8') as f:
+        assert f.read() == '太阳之为病'
+
+def test_rejects_too_many_members(archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_ARCHIVE_FILES', 3)
+    path = archive({f'{i}.txt': b'x' for i in range(4)})
+    with pytest.raises(ValueError, match='文件数'):
+        extract_archive(path, str(tmp_path / 'out'))
+
+def test_rejects_uncompressed_total_over_limit(archive, tmp_path, monkeypatch):
+    # 每个文件都在单文件上限内，累计解压大小超限
+    monkeypatch.setattr(settings, 'MAX_ARCHIVE_UNCOMPRESSED_SIZE', 1000)
+    monkeypatch.setattr(settings, 'UPLOAD_CHUNK_SIZE', 64)
+    path = archive({f'{i}.txt': b'0' * 400 for i in range(3)})
+    with pytest.raises(ValueError, match='总大小'):
+        extract_archive(path, str(tmp_path / 'out'))
+
+def test_rejects_oversized_member(archive, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'MAX_FILE_SIZE', 100)
+    path = archive({'big.txt': b'0' * 101})
+    with pytest.raises(ValueError, match='大小限制'):
+        extract_archive(path, str(tmp_path / 'out'))
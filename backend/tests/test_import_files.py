@@ -0,0 +1,40 @@
+import asyncio
+from app.core.config import settings
+from app.services.ingest_service import ingest_service
+from app.services.rag_service import rag_service
+
+def test_import_files_bounds_concurrency_and_commits_batches_as_they_fill(monkeypatch):
+    monkeypatch.setattr(settings, 'INGEST_WORKERS', 2)
+    monkeypatch.setattr(settings, 'IMPORT_COMMIT_BATCH', 2)
+    monkeypatch.setattr(rag_service, 'get_category', lambda category_id: {'id': category_id})
+    state = {'running': 0, 'peak': 0, 'prepared': 0}
+    commits = []
+
+    async def prepare(path, name, category_id, creator):
+        state['running'] += 1
+        state['peak'] = max(state['peak'], state['running'])
+        # 后面的文件先完成，结果仍按输入顺序返回
+        await asyncio.sleep(0.01 * (10 - int(name[0])))
+        state['running'] -= 1
+        state['prepared'] += 1
+        if name.startswith('3'):
+            return {'filename': name, 'status': 'failed', 'doc_id': None, 'chunk_count': 0, 'error': '不支持的文件格式'}
+        return {'filename': name, 'status': 'done', 'doc_id': None, 'chunk_count': 0, 'error': None, 'item': {'filename': name}}
+
+    def add_documents(items):
+        commits.append(([item['filename'] for item in items], state['prepared']))
+        return [{'id': f"doc-{item['filename']}", 'chunk_count': 1} for item in items]
+
+    monkeypatch.setattr(ingest_service, '_prepare', prepare)
+    monkeypatch.setattr(rag_service, 'add_documents', add_documents)
+    files = [(f'/tmp/{i}.txt', f'{i}.txt') for i in range(7)]
+    report = asyncio.run(ingest_service.import_files(files, 'cat'))
+
+    assert state['peak'] == 2
+    assert [result['filename'] for result in report['files']] == [name for _, name in files]
+    assert (report['total'], report['succeeded'], report['failed']) == (7, 6, 1)
+    assert all('item' not in result for result in report['files'])
+    assert report['files'][0]['doc_id'] == 'doc-0.txt'
+    assert [len(names) for names, _ in commits] == [2, 2, 2]
+    # 第一批在全部文件解析完成之前就已提交
+    assert commits[0][1] < len(files)
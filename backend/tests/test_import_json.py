@@ -0,0 +1,62 @@
+import json
+import threading
+from app.services.conversation_store import ConversationStore
+from app.services.kb_store import KnowledgeStore
+
+def _write_conversations(path, count=20, messages=5):
+    conversations = [{
+        'id': f'conv-{i}', 'title': f'对话{i}', 'created_at': '2024-01-01T00:00:00', 'updated_at': f'2024-01-01T00:00:{i:02d}',
+        'messages': [{'role': 'user', 'content': f'消息{j}', 'timestamp': '2024-01-01T00:00:00', 'sources': []} for j in range(messages)]
+    } for i in range(count)]
+    path.write_text(json.dumps({'conversations': conversations}, ensure_ascii=False), encoding='utf-8')
+
+def _message_count(store):
+    return store.conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+def test_conversation_import_runs_once(tmp_path):
+    json_file = tmp_path / 'conversations.json'
+    _write_conversations(json_file)
+    store = ConversationStore(str(tmp_path / 'conversations.db'))
+    assert store.import_json(str(json_file))
+    assert not store.import_json(str(json_file))
+    assert _message_count(store) == 100
+    assert not ConversationStore(str(tmp_path / 'conversations.db')).import_json(str(json_file))
+
+def test_concurrent_conversation_import_runs_once(tmp_path):
+    # 模拟多个worker同时启动：各自的连接同时检查并导入
+    json_file = tmp_path / 'conversations.json'
+    _write_conversations(json_file, count=50, messages=20)
+    db_file = str(tmp_path / 'conversations.db')
+    stores = [ConversationStore(db_file) for _ in range(4)]
+    barrier = threading.Barrier(len(stores))
+    results = []
+
+    def run(store):
+        barrier.wait()
+        results.append(store.import_json(str(json_file)))
+
+    threads = [threading.Thread(target=run, args=(store,)) for store in stores]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, False, False, True]
+    assert _message_count(stores[0]) == 50 * 20
+
+def test_knowledge_import_runs_once(tmp_path):
+    json_file = tmp_path / 'knowledge_base.json'
+    json_file.write_text(json.dumps({
+        'categories': [{'id': 'cat', 'name': '伤寒论', 'creator': 'admin', 'created_at': '2024-01-01T00:00:00'}],
+        'documents': [{
+            'id': 'doc', 'filename': 'a.txt', 'original_filename': 'a.txt', 'type': 'txt', 'size': 1, 'category_id': 'cat',
+            'status': 'enabled', 'creator': 'admin', 'created_at': '2024-01-01T00:00:00', 'updated_at': '2024-01-01T00:00:00',
+            'chunks': [{'content': '太阳之为病，脉浮，头项强痛而恶寒。', 'index': 0}, {'content': '太阳病，发热，汗出，恶风，脉缓者，名为中风。', 'index': 1}]
+        }]
+    }, ensure_ascii=False), encoding='utf-8')
+    store = KnowledgeStore(str(tmp_path / 'knowledge_base.db'))
+    assert store.import_json(str(json_file))
+    assert not store.import_json(str(json_file))
+    categories, documents = store.load()
+    assert [c['id'] for c in categories] == ['cat']
+    assert [(d.id, d.chunk_count) for d in documents] == [('doc', 2)]
+    assert store.count_chunks() == 2
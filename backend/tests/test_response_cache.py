@@ -0,0 +1,25 @@
+import asyncio
+import threading
+from app.services.llm_service import llm_service
+from app.services.response_cache import ResponseCache
+
+def test_similarity_embedding_runs_off_event_loop(monkeypatch):
+    loop_threads = []
+
+    def embed(text):
+        # 远程嵌入调用不应在事件循环线程上执行
+        loop_threads.append(threading.current_thread() is threading.main_thread())
+        return [1.0, 0.0] if '头痛' in text else [0.0, 1.0]
+
+    cache = ResponseCache(ttl=60, max_entries=10, max_bytes=1 << 20, similarity=0.9, embed=embed)
+    monkeypatch.setattr(llm_service, 'cache', cache)
+    context = {'cache_key': 'ctx', 'message': '头痛怎么办', 'relevant_docs': [{'metadata': {'doc_id': 'doc'}}]}
+
+    async def run():
+        assert await llm_service._acached_response(context) is None
+        await llm_service._acache_response(context, '请问有汗吗')
+        return await llm_service._acached_response({**context, 'message': '头痛如何处理'})
+
+    assert asyncio.run(run()) == '请问有汗吗'
+    assert cache.semantic_hits == 1
+    assert loop_threads and not any(loop_threads)
@@ -0,0 +1,74 @@
+import pytest
+from app.services.search_index import NgramIndex, char_ngrams, normalize_text
+
+TAIYANG = '太阳之为病，脉浮，头项强痛而恶寒。'
+ZHONGFENG = '太阳病，发热，汗出，恶风，脉缓者，名为中风。'
+SHANGHAN = '太阳病，或已发热，或未发热，必恶寒，体痛，呕逆，脉阴阳俱紧者，名为伤寒。'
+
+@pytest.fixture
+def index():
+    index = NgramIndex()
+    index.add('c1', 'd1', TAIYANG)
+    index.add('c2', 'd1', ZHONGFENG)
+    index.add('c3', 'd2', SHANGHAN)
+    return index
+
+def test_char_ngrams_split_on_punctuation():
+    assert char_ngrams('头痛，恶寒') == ['头痛', '恶寒']
+    assert char_ngrams('发热汗出') == ['发热', '热汗', '汗出']
+    assert char_ngrams('汗') == ['汗']
+    assert normalize_text('头痛， 恶寒！') == '头痛恶寒'
+
+def test_search_ranks_matching_chunks(index):
+    scores = index.search('汗出恶风')
+    assert max(scores, key=scores.get) == 'c2'
+    assert 'c1' not in scores
+    assert index.search('麻黄汤') == {}
+    assert set(index.search('恶寒')) == {'c1', 'c3'}
+
+def test_add_returns_term_frequencies(index):
+    tfs = index.add('c4', 'd3', '发热发热')
+    assert tfs == {'发热': 2, '热发': 1}
+    assert index.chunk_lengths['c4'] == 3
+    assert set(index.chunk_grams['c4']) == {'发热', '热发'}
+
+def test_shared_chunk_removed_with_last_reference(index):
+    # 内容相同的知识块只收录一次，最后一个引用移除时才删除倒排
+    assert index.add('c2', 'd3', ZHONGFENG) is None
+    assert index.chunk_docs['c2'] == {'d1', 'd3'}
+    total_length = index.total_length
+    assert index.remove('c2', 'd1') is False
+    assert 'c2' in index.search('中风')
+    assert index.remove('c2', 'd3') is True
+    assert 'c2' not in index
+    assert '中风' not in index.postings
+    assert index.total_length == total_length - len(char_ngrams(ZHONGFENG))
+    assert index.remove('c2', 'd3') is False
+
+def test_remove_keeps_other_chunks_postings(index):
+    index.remove('c1', 'd1')
+    assert 'c1' not in index.postings['恶寒']
+    assert set(index.search('恶寒')) == {'c3'}
+    assert len(index) == 2
+
+def test_add_postings_and_restore_match_add(index):
+    other = NgramIndex()
+    for chunk_id, docs in index.chunk_docs.items():
+        tfs = {gram: chunk_tfs[chunk_id] for gram, chunk_tfs in index.postings.items() if chunk_id in chunk_tfs}
+        for doc_id in docs:
+            other.add_postings(chunk_id, doc_id, index.chunk_lengths[chunk_id], tfs)
+    assert other.search('太阳病发热') == index.search('太阳病发热')
+
+    restored = NgramIndex()
+    restored.restore({k: set(v) for k, v in index.chunk_docs.items()}, dict(index.chunk_lengths), {g: dict(t) for g, t in index.postings.items()})
+    assert restored.search('太阳病发热') == index.search('太阳病发热')
+    assert {k: set(v) for k, v in restored.chunk_grams.items()} == {k: set(v) for k, v in index.chunk_grams.items()}
+    # 恢复的索引同样能按chunk_grams删除倒排
+    restored.remove('c3', 'd2')
+    assert '伤寒' not in restored.postings
+    assert restored.total_length == index.total_length - index.chunk_lengths['c3']
+
+def test_clear(index):
+    index.clear()
+    assert len(index) == 0
+    assert index.search('太阳') == {}
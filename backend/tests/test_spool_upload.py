@@ -0,0 +1,37 @@
+import asyncio
+import io
+import os
+import pytest
+from fastapi import HTTPException, UploadFile
+from app.api.knowledge import _spool_upload
+from app.core.config import settings
+
+@pytest.fixture(autouse=True)
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_DIR', str(tmp_path / 'uploads'))
+    monkeypatch.setattr(settings, 'UPLOAD_CHUNK_SIZE', 16)
+    return tmp_path / 'uploads'
+
+def _upload(data: bytes, filename: str = '伤寒论.txt') -> UploadFile:
+    return UploadFile(io.BytesIO(data), filename=filename)
+
+def test_same_name_uploads_do_not_overwrite(upload_dir):
+    first = asyncio.run(_spool_upload(_upload('太阳病'.encode('utf-8') * 10)))
+    second = asyncio.run(_spool_upload(_upload(b'second')))
+    assert first[0] != second[0]
+    assert first[0].endswith('_伤寒论.txt')
+    assert first[2] == len('太阳病'.encode('utf-8')) * 10
+    with open(first[1], 'rb') as f:
+        assert f.read() == '太阳病'.encode('utf-8') * 10
+    assert sorted(os.listdir(upload_dir)) == sorted([first[0], second[0]])
+
+def test_path_components_stripped_from_filename(upload_dir):
+    safe_filename, path, _ = asyncio.run(_spool_upload(_upload(b'x', '../../etc/passwd')))
+    assert safe_filename.endswith('_passwd')
+    assert os.path.dirname(path) == str(upload_dir)
+
+def test_oversized_upload_rejected_and_removed(upload_dir):
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(_spool_upload(_upload(b'0' * 100), max_size=50))
+    assert exc.value.status_code == 413
+    assert os.listdir(upload_dir) == []
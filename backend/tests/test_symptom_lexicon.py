@@ -0,0 +1,91 @@
+import threading
+import time
+import pytest
+from app.core.config import settings
+from app.services.symptom_lexicon import CompiledLexicon, SymptomLexicon, parse_lexicon
+
+LEXICON = """
+否定词: 不, 没, 没有, 无, 未, 并不, 从不, 不太
+头痛: 头疼, 脑袋疼
+发热: 发烧, 身热
+恶寒: 怕冷, 畏寒
+无汗: 不出汗, 没出汗, 没有汗, 没汗
+有汗: 出汗, 汗出
+"""
+
+@pytest.fixture(scope='module')
+def lexicon():
+    synonyms, negations = {}, {}
+    parse_lexicon(LEXICON.splitlines(), synonyms, negations)
+    return CompiledLexicon(synonyms, negations, negation_window=2)
+
+@pytest.mark.parametrize('text, expected', [
+    # 词条内部的否定词不否定后面的症状
+    ('无汗发热', ['无汗', '发热']),
+    ('不出汗发烧', ['无汗', '发热']),
+    ('没有汗怕冷', ['无汗', '恶寒']),
+    ('头痛无汗恶寒', ['头痛', '无汗', '恶寒']),
+    ('我头痛，无汗发热', ['头痛', '无汗', '发热']),
+    ('没有汗', ['无汗']),
+])
+def test_negation_inside_symptom_term(lexicon, text, expected):
+    assert lexicon.extract(text) == expected
+
+@pytest.mark.parametrize('text, expected', [
+    ('不怕冷', []),
+    ('没有头痛', []),
+    ('不太发烧，怕冷', ['恶寒']),
+    ('不发热，头痛', ['头痛']),
+    ('并不头痛', []),
+])
+def test_negation_cues(lexicon, text, expected):
+    assert lexicon.extract(text) == expected
+
+def test_negation_window(lexicon):
+    # 否定词与症状之间超过negation_window个字不再视为否定
+    assert lexicon.extract('没有什么头痛') == []
+    assert lexicon.extract('没有任何其他的头痛') == ['头痛']
+
+def test_match_reports_positions(lexicon):
+    matches = lexicon.match('不怕冷')
+    assert [(m['term'], m['symptom'], m['start'], m['end'], m['negated']) for m in matches] == [('怕冷', '恶寒', 1, 3, True)]
+
+def test_reload_check_does_not_block_callers(tmp_path, monkeypatch):
+    lexicon_file = tmp_path / 'symptom_lexicon.txt'
+    lexicon_file.write_text('头痛: 头疼\n', encoding='utf-8')
+    monkeypatch.setattr(settings, 'SYMPTOM_LEXICON_FILE', str(lexicon_file))
+    monkeypatch.setattr(settings, 'SYMPTOM_LEXICON_CATEGORY', '症状词表')
+    monkeypatch.setattr(settings, 'SYMPTOM_LEXICON_RELOAD_INTERVAL', 0.0)
+    release = threading.Event()
+    checking = threading.Event()
+
+    def category_version():
+        # 模拟检查知识库类别时等待知识库锁
+        checking.set()
+        release.wait(5)
+        return ()
+    monkeypatch.setattr(SymptomLexicon, '_category_version', staticmethod(category_version))
+    monkeypatch.setattr(SymptomLexicon, '_compile', lambda self: CompiledLexicon(*_read(lexicon_file), settings.SYMPTOM_NEGATION_WINDOW))
+
+    release.set()
+    lexicon = SymptomLexicon()
+    assert lexicon.extract('头疼') == ['头痛']
+    release.clear()
+    checking.clear()
+    lexicon_file.write_text('头痛: 头疼\n发热: 发烧\n', encoding='utf-8')
+
+    started = time.monotonic()
+    assert lexicon.extract('头疼发烧') == ['头痛']
+    assert checking.wait(5)
+    assert lexicon.extract('头疼发烧') == ['头痛']
+    assert time.monotonic() - started < 1
+    release.set()
+    deadline = time.monotonic() + 5
+    while lexicon.extract('头疼发烧') != ['头痛', '发热'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert lexicon.extract('头疼发烧') == ['头痛', '发热']
+
+def _read(path):
+    synonyms, negations = {}, {}
+    parse_lexicon(path.read_text(encoding='utf-8').splitlines(), synonyms, negations)
+    return synonyms, negations
@@ -13,7 +13,7 @@ echo "检查后端服务..."
 if ! pgrep -f "uvicorn.*8000" > /dev/null; then
     echo "启动后端..."
     cd backend
-    nohup venv/bin/python -m uvicorn app.main:app --host 0.0.0.0 --port 8000 > /tmp/tcm_backend.log 2>&1 &
+    nohup venv/bin/python -m uvicorn app.main:app --host 0.0.0.0 --port 8000 --workers ${TCM_WORKERS:-1} > /tmp/tcm_backend.log 2>&1 &
     sleep 3
     echo "✓ 后端已启动"
 else